@@ -86,7 +86,9 @@ CREATE TABLE fact_sales_order (
     design_id INT NOT NULL REFERENCES dim_design(design_id),
     agreed_payment_date DATE NOT NULL REFERENCES dim_date(date_id),
     agreed_delivery_date DATE NOT NULL REFERENCES dim_date(date_id),
-    agreed_delivery_location_id INT NOT NULL REFERENCES dim_location(location_id)
+    agreed_delivery_location_id INT NOT NULL REFERENCES dim_location(location_id),
+    gross_value NUMERIC(12,2) NOT NULL,
+    gross_value_gbp NUMERIC(12,2)
 );
 
 CREATE TABLE fact_purchase_order (
@@ -0,0 +1,26 @@
+-- Adds the gross_value and gross_value_gbp measures to the fact_sales_order
+-- table of a warehouse built before them, by build-data-wh.sql or
+-- build-data-wh-int-date-keys.sql. The rows already loaded are filled in
+-- as the transform works the measures out: units_sold * unit_price, and
+-- that converted at the GBP rates of version 2022-11-03
+-- (lambda_transform_rates), both rounded half up to the penny.
+
+BEGIN;
+
+ALTER TABLE fact_sales_order
+    ADD COLUMN IF NOT EXISTS gross_value NUMERIC(12,2),
+    ADD COLUMN IF NOT EXISTS gross_value_gbp NUMERIC(12,2);
+
+UPDATE fact_sales_order
+SET gross_value = ROUND(units_sold * unit_price, 2)
+WHERE gross_value IS NULL;
+
+UPDATE fact_sales_order
+SET gross_value_gbp = ROUND(gross_value * gbp_rates.gbp_rate, 2)
+FROM (VALUES (1, 1.0), (2, 0.896), (3, 0.8795)) AS gbp_rates (currency_id, gbp_rate)
+WHERE fact_sales_order.currency_id = gbp_rates.currency_id
+    AND gross_value_gbp IS NULL;
+
+ALTER TABLE fact_sales_order ALTER COLUMN gross_value SET NOT NULL;
+
+COMMIT;
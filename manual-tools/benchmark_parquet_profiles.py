@@ -0,0 +1,82 @@
+"""
+Compares the parquet writer profiles in src.lambda_transform_utils on the
+data/json_lines_s3_format fixtures, scaled up by repeating the source rows.
+
+Run from the project root:
+    PYTHONPATH=. python manual-tools/benchmark_parquet_profiles.py --scale 50
+"""
+
+import argparse
+import io
+import time
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from src.lambda_transform import TRANSFORM_TABLES
+from src.lambda_transform_utils import (
+    PARQUET_WRITER_PROFILES,
+    return_arrow_table_and_write_options,
+    return_parquet_writer_profile,
+)
+
+
+def read_scaled_jsonl(table_name, scale):
+    """Reads a jsonl fixture and repeats its rows scale times."""
+    df = pd.read_json(
+        f"data/json_lines_s3_format/{table_name}.jsonl",
+        lines=True,
+        dtype=False,
+        convert_dates=False,
+    )
+    return pd.concat([df] * scale, ignore_index=True)
+
+
+def encode_table(df, writer_profile):
+    """Encodes a dataframe the same way populate_parquet_file does."""
+    table, write_options = return_arrow_table_and_write_options(df, writer_profile)
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, **write_options)
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scale", type=int, default=50)
+    args = parser.parse_args()
+
+    source_names = {name for _, _, names in TRANSFORM_TABLES for name in names}
+    # the lookup tables are left unscaled so joins keep their cardinality
+    unscaled = {"address", "department", "currency"}
+    source_dfs = {
+        name: read_scaled_jsonl(name, 1 if name in unscaled else args.scale)
+        for name in sorted(source_names)
+    }
+
+    profile_names = ["default"] + list(PARQUET_WRITER_PROFILES)
+    print(f"scale={args.scale}")
+    print(
+        f"{'table':<18}{'rows':>10}"
+        + "".join(f"{name + ' KiB':>14}{name + ' s':>12}" for name in profile_names)
+    )
+    totals = {name: 0 for name in profile_names}
+    for table_name, builder, input_names in TRANSFORM_TABLES:
+        df = builder(*[source_dfs[name] for name in input_names])
+        row = f"{table_name:<18}{len(df):>10}"
+        for profile_name in profile_names:
+            start_time = time.perf_counter()
+            body = encode_table(
+                df, return_parquet_writer_profile(table_name, profile_name)
+            )
+            elapsed = time.perf_counter() - start_time
+            totals[profile_name] += len(body)
+            row += f"{len(body) / 1024:>14.1f}{elapsed:>12.3f}"
+        print(row)
+    print(
+        f"{'total':<28}"
+        + "".join(f"{totals[name] / 1024:>14.1f}{'':>12}" for name in profile_names)
+    )
+
+
+if __name__ == "__main__":
+    main()
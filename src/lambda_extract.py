@@ -11,6 +11,8 @@ from src.utils import (
     close_db,
     get_rows_and_columns_from_table,
     write_table_to_s3,
+    get_primary_keys_from_table,
+    write_key_index_to_s3,
     log_file,
 )
 
@@ -51,6 +53,17 @@ def lambda_handler(event, context):
                 s3_client, bucket_name, table, rows, columns, datetime_string
             )
             keys.append(key)
+            # sorted primary keys of the whole source table, for detecting
+            # deletes and checking keys without reading the rows
+            primary_key = f"{table}_id"
+            if primary_key in columns:
+                write_key_index_to_s3(
+                    s3_client,
+                    bucket_name,
+                    table,
+                    get_primary_keys_from_table(conn, table, primary_key),
+                    datetime_string,
+                )
         # Write log file to S3 bucket
         log_file(s3_client, bucket_name, keys)
         close_db(conn)
@@ -5,8 +5,38 @@ import psycopg2
 import pandas as pd
 import json
 import time
-from src.utils import get_secret
-from src.lambda_transform_utils import return_s3_key
+import pyarrow.csv as csv
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from src.utils import get_secret, return_s3_key
+from src.lambda_transform_utils import read_manifest, return_table_s3_keys
+from src.warehouse_schema import (
+    WAREHOUSE_COLUMN_TYPES,
+    WAREHOUSE_FOREIGN_KEYS,
+    cast_to_warehouse_schema,
+)
+from src.lambda_transform_money import return_fixed_point_measures
+
+# parquet files of a partitioned table read from S3 at once
+MAX_READ_WORKERS = 4
+
+# warehouse tables in load order, from the schema catalog: the dimensions,
+# which reference no table, before the fact tables that reference them
+FACT_TABLES = list(WAREHOUSE_FOREIGN_KEYS)
+LIST_OF_TABLES = [
+    table for table in WAREHOUSE_COLUMN_TYPES if table not in FACT_TABLES
+] + FACT_TABLES
+
+# the run whose output each warehouse table holds, written by every load
+LOAD_WATERMARK_S3_KEY = "load/watermark.json"
+
+# the dimensions each fact table references, for reloading a fact table
+# whenever one of them is reloaded
+FACT_TABLE_DIMENSIONS = {
+    fact_table: list(dict.fromkeys(foreign_keys.values()))
+    for fact_table, foreign_keys in WAREHOUSE_FOREIGN_KEYS.items()
+}
 
 
 def lambda_handler(event, context):
@@ -22,7 +52,34 @@ def lambda_handler(event, context):
         else:
             secret_name = event["SECRET_NAME"]
         db_credentials = get_secret(sm_client, secret_name)
-        dw_cleanup(db_credentials)
+
+        bucket_name = "totesys-processed-zone-fenor"
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+
+        # the manifest lists the partitions of partitioned tables and the
+        # tables the transform reused unchanged from its previous run
+        manifest = read_manifest(s3_client, bucket_name, event["datetime_string"])
+        processed_tables = None
+        if manifest is None:
+            processed_tables = return_processed_tables(
+                s3_client, bucket_name, event["datetime_string"]
+            )
+        watermark = read_load_watermark(s3_client, bucket_name)
+        list_of_tables = return_tables_to_load(
+            manifest, event.get("full_reload", False), processed_tables, watermark
+        )
+        # the tables about to be emptied hold no run's output until the load
+        # succeeds, so a failed load leaves them out of the watermark
+        write_load_watermark(
+            s3_client,
+            bucket_name,
+            {
+                table: mark
+                for table, mark in watermark.items()
+                if table not in list_of_tables
+            },
+        )
+        dw_cleanup(db_credentials, list_of_tables)
 
         # Connection
         print("Loading started...")
@@ -30,48 +87,35 @@ def lambda_handler(event, context):
         conn = load_connection_psycopg2(db_credentials)
         cursor = conn.cursor()
 
-        bucket_name = "totesys-processed-zone-fenor"
-        s3_client = boto3.client("s3", region_name="eu-west-2")
-
-        list_of_tables = [
-            "dim_date",
-            "dim_design",
-            "dim_location",
-            "dim_counterparty",
-            "dim_staff",
-            "dim_currency",
-            "fact_sales_order",
-        ]
-
-        # Insert statement
+        # Copy statement
         for file in list_of_tables:
 
-            # Read parquet file
-            s3_key = return_s3_key(file, event["datetime_string"], extension=".parquet")
-            s3_response = s3_client.get_object(Bucket=bucket_name, Key=s3_key)
-            parquet_data = s3_response["Body"].read()
-            df = pd.read_parquet(io.BytesIO(parquet_data))
-            df = df.reset_index()
-
-            # Build Insert query
-            df_columns = df.columns.tolist()
-            df_columns = ", ".join(df_columns)
-            df_placeholders = ", ".join(["%s"] * len(df.columns))
-
-            insert_query = f"""
-            INSERT INTO {file} 
-            ({df_columns})
-            VALUES 
-            ({df_placeholders})
-            """
-
-            for _, row in df.iterrows():
-                row_dict = row.to_dict()
-                cursor.execute(insert_query, tuple(row_dict.values()))
+            # Read parquet files, the partitions of a table in parallel
+            s3_keys = return_table_s3_keys(manifest, file, event["datetime_string"])
+            with ThreadPoolExecutor(max_workers=MAX_READ_WORKERS) as pool:
+                tables = pool.map(
+                    lambda s3_key: read_parquet_table(
+                        s3_client, bucket_name, s3_key, file
+                    ),
+                    s3_keys,
+                )
+                for table in tables:
+                    copy_table(cursor, file, table)
             conn.commit()
 
         cursor.close()
         conn.close()
+        write_load_watermark(
+            s3_client,
+            bucket_name,
+            return_load_watermark(
+                watermark,
+                manifest,
+                list_of_tables,
+                processed_tables,
+                event["datetime_string"],
+            ),
+        )
         end_time = time.time()
         execution_time = end_time - start_time
         return {"message": "Successfully uploaded to data warehouse"}
@@ -79,8 +123,172 @@ def lambda_handler(event, context):
         return {"message": f"Error: {e}"}
 
 
+def return_tables_to_load(
+    manifest, full_reload=False, processed_tables=None, watermark=None
+):
+    """
+    returns the tables to reload, skipping the ones the transform reused
+    unchanged from an earlier run, or found unchanged by diffing their
+    inputs with the previous snapshot, when the load watermark shows the
+    warehouse holds that run's output, and the ones it did not build. a
+    fact table is reloaded whenever a dimension it references is. without
+    a manifest every table is loaded, or only the processed_tables if given.
+    """
+    if manifest is None:
+        return [
+            table
+            for table in LIST_OF_TABLES
+            if processed_tables is None or table in processed_tables
+        ]
+    entries = manifest["tables"]
+    built = [table for table in LIST_OF_TABLES if table in entries]
+    if full_reload:
+        return built
+    tables = [
+        table
+        for table in built
+        if not is_table_loaded(entries[table], table, watermark)
+    ]
+    for fact_table in FACT_TABLES:
+        if fact_table in built and fact_table not in tables:
+            if any(table in tables for table in FACT_TABLE_DIMENSIONS[fact_table]):
+                tables.append(fact_table)
+    return [table for table in LIST_OF_TABLES if table in tables]
+
+
+def return_source_run(entry):
+    """
+    returns the run a manifest entry's output was reused or found unchanged
+    from, None if it was built by its own run
+    """
+    return entry.get("reused_from", entry.get("unchanged_from"))
+
+
+def is_table_loaded(entry, table_name, watermark):
+    """
+    returns whether the warehouse already holds a table's output: it was
+    reused or found unchanged from a run that the load watermark records
+    as loaded into the table, or as the run whose output that was.
+    """
+    source_run = return_source_run(entry)
+    mark = (watermark or {}).get(table_name)
+    if source_run is None or mark is None:
+        return False
+    return source_run in (mark["datetime_string"], mark["content_from"])
+
+
+def return_load_watermark(
+    watermark, manifest, loaded_tables, processed_tables, datetime_string
+):
+    """
+    returns the load watermark after a successful load of a run: every
+    table it loaded, or skipped as already loaded, holds that run's output,
+    built by the run recorded as content_from. other tables keep their mark.
+    """
+    watermark = dict(watermark)
+    if manifest is None:
+        entries = {table: {} for table in processed_tables or LIST_OF_TABLES}
+    else:
+        entries = manifest["tables"]
+    for table, entry in entries.items():
+        if table not in LIST_OF_TABLES:
+            continue
+        if table in loaded_tables:
+            content_from = return_source_run(entry) or datetime_string
+        else:
+            content_from = watermark[table]["content_from"]
+        watermark[table] = {
+            "datetime_string": datetime_string,
+            "content_from": content_from,
+        }
+    return watermark
+
+
+def read_load_watermark(s3_client, bucket_name):
+    """returns the load watermark, empty if no load has written one"""
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=LOAD_WATERMARK_S3_KEY)
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return {}
+        raise
+    return json.loads(response["Body"].read())
+
+
+def write_load_watermark(s3_client, bucket_name, watermark):
+    """writes the load watermark, mapping each table to the run it holds"""
+    return s3_client.put_object(
+        Bucket=bucket_name,
+        Key=LOAD_WATERMARK_S3_KEY,
+        Body=json.dumps(watermark, indent=2),
+    )
+
+
+def return_processed_tables(s3_client, bucket_name, datetime_string):
+    """
+    returns the tables with a parquet file in a run's processed output, for
+    the runs written before the transform wrote manifests, which hold only
+    the tables it built then.
+    """
+    paginator = s3_client.get_paginator("list_objects_v2")
+    keys = {
+        s3_object["Key"]
+        for page in paginator.paginate(
+            Bucket=bucket_name, Prefix=f"data/{datetime_string}/"
+        )
+        for s3_object in page.get("Contents", [])
+    }
+    return [
+        table
+        for table in LIST_OF_TABLES
+        if return_s3_key(table, datetime_string, extension=".parquet") in keys
+    ]
+
+
+def read_parquet_table(s3_client, bucket_name, s3_key, table_name):
+    """
+    reads a processed parquet file into an arrow table of the table's
+    warehouse schema, whichever types the transform wrote it with.
+    """
+    s3_response = s3_client.get_object(Bucket=bucket_name, Key=s3_key)
+    table = pq.read_table(io.BytesIO(s3_response["Body"].read()))
+    return cast_to_warehouse_schema(table_name, add_missing_measures(table_name, table))
+
+
+def add_missing_measures(table_name, table):
+    """
+    adds the gross_value measures to fact_sales_order files written before
+    the transform built them, worked out as it does with fixed_point_money
+    at the current GBP rates version. other tables are returned unchanged.
+    """
+    if table_name != "fact_sales_order" or "gross_value" in table.column_names:
+        return table
+    measures = return_fixed_point_measures(
+        table["units_sold"], table["unit_price"], table["currency_id"]
+    )
+    for name in ["gross_value", "gross_value_gbp"]:
+        table = table.append_column(name, measures[name])
+    return table
+
+
+def copy_table(cursor, table_name, table):
+    """
+    copies an arrow table into its warehouse table with COPY, as csv
+    written by arrow. Null values are written unquoted and strings quoted,
+    as postgres csv tells NULL from an empty string.
+    """
+    buffer = io.BytesIO()
+    csv.write_csv(table, buffer)
+    buffer.seek(0)
+    columns = ", ".join(table.column_names)
+    cursor.copy_expert(
+        f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv, HEADER true)",
+        buffer,
+    )
+
+
 def load_connection_psycopg2(db_credentials):
-    ''' use psychopg to connect to the data warehouse. '''
+    """use psychopg to connect to the data warehouse."""
     try:
         conn = psycopg2.connect(
             dbname=db_credentials["database"],
@@ -97,24 +305,22 @@ def load_connection_psycopg2(db_credentials):
         }
 
 
-def dw_cleanup(db_credentials):
-    '''
+def dw_cleanup(db_credentials, tables=None):
+    """
     reset the datawarehouse ready for the data to be reuploaded.
     Future improvements for this ETL pipeline would include only
     collecting new and updated data from the ToteSys database and
-    refactoring lambda transform to be able to deal with this data 
+    refactoring lambda transform to be able to deal with this data
     and finally refactoring lambda load so that it only needs to
     update the data warehouse with new or updated data rather than
     totally re-seeding it each time.
-    '''
+    If tables is given, only those tables are emptied.
+    """
     conn = load_connection_psycopg2(db_credentials)
     cursor = conn.cursor()
-    cursor.execute("DELETE FROM fact_sales_order")
-    cursor.execute("DELETE FROM dim_counterparty")
-    cursor.execute("DELETE FROM dim_currency")
-    cursor.execute("DELETE FROM dim_date")
-    cursor.execute("DELETE FROM dim_design")
-    cursor.execute("DELETE FROM dim_location")
-    cursor.execute("DELETE FROM dim_staff")
+    # fact tables first, before the dimensions they reference
+    for table in reversed(LIST_OF_TABLES):
+        if tables is None or table in tables:
+            cursor.execute(f"DELETE FROM {table}")
     conn.commit()
     return {"message": "Date Warehouse restored to default state."}
@@ -6,11 +6,15 @@ import boto3
 from botocore.exceptions import ClientError, NoCredentialsError
 from pg8000.exceptions import DatabaseError
 import logging
+import time
+import pandas as pd
 from datetime import datetime
 from random import random, randint
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 
-from src.utils import return_datetime_string
+from src.utils import return_datetime_string, read_key_index
 
 from src.lambda_transform_utils import (
     read_s3_table_json,
@@ -22,7 +26,61 @@ from src.lambda_transform_utils import (
     _return_df_dim_staff,
     _return_df_dim_currency,
     _return_df_fact_sales_order,
+    _return_df_dim_payment_type,
+    _return_df_dim_transaction,
+    _return_df_fact_purchase_order,
+    _return_df_fact_payment,
+    _return_unique_fact_dates,
     return_s3_key,
+    build_and_populate_table,
+    build_and_populate_sales_order_chunked,
+    copy_on_write,
+    SALES_ORDER_CHUNKED_TABLES,
+    TABLE_PARTITION_COLUMNS,
+    return_manifest_entry,
+    populate_manifest,
+    read_manifest,
+    return_builder_version,
+    return_table_fingerprint,
+    read_fingerprint_record,
+    populate_fingerprint_record,
+    copy_table_output,
+    read_s3_table_json_cached,
+    S3_TABLE_CACHE,
+    S3_TABLE_CACHE_MAX_BYTES,
+    return_parquet_writer_profile,
+)
+from src.lambda_transform_arrow import (
+    read_s3_table_arrow,
+    _return_table_dim_dates,
+    _return_table_dim_design,
+    _return_table_dim_location,
+    _return_table_dim_counterparty,
+    _return_table_dim_staff,
+    _return_table_dim_currency,
+    _return_table_fact_sales_order,
+    _return_table_dim_payment_type,
+    _return_table_dim_transaction,
+    _return_table_fact_purchase_order,
+    _return_table_fact_payment,
+)
+from src.lambda_transform_keys import SalesRecordKeyMap
+from src.lambda_transform_state import (
+    update_current_state,
+    keep_latest_versions,
+    SOURCE_TABLE_KEYS,
+    LATEST_VERSION_KEYS,
+)
+from src.lambda_transform_validation import ReferenceValidator
+from src.lambda_transform_rates import GBP_RATE_VERSIONS, CURRENT_GBP_RATES_VERSION
+from src.lambda_transform_money import FIXED_POINT_MONEY_COLUMNS
+from src.lambda_transform_shards import SHARDED_TABLES, build_and_populate_table_sharded
+from src.warehouse_schema import WAREHOUSE_FOREIGN_KEYS, WAREHOUSE_DATE_KEY_COLUMNS
+from src.lambda_transform_diff import (
+    CHANGE_KINDS,
+    diff_snapshots,
+    populate_change_sets,
+    return_previous_datetime_string,
 )
 
 
@@ -30,11 +88,342 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+# warehouse table, builder and the ingestion tables it is built from
+TRANSFORM_TABLES = [
+    ("dim_date", _return_df_dim_dates, ["sales_order"]),
+    ("dim_design", _return_df_dim_design, ["design"]),
+    ("dim_location", _return_df_dim_location, ["address"]),
+    ("dim_counterparty", _return_df_dim_counterparty, ["counterparty", "address"]),
+    ("dim_staff", _return_df_dim_staff, ["staff", "department"]),
+    ("dim_currency", _return_df_dim_currency, ["currency"]),
+    ("fact_sales_order", _return_df_fact_sales_order, ["sales_order"]),
+]
+
+# the same tables built with pyarrow.compute, see lambda_transform_arrow
+ARROW_TRANSFORM_TABLES = [
+    ("dim_date", _return_table_dim_dates, ["sales_order"]),
+    ("dim_design", _return_table_dim_design, ["design"]),
+    ("dim_location", _return_table_dim_location, ["address"]),
+    ("dim_counterparty", _return_table_dim_counterparty, ["counterparty", "address"]),
+    ("dim_staff", _return_table_dim_staff, ["staff", "department"]),
+    ("dim_currency", _return_table_dim_currency, ["currency"]),
+    ("fact_sales_order", _return_table_fact_sales_order, ["sales_order"]),
+]
+
+# the rest of the warehouse schema, built with all_tables set: the purchase
+# and payment facts and their dimensions, with dim_date then built from the
+# dates of every fact's source table in one pass
+FACT_SOURCE_TABLES = ["sales_order", "purchase_order", "payment"]
+ALL_TABLES_TRANSFORM_TABLES = [
+    ("dim_date", _return_df_dim_dates, FACT_SOURCE_TABLES),
+    ("dim_payment_type", _return_df_dim_payment_type, ["payment_type"]),
+    ("dim_transaction", _return_df_dim_transaction, ["transaction"]),
+    ("fact_purchase_order", _return_df_fact_purchase_order, ["purchase_order"]),
+    ("fact_payment", _return_df_fact_payment, ["payment"]),
+]
+ARROW_ALL_TABLES_TRANSFORM_TABLES = [
+    ("dim_date", _return_table_dim_dates, FACT_SOURCE_TABLES),
+    ("dim_payment_type", _return_table_dim_payment_type, ["payment_type"]),
+    ("dim_transaction", _return_table_dim_transaction, ["transaction"]),
+    ("fact_purchase_order", _return_table_fact_purchase_order, ["purchase_order"]),
+    ("fact_payment", _return_table_fact_payment, ["payment"]),
+]
+
+# transform engine name -> (ingestion file reader, table builders, builders
+# of the rest of the schema); the duckdb engine is added on first use by
+# return_transform_engine
+TRANSFORM_ENGINES = {
+    "pandas": (read_s3_table_json, TRANSFORM_TABLES, ALL_TABLES_TRANSFORM_TABLES),
+    "arrow": (
+        read_s3_table_arrow,
+        ARROW_TRANSFORM_TABLES,
+        ARROW_ALL_TABLES_TRANSFORM_TABLES,
+    ),
+}
+
+
+def return_transform_engine(engine):
+    """
+    Returns the TRANSFORM_ENGINES entry of an engine. The duckdb engine's
+    module is imported here rather than with this one, as duckdb is only
+    packaged in the layer of a deployment whose TRANSFORM_ENGINE is duckdb;
+    it builds the same tables by DuckDB SQL statements, see
+    lambda_transform_duckdb.
+    """
+    if engine == "duckdb" and engine not in TRANSFORM_ENGINES:
+        from src.lambda_transform_duckdb import (
+            read_s3_table_duckdb,
+            return_duckdb_builder,
+        )
+
+        TRANSFORM_ENGINES[engine] = (
+            read_s3_table_duckdb,
+            [
+                (table_name, return_duckdb_builder(table_name, inputs), inputs)
+                for table_name, _, inputs in TRANSFORM_TABLES
+            ],
+            [
+                (table_name, return_duckdb_builder(table_name, inputs), inputs)
+                for table_name, _, inputs in ALL_TABLES_TRANSFORM_TABLES
+            ],
+        )
+    return TRANSFORM_ENGINES[engine]
+
+
+# defaults for the run options, each can be overridden by the event or by
+# a TRANSFORM_<OPTION> environment variable
+DEFAULT_RUN_OPTIONS = {
+    "engine": "pandas",
+    "execution_mode": "sequential",
+    "max_workers": 4,
+    "arrow_temporal": False,
+    "parquet_profile": "zstd",
+    "streaming_upload": False,
+    "chunk_rows": 0,
+    "fact_partitioning": "none",
+    "reuse_outputs": False,
+    "input_cache_bytes": S3_TABLE_CACHE_MAX_BYTES,
+    "stable_keys": False,
+    "compact_dtypes": False,
+    "warehouse_types": False,
+    "incremental": False,
+    "latest_versions": False,
+    "snapshot_diff": False,
+    "all_tables": False,
+    "validate_references": False,
+    "int_date_keys": False,
+    "gbp_rates_version": CURRENT_GBP_RATES_VERSION,
+    "fixed_point_money": False,
+    "fact_shards": 0,
+}
+
+# the run options that change the files written, so are part of the
+# fingerprint of the tables they apply to (None for every table)
+OUTPUT_RUN_OPTIONS = {
+    "engine": None,
+    "parquet_profile": None,
+    "compact_dtypes": None,
+    "warehouse_types": None,
+    "incremental": None,
+    "latest_versions": None,
+    "validate_references": None,
+    "arrow_temporal": ["fact_sales_order"],
+    "int_date_keys": list(WAREHOUSE_DATE_KEY_COLUMNS),
+    "stable_keys": ["fact_sales_order"],
+    "gbp_rates_version": ["fact_sales_order"],
+    "fixed_point_money": list(FIXED_POINT_MONEY_COLUMNS),
+    "fact_partitioning": list(TABLE_PARTITION_COLUMNS),
+    "chunk_rows": SALES_ORDER_CHUNKED_TABLES,
+    "fact_shards": SHARDED_TABLES,
+}
+
+
+def return_run_options(event):
+    """
+    Returns the run options for this invocation. Values in the event take
+    priority over TRANSFORM_<OPTION> environment variables, which take
+    priority over DEFAULT_RUN_OPTIONS.
+    """
+    run_options = dict(DEFAULT_RUN_OPTIONS)
+    for option, default in DEFAULT_RUN_OPTIONS.items():
+        env_value = os.environ.get(f"TRANSFORM_{option.upper()}")
+        if env_value is None:
+            continue
+        if isinstance(default, bool):
+            run_options[option] = env_value.lower() in ("1", "true", "yes")
+        elif isinstance(default, int):
+            run_options[option] = int(env_value)
+        else:
+            run_options[option] = env_value
+    for option in DEFAULT_RUN_OPTIONS:
+        if option in event:
+            run_options[option] = event[option]
+    return run_options
+
+
+def return_transform_tables(transform_tables, all_tables_transform_tables):
+    """
+    Returns the warehouse tables, builders and inputs of a full schema run:
+    transform_tables with the tables of all_tables_transform_tables replacing
+    those of the same name, and the rest appended
+    """
+    replacements = {entry[0]: entry for entry in all_tables_transform_tables}
+    tables = [replacements.pop(entry[0], entry) for entry in transform_tables]
+    return tables + list(replacements.values())
+
+
+def return_table_input_names(transform_tables, validate_references=False):
+    """
+    Returns the ingestion tables each warehouse table depends on: its
+    inputs, and when validate_references is set for a fact, the inputs of
+    the dimensions it references, whose keys decide which rows are valid
+    """
+    input_names = {table_name: list(names) for table_name, _, names in transform_tables}
+    if validate_references:
+        for table_name, foreign_keys in WAREHOUSE_FOREIGN_KEYS.items():
+            if table_name not in input_names:
+                continue
+            for dimension in dict.fromkeys(foreign_keys.values()):
+                for name in input_names.get(dimension, []):
+                    if name not in input_names[table_name]:
+                        input_names[table_name].append(name)
+    return input_names
+
+
+def build_and_populate_tables(jobs, execution_mode="sequential", max_workers=4):
+    """
+    Runs build_and_populate_table for each job, in a thread pool if
+    execution_mode is "parallel", returning the results in job order
+    """
+    if execution_mode == "parallel":
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(lambda args: build_and_populate_table(*args), jobs))
+    return [build_and_populate_table(*args) for args in jobs]
+
+
+def return_output_run_options(table_name, run_options):
+    """Returns the run options that change the file written for a table"""
+    return {
+        option: run_options[option]
+        for option, table_names in OUTPUT_RUN_OPTIONS.items()
+        if table_names is None or table_name in table_names
+    }
+
+
+def reuse_unchanged_tables(
+    s3_client,
+    datetime_string,
+    ingestion_bucket_name,
+    processed_bucket_name,
+    transform_tables,
+    run_options,
+):
+    """
+    Fingerprints each table on the ETags of its ingestion files, its builder
+    code and the output run options. Tables whose fingerprint matches that
+    of their last output have it copied to this run instead of being built.
+    Returns the fingerprints, and the manifest entries and timings of the
+    reused tables.
+    """
+    table_input_names = return_table_input_names(
+        transform_tables, run_options["validate_references"]
+    )
+    input_table_names = {
+        name for input_names in table_input_names.values() for name in input_names
+    }
+    input_etags = {
+        name: s3_client.head_object(
+            Bucket=ingestion_bucket_name, Key=return_s3_key(name, datetime_string)
+        )["ETag"]
+        for name in sorted(input_table_names)
+    }
+    fingerprints = {
+        table_name: return_table_fingerprint(
+            table_name,
+            return_builder_version(builder),
+            {name: input_etags[name] for name in table_input_names[table_name]},
+            return_output_run_options(table_name, run_options),
+        )
+        for table_name, builder, _ in transform_tables
+    }
+    records = {
+        table_name: read_fingerprint_record(
+            s3_client, processed_bucket_name, table_name
+        )
+        for table_name in fingerprints
+    }
+    reusable = [
+        table_name
+        for table_name, record in records.items()
+        if record is not None and record["fingerprint"] == fingerprints[table_name]
+    ]
+    if run_options["chunk_rows"] > 0:
+        # chunked mode builds the sales_order tables together, so they are
+        # only reused together
+        if not all(name in reusable for name in SALES_ORDER_CHUNKED_TABLES):
+            reusable = [
+                name for name in reusable if name not in SALES_ORDER_CHUNKED_TABLES
+            ]
+
+    reused_entries = {}
+    reused_timings = {}
+    for table_name in reusable:
+        start_time = time.perf_counter()
+        reused_entries[table_name] = copy_table_output(
+            s3_client, processed_bucket_name, records[table_name], datetime_string
+        )
+        reused_timings[table_name] = {
+            "copy_seconds": time.perf_counter() - start_time,
+            "rows": reused_entries[table_name]["rows"],
+        }
+    return fingerprints, reused_entries, reused_timings
+
+
+def diff_input_tables(
+    s3_client,
+    read_table,
+    datetime_string,
+    previous_datetime_string,
+    ingestion_bucket_name,
+    processed_bucket_name,
+    input_dfs,
+):
+    """
+    Diffs each input table against its snapshot at previous_datetime_string
+    and writes the inserted, updated and deleted rows to the processed
+    bucket. Returns the change sets and their manifest entries, keyed by
+    input table name.
+    """
+    changes = {}
+    change_entries = {}
+    for name, df_input in input_dfs.items():
+        start_time = time.perf_counter()
+        df_previous = read_table(
+            s3_client,
+            return_s3_key(name, previous_datetime_string),
+            ingestion_bucket_name,
+        )
+        changes[name] = diff_snapshots(df_previous, df_input, SOURCE_TABLE_KEYS[name])
+        change_entries[name] = populate_change_sets(
+            s3_client, datetime_string, processed_bucket_name, name, changes[name]
+        )
+        change_entries[name]["seconds"] = time.perf_counter() - start_time
+    return changes, change_entries
+
+
+def return_unchanged_tables(
+    transform_tables, change_entries, previous_manifest, build_fingerprints
+):
+    """
+    Returns the tables built this run whose inputs have no changes since the
+    previous snapshot and whose builder and output options are those of the
+    previous run's output, so the warehouse already holds their rows
+    """
+    if previous_manifest is None:
+        return []
+    previous_entries = previous_manifest["tables"]
+    return [
+        table_name
+        for table_name, _, input_names in transform_tables
+        if all(
+            name in change_entries
+            and not any(
+                change_entries[name][change_kind]["rows"]
+                for change_kind in CHANGE_KINDS
+            )
+            for name in input_names
+        )
+        and previous_entries.get(table_name, {}).get("build_fingerprint")
+        == build_fingerprints[table_name]
+    ]
+
+
+@copy_on_write
 def lambda_handler(event, context):
     """
     Function to transform the data landing in the ingestion bucket.
     JSON files are read from S3 and converted to pandas dataframes
-    with extrapolated data to fit the fact and dimension tables of 
+    with extrapolated data to fit the fact and dimension tables of
     the pre-existing star schema data warehouse.
     Dataframes are then converted to parquet format to be stored in
     the 'processed' S3 bucket, ready for loading.
@@ -45,114 +434,385 @@ def lambda_handler(event, context):
         s3_client = boto3.client("s3", region_name="eu-west-2")
         ingestion_bucket_name = os.environ.get("INGESTION_BUCKET")
         processed_bucket_name = os.environ.get("PROCESSED_BUCKET")
-        responses = []
 
         # testing_backdoor
         if "testing_client" in event.keys() != None:
             s3_client = event["testing_client"]
 
-        # read ingestion files
-        df_totesys_sales_order = read_s3_table_json(
-            s3_client,
-            return_s3_key("sales_order", datetime_string),
-            ingestion_bucket_name,
-        )
-        df_totesys_design = read_s3_table_json(
-            s3_client, return_s3_key("design", datetime_string), ingestion_bucket_name
-        )
-        df_totesys_address = read_s3_table_json(
-            s3_client, return_s3_key("address", datetime_string), ingestion_bucket_name
-        )
-        df_totesys_counterparty = read_s3_table_json(
-            s3_client,
-            return_s3_key("counterparty", datetime_string),
-            ingestion_bucket_name,
-        )
-        df_totesys_staff = read_s3_table_json(
-            s3_client, return_s3_key("staff", datetime_string), ingestion_bucket_name
-        )
-        df_totesys_department = read_s3_table_json(
-            s3_client,
-            return_s3_key("department", datetime_string),
-            ingestion_bucket_name,
-        )
-        df_totesys_currency = read_s3_table_json(
-            s3_client, return_s3_key("currency", datetime_string), ingestion_bucket_name
+        run_options = return_run_options(event)
+        read_table, all_tables, rest_of_schema = return_transform_engine(
+            run_options["engine"]
         )
+        # with all_tables set, the purchase and payment tables are built too
+        if run_options["all_tables"]:
+            all_tables = return_transform_tables(all_tables, rest_of_schema)
+        if (run_options["incremental"] or run_options["snapshot_diff"]) and (
+            run_options["engine"] != "pandas" or run_options["chunk_rows"] > 0
+        ):
+            raise ValueError(
+                "incremental and snapshot_diff runs need the pandas engine, "
+                "without chunk_rows"
+            )
+        if run_options["fact_shards"] > 0 and (
+            run_options["engine"] != "pandas"
+            or run_options["chunk_rows"] > 0
+            or run_options["fact_partitioning"] != "none"
+        ):
+            raise ValueError(
+                "fact_shards runs need the pandas engine, without chunk_rows "
+                "or fact_partitioning"
+            )
+        if run_options["gbp_rates_version"] not in GBP_RATE_VERSIONS:
+            raise ValueError(f"no GBP rates version {run_options['gbp_rates_version']}")
 
-        # produce and populate
-        df_dim_dates = _return_df_dim_dates(df_totesys_sales_order)
-        r = populate_parquet_file(
-            s3_client, datetime_string, "dim_date", df_dim_dates, processed_bucket_name
-        )
-        responses += [r]
+        # parsed ingestion tables are cached across warm invocations, an
+        # input_cache_bytes of 0 empties and disables the cache
+        S3_TABLE_CACHE.resize(run_options["input_cache_bytes"])
+        if run_options["engine"] == "pandas" and run_options["input_cache_bytes"] > 0:
+            read_table = read_s3_table_json_cached
 
-        df_dim_design = _return_df_dim_design(df_totesys_design)
-        r = populate_parquet_file(
-            s3_client,
-            datetime_string,
-            "dim_design",
-            df_dim_design,
-            processed_bucket_name,
-        )
-        responses += [r]
+        # with reuse_outputs set, tables whose inputs, builder and output
+        # options are unchanged since their last output are copied from it
+        fingerprints, reused_entries, reused_timings = {}, {}, {}
+        if run_options["reuse_outputs"]:
+            fingerprints, reused_entries, reused_timings = reuse_unchanged_tables(
+                s3_client,
+                datetime_string,
+                ingestion_bucket_name,
+                processed_bucket_name,
+                all_tables,
+                run_options,
+            )
 
-        df_dim_location = _return_df_dim_location(df_totesys_address)
-        r = populate_parquet_file(
-            s3_client,
-            datetime_string,
-            "dim_location",
-            df_dim_location,
-            processed_bucket_name,
-        )
-        responses += [r]
+        # with chunk_rows set, the sales_order tables are built batch by batch,
+        # with the pandas builders whatever the engine,
+        # instead of from the whole sales_order table
+        chunked_tables = []
+        if run_options["chunk_rows"] > 0:
+            chunked_tables = SALES_ORDER_CHUNKED_TABLES
+        chunked = any(name not in reused_entries for name in chunked_tables)
+        transform_tables = [
+            (table_name, builder, input_names)
+            for table_name, builder, input_names in all_tables
+            if table_name not in reused_entries and table_name not in chunked_tables
+        ]
 
-        df_dim_counterparty = _return_df_dim_counterparty(
-            df_totesys_counterparty, df_totesys_address
-        )
-        r = populate_parquet_file(
-            s3_client,
-            datetime_string,
-            "dim_counterparty",
-            df_dim_counterparty,
-            processed_bucket_name,
-        )
-        responses += [r]
+        # read ingestion files
+        input_table_names = {
+            name for _, _, input_names in transform_tables for name in input_names
+        }
+        input_dfs = {
+            name: read_table(
+                s3_client, return_s3_key(name, datetime_string), ingestion_bucket_name
+            )
+            for name in sorted(input_table_names)
+        }
 
-        df_dim_staff = _return_df_dim_staff(df_totesys_staff, df_totesys_department)
-        r = populate_parquet_file(
-            s3_client, datetime_string, "dim_staff", df_dim_staff, processed_bucket_name
-        )
-        responses += [r]
+        # with snapshot_diff set, each input table is diffed against its
+        # previous snapshot, and the inserted, updated and deleted rows are
+        # written next to the outputs
+        changes, change_entries = {}, {}
+        previous_datetime_string = None
+        if run_options["snapshot_diff"]:
+            previous_datetime_string = event.get(
+                "previous_datetime_string"
+            ) or return_previous_datetime_string(
+                s3_client, ingestion_bucket_name, datetime_string
+            )
+        if previous_datetime_string is not None:
+            changes, change_entries = diff_input_tables(
+                s3_client,
+                read_table,
+                datetime_string,
+                previous_datetime_string,
+                ingestion_bucket_name,
+                processed_bucket_name,
+                input_dfs,
+            )
 
-        df_dim_currency = _return_df_dim_currency(df_totesys_currency)
-        r = populate_parquet_file(
-            s3_client,
-            datetime_string,
-            "dim_currency",
-            df_dim_currency,
-            processed_bucket_name,
-        )
-        responses += [r]
+        # with incremental set, ingestion snapshots hold only the rows changed
+        # since the last one, which are merged into the current state of
+        # their source table kept in the processed bucket. Rows deleted from
+        # the source are found from the snapshot's key index. Full snapshots
+        # diffed with snapshot_diff are merged as their change sets.
+        if run_options["incremental"]:
+            for name, df_input in input_dfs.items():
+                df_delta, df_deleted, df_snapshot = df_input, None, None
+                key_index = None
+                if name in changes:
+                    df_delta = pd.concat(
+                        [changes[name]["inserted"], changes[name]["updated"]],
+                        ignore_index=True,
+                    )
+                    df_deleted, df_snapshot = changes[name]["deleted"], df_input
+                else:
+                    key_index = read_key_index(
+                        s3_client, ingestion_bucket_name, name, datetime_string
+                    )
+                input_dfs[name] = update_current_state(
+                    s3_client,
+                    processed_bucket_name,
+                    name,
+                    df_delta,
+                    df_deleted,
+                    df_snapshot,
+                    key_index,
+                )
 
-        df_fact_sales_order = _return_df_fact_sales_order(df_totesys_sales_order)
-        r = populate_parquet_file(
-            s3_client,
-            datetime_string,
-            "fact_sales_order",
-            df_fact_sales_order,
-            processed_bucket_name,
-        )
-        responses += [r]
+        # with latest_versions set, source rows repeated across combined
+        # snapshots are reduced to the latest version of each primary key
+        if run_options["latest_versions"]:
+            input_dfs = {
+                name: keep_latest_versions(df_input, LATEST_VERSION_KEYS[name])
+                for name, df_input in input_dfs.items()
+            }
+
+        # with stable_keys, sales_record_id keys are kept across runs by the
+        # key map stored in the processed bucket
+        key_map = None
+        if run_options["stable_keys"]:
+            key_map = SalesRecordKeyMap.read(s3_client, processed_bucket_name)
+
+        # with validate_references, rows breaking the warehouse's NOT NULL,
+        # primary key or foreign key rules are quarantined instead of written.
+        # Dimensions copied from a previous output are read for their keys.
+        validator = None
+        if run_options["validate_references"]:
+            validator = ReferenceValidator()
+            for table_name in reused_entries:
+                if table_name not in WAREHOUSE_FOREIGN_KEYS:
+                    validator.read_dimension_keys(
+                        s3_client, processed_bucket_name, table_name, datetime_string
+                    )
+
+        # produce and populate
+        builder_kwargs = {
+            "fact_sales_order": {
+                "arrow_temporal": run_options["arrow_temporal"],
+                "key_map": key_map,
+                "gbp_rates_version": run_options["gbp_rates_version"],
+            },
+        }
+        # with fixed_point_money the money columns of the fact tables are
+        # decimals worked out in pence rather than floats
+        if run_options["fixed_point_money"]:
+            for table_name in FIXED_POINT_MONEY_COLUMNS:
+                builder_kwargs.setdefault(table_name, {})["fixed_point_money"] = True
+        # with int_date_keys the date keys are int32 yyyymmdd smart keys, to
+        # load into a warehouse built with db/build-data-wh-int-date-keys.sql
+        if run_options["int_date_keys"]:
+            for table_name in WAREHOUSE_DATE_KEY_COLUMNS:
+                builder_kwargs.setdefault(table_name, {})["int_date_keys"] = True
+        # with fact_partitioning set to "day" or "month" the partitioned
+        # tables are written as one file per partition
+        partitionings = {}
+        if run_options["fact_partitioning"] != "none":
+            partitionings = {
+                table_name: (partition_column, run_options["fact_partitioning"])
+                for table_name, partition_column in TABLE_PARTITION_COLUMNS.items()
+            }
+        # with fact_shards set, the sharded tables are built after the others
+        # by that many processes, each writing one part of the table
+        sharded_tables = []
+        if run_options["fact_shards"] > 0:
+            sharded_tables = SHARDED_TABLES
+        jobs = [
+            (
+                s3_client,
+                datetime_string,
+                table_name,
+                partial(builder, **builder_kwargs.get(table_name, {})),
+                [input_dfs[name] for name in input_names],
+                processed_bucket_name,
+                return_parquet_writer_profile(
+                    table_name, run_options["parquet_profile"]
+                ),
+                run_options["streaming_upload"],
+                partitionings.get(table_name),
+                run_options["compact_dtypes"],
+                run_options["warehouse_types"],
+                validator,
+            )
+            for table_name, builder, input_names in transform_tables
+            if table_name not in sharded_tables
+        ]
+        # with validate_references, the dimensions are built first, so that
+        # the facts are checked against the keys of their valid rows
+        stages = [jobs]
+        if validator is not None:
+            stages = [
+                [job for job in jobs if job[2] not in WAREHOUSE_FOREIGN_KEYS],
+                [job for job in jobs if job[2] in WAREHOUSE_FOREIGN_KEYS],
+            ]
+        stage_results = {}
+        for stage_jobs in stages:
+            stage_results.update(
+                zip(
+                    [job[2] for job in stage_jobs],
+                    build_and_populate_tables(
+                        stage_jobs,
+                        run_options["execution_mode"],
+                        run_options["max_workers"],
+                    ),
+                )
+            )
+        for table_name, builder, input_names in transform_tables:
+            if table_name not in sharded_tables:
+                continue
+            df_input = input_dfs[input_names[0]]
+            if key_map is not None:
+                # the shards' processes only look up keys assigned here
+                key_map.assign(df_input["sales_order_id"], df_input["last_updated"])
+            stage_results[table_name] = build_and_populate_table_sharded(
+                s3_client,
+                datetime_string,
+                table_name,
+                partial(builder, **builder_kwargs.get(table_name, {})),
+                df_input,
+                processed_bucket_name,
+                run_options["fact_shards"],
+                return_parquet_writer_profile(
+                    table_name, run_options["parquet_profile"]
+                ),
+                run_options["compact_dtypes"],
+                run_options["warehouse_types"],
+                validator,
+            )
+        results = [stage_results[table_name] for table_name, _, _ in transform_tables]
+        table_responses = {
+            table_name: response
+            for (table_name, _, _), (response, _) in zip(transform_tables, results)
+        }
+        timings = {
+            table_name: table_timings
+            for (table_name, _, _), (_, table_timings) in zip(transform_tables, results)
+        }
+        if chunked:
+            # dim_date also holds the days of the other facts' source tables
+            extra_dates = None
+            if run_options["all_tables"]:
+                other_fact_sources = {}
+                for name in FACT_SOURCE_TABLES:
+                    if name == "sales_order":
+                        continue
+                    if name not in input_dfs:
+                        input_dfs[name] = read_table(
+                            s3_client,
+                            return_s3_key(name, datetime_string),
+                            ingestion_bucket_name,
+                        )
+                    other_fact_sources[name] = input_dfs[name]
+                extra_dates = _return_unique_fact_dates(other_fact_sources)
+            chunked_responses, chunked_timings = build_and_populate_sales_order_chunked(
+                s3_client,
+                datetime_string,
+                ingestion_bucket_name,
+                processed_bucket_name,
+                run_options["chunk_rows"],
+                {
+                    table_name: return_parquet_writer_profile(
+                        table_name, run_options["parquet_profile"]
+                    )
+                    for table_name in SALES_ORDER_CHUNKED_TABLES
+                },
+                run_options["arrow_temporal"],
+                partitioning=partitionings.get("fact_sales_order"),
+                key_map=key_map,
+                warehouse_types=run_options["warehouse_types"],
+                extra_dates=extra_dates,
+                validator=validator,
+                int_date_keys=run_options["int_date_keys"],
+                gbp_rates_version=run_options["gbp_rates_version"],
+                fixed_point_money=run_options["fixed_point_money"],
+            )
+            table_responses.update(chunked_responses)
+            timings.update(chunked_timings)
+        responses = list(table_responses.values())
+        timings.update(reused_timings)
 
         # response logic
         if all([200 == rn["ResponseMetadata"]["HTTPStatusCode"] for rn in responses]):
+            manifest_tables = {
+                table_name: return_manifest_entry(
+                    table_name,
+                    datetime_string,
+                    response,
+                    timings[table_name]["rows"],
+                )
+                for table_name, response in table_responses.items()
+            }
+            for table_name, table_timings in timings.items():
+                if "quarantine_key" in table_timings.get("validation", {}):
+                    manifest_tables[table_name]["quarantine"] = {
+                        "key": table_timings["validation"]["quarantine_key"],
+                        "rows": table_timings["validation"]["quarantined_rows"],
+                    }
+            if "fact_sales_order" in table_responses:
+                fact_entry = manifest_tables["fact_sales_order"]
+                fact_entry["gbp_rates_version"] = run_options["gbp_rates_version"]
+            manifest_tables.update(reused_entries)
+            manifest_tables = {
+                table_name: manifest_tables[table_name]
+                for table_name, _, _ in all_tables
+            }
+            # with snapshot_diff, tables whose inputs have no changes and
+            # which are built as the previous run's were are marked unchanged
+            # in the manifest, for load to skip
+            if run_options["snapshot_diff"]:
+                build_fingerprints = {
+                    table_name: return_table_fingerprint(
+                        table_name,
+                        return_builder_version(builder),
+                        {},
+                        return_output_run_options(table_name, run_options),
+                    )
+                    for table_name, builder, _ in transform_tables
+                }
+                previous_manifest = None
+                if previous_datetime_string is not None:
+                    previous_manifest = read_manifest(
+                        s3_client, processed_bucket_name, previous_datetime_string
+                    )
+                for table_name in return_unchanged_tables(
+                    transform_tables,
+                    change_entries,
+                    previous_manifest,
+                    build_fingerprints,
+                ):
+                    manifest_tables[table_name][
+                        "unchanged_from"
+                    ] = previous_datetime_string
+                for table_name, build_fingerprint in build_fingerprints.items():
+                    manifest_tables[table_name]["build_fingerprint"] = build_fingerprint
+            if key_map is not None and key_map.assigned:
+                key_map.write(s3_client, processed_bucket_name)
+            populate_manifest(
+                s3_client,
+                datetime_string,
+                processed_bucket_name,
+                manifest_tables,
+                previous_datetime_string,
+                change_entries,
+            )
+            for table_name, fingerprint in fingerprints.items():
+                populate_fingerprint_record(
+                    s3_client,
+                    processed_bucket_name,
+                    table_name,
+                    fingerprint,
+                    datetime_string,
+                    manifest_tables[table_name],
+                )
             logger.info("Wrote processed tables to S3 successfully")
             return {
                 "statusCode": 200,
                 "message": "Receipt processed successfully",
                 "datetime_string": datetime_string,
                 "responses_list": responses,
+                "timings": timings,
+                "skipped_tables": list(reused_entries),
+                "input_cache": S3_TABLE_CACHE.stats(),
+                "changes": change_entries,
             }
         else:
             statusCodes = set(
@@ -167,6 +827,10 @@ def lambda_handler(event, context):
                 "message": "Receipt processed successfully",
                 "datetime_string": datetime_string,
                 "responses_list": responses,
+                "timings": timings,
+                "skipped_tables": list(reused_entries),
+                "input_cache": S3_TABLE_CACHE.stats(),
+                "changes": change_entries,
             }
     except Exception as e:
         return str(e)
@@ -0,0 +1,426 @@
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from src.lambda_transform_utils import FACT_DATE_COLUMNS
+from src.lambda_transform_rates import (
+    CURRENT_GBP_RATES_VERSION,
+    return_gross_values,
+    return_gbp_values,
+)
+from src.lambda_transform_money import (
+    FIXED_POINT_MONEY_COLUMNS,
+    return_fixed_point_measures,
+    return_money_decimals,
+)
+
+
+# Arrow-native versions of the _return_df_* builders in lambda_transform_utils.
+# Each builder takes pa.Tables read with read_s3_table_arrow and returns a
+# pa.Table with the same values as the pandas builder, with the key column
+# first (the pandas builders hold it as the dataframe index).
+
+DAY_NAMES = pa.array(
+    ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+)
+MONTH_NAMES = pa.array(
+    [
+        "january",
+        "february",
+        "march",
+        "april",
+        "may",
+        "june",
+        "july",
+        "august",
+        "september",
+        "october",
+        "november",
+        "december",
+    ]
+)
+CURRENCY_NAMES = {
+    "GBP": "Great British Pounds",
+    "USD": "United States Dollars",
+    "EUR": "Euro",
+}
+
+
+def read_s3_table_arrow(s3_client, s3_key, ingestion_bucket_name):
+    """
+    Gets json file from the ingestion table and returns an arrow table
+    """
+    response = s3_client.get_object(Bucket=ingestion_bucket_name, Key=s3_key)
+    json_data = response["Body"].read().decode("utf-8")
+    json_data = json_data.replace("\\", "\\\\")  # as read_s3_table_json
+    return pa.Table.from_pylist(json.loads(json_data))
+
+
+def _return_inner_join(left, right, left_key, right_key):
+    """
+    Inner joins two tables keeping the row order of the left table, as
+    pd.merge does (pyarrow's hash join does not preserve order).
+    """
+    left = left.append_column("_row_order", pa.array(np.arange(len(left))))
+    joined = left.join(
+        right, keys=left_key, right_keys=right_key, join_type="inner"
+    ).sort_by("_row_order")
+    return joined.drop_columns(["_row_order"])
+
+
+def _return_int_date_keys(dates):
+    """
+    Returns int32 yyyymmdd date keys of a date32 or timestamp array, from
+    its year, month and day components
+    """
+    keys = pc.add(
+        pc.add(pc.multiply(pc.year(dates), 10000), pc.multiply(pc.month(dates), 100)),
+        pc.day(dates),
+    )
+    return keys.cast(pa.int32())
+
+
+def _return_table_dim_dates(
+    tbl_totesys_sales_order,
+    tbl_totesys_purchase_order=None,
+    tbl_totesys_payment=None,
+    int_date_keys=False,
+):
+    """
+    Produce unique dates for the dim_date table, from the dates of every
+    fact source table given. With int_date_keys date_id is an int32
+    yyyymmdd key.
+    """
+    fact_source_tables = {
+        "sales_order": tbl_totesys_sales_order,
+        "purchase_order": tbl_totesys_purchase_order,
+        "payment": tbl_totesys_payment,
+    }
+    all_dates = pa.chunked_array(
+        [
+            pc.utf8_slice_codeunits(tbl_source[col], 0, 10)
+            for name, tbl_source in fact_source_tables.items()
+            if tbl_source is not None
+            for col in FACT_DATE_COLUMNS[name]
+        ]
+    )
+    date_strings = pc.unique(all_dates).sort()
+    dates = pc.cast(date_strings, pa.date32())
+    month = pc.month(dates)
+    day_of_week = pc.day_of_week(dates, count_from_zero=False)
+
+    return pa.table(
+        {
+            "date_id": _return_int_date_keys(dates) if int_date_keys else date_strings,
+            "year": pc.year(dates),
+            "month": month,
+            "day": pc.day(dates),
+            "day_of_week": day_of_week,
+            "day_name": DAY_NAMES.take(pc.subtract(day_of_week, 1)),
+            "month_name": MONTH_NAMES.take(pc.subtract(month, 1)),
+            "quarter": pc.add(pc.divide(month, 3), 1),
+        }
+    )
+
+
+def _return_table_dim_design(tbl_totesys_design):
+    """Returns the extrapolated data for the dim_design table"""
+    return tbl_totesys_design.select(
+        ["design_id", "design_name", "file_location", "file_name"]
+    )
+
+
+def _return_table_dim_location(tbl_totesys_address):
+    """Returns the extrapolated data for the dim_location table"""
+    columns = [
+        "address_id",
+        "address_line_1",
+        "address_line_2",
+        "district",
+        "city",
+        "postal_code",
+        "country",
+        "phone",
+    ]
+    return tbl_totesys_address.select(columns).rename_columns(
+        ["location_id"] + columns[1:]
+    )
+
+
+def _return_table_dim_counterparty(tbl_totesys_counterparty, tbl_totesys_address):
+    """Returns the extrapolated data for the dim_counterparty table"""
+    address_columns = {
+        "address_line_1": "counterparty_legal_address_line_1",
+        "address_line_2": "counterparty_legal_address_line_2",
+        "district": "counterparty_legal_district",
+        "city": "counterparty_legal_city",
+        "postal_code": "counterparty_legal_postal_code",
+        "country": "counterparty_legal_country",
+        "phone": "counterparty_legal_phone_number",
+    }
+    tbl_count = tbl_totesys_counterparty.select(
+        ["counterparty_id", "counterparty_legal_name", "legal_address_id"]
+    )
+    tbl_addy = tbl_totesys_address.select(["address_id"] + list(address_columns))
+    tbl_merged = _return_inner_join(
+        tbl_count, tbl_addy, "legal_address_id", "address_id"
+    )
+    return tbl_merged.select(
+        ["counterparty_id", "counterparty_legal_name"] + list(address_columns)
+    ).rename_columns(
+        ["counterparty_id", "counterparty_legal_name"] + list(address_columns.values())
+    )
+
+
+def _return_table_dim_staff(tbl_totesys_staff, tbl_totesys_department):
+    """Returns the extrapolated data for the dim_staff table"""
+    tbl_staff = tbl_totesys_staff.select(
+        ["staff_id", "first_name", "last_name", "department_id", "email_address"]
+    )
+    tbl_department = tbl_totesys_department.select(
+        ["department_id", "department_name", "location"]
+    )
+    tbl_merged = _return_inner_join(
+        tbl_staff, tbl_department, "department_id", "department_id"
+    )
+    return tbl_merged.select(
+        [
+            "staff_id",
+            "first_name",
+            "last_name",
+            "department_name",
+            "location",
+            "email_address",
+        ]
+    )
+
+
+def _return_table_dim_currency(tbl_totesys_currency):
+    """Returns the extrapolated data for the dim_currency table"""
+    currency_codes = tbl_totesys_currency["currency_code"]
+    currency_names = pa.array(list(CURRENCY_NAMES.values())).take(
+        pc.index_in(currency_codes, value_set=pa.array(list(CURRENCY_NAMES)))
+    )
+    return pa.table(
+        {
+            "currency_id": tbl_totesys_currency["currency_id"],
+            "currency_code": currency_codes,
+            "currency_name": currency_names,
+        }
+    )
+
+
+def _return_table_dim_payment_type(tbl_totesys_payment_type):
+    """Returns the extrapolated data for the dim_payment_type table"""
+    return tbl_totesys_payment_type.select(["payment_type_id", "payment_type_name"])
+
+
+def _return_table_dim_transaction(tbl_totesys_transaction):
+    """Returns the extrapolated data for the dim_transaction table"""
+    return tbl_totesys_transaction.select(
+        ["transaction_id", "transaction_type", "sales_order_id", "purchase_order_id"]
+    )
+
+
+def _return_table_dates_and_times(
+    tbl_totesys_table, arrow_temporal=False, int_date_keys=False
+):
+    """
+    Returns the created and last_updated date and time columns of a fact
+    table, split from the timestamps of its source table. With
+    arrow_temporal they are date32/time64 columns, otherwise strings as
+    produced by the pandas builders. With int_date_keys the dates are int32
+    yyyymmdd keys.
+    """
+    columns = {}
+    for source_column, target_column in [
+        ("created_at", "created"),
+        ("last_updated", "last_updated"),
+    ]:
+        timestamp_strings = tbl_totesys_table[source_column]
+        if arrow_temporal or int_date_keys:
+            timestamps = pc.cast(timestamp_strings, pa.timestamp("ms"))
+        if int_date_keys:
+            dates = _return_int_date_keys(timestamps)
+        elif arrow_temporal:
+            dates = pc.cast(timestamps, pa.date32())
+        else:
+            dates = pc.utf8_slice_codeunits(timestamp_strings, 0, 10)
+        if arrow_temporal:
+            times = pc.cast(timestamps, pa.time64("us"))
+        else:
+            times = pc.utf8_slice_codeunits(timestamp_strings, 11, 23)
+        columns[f"{target_column}_date"] = dates
+        columns[f"{target_column}_time"] = times
+    return columns
+
+
+def _convert_date_columns(columns, names, arrow_temporal=False, int_date_keys=False):
+    """
+    Converts the YYYY-MM-DD string date columns of a fact table's columns
+    to int32 yyyymmdd keys with int_date_keys, otherwise to date32 columns
+    with arrow_temporal
+    """
+    for name in names:
+        if int_date_keys:
+            columns[name] = _return_int_date_keys(pc.cast(columns[name], pa.date32()))
+        elif arrow_temporal:
+            columns[name] = pc.cast(columns[name], pa.date32())
+
+
+def _convert_money_columns(columns, table_name):
+    """
+    Replaces the money columns of a fact table's dict of columns by
+    decimal128 columns of their warehouse types, see fixed_point_money
+    """
+    for column in FIXED_POINT_MONEY_COLUMNS[table_name]:
+        columns[column] = return_money_decimals(table_name, column, columns[column])
+
+
+def _return_table_fact_sales_order(
+    tbl_totesys_sales_order,
+    arrow_temporal=False,
+    key_map=None,
+    int_date_keys=False,
+    gbp_rates_version=CURRENT_GBP_RATES_VERSION,
+    fixed_point_money=False,
+):
+    """
+    Returns the data for the fact_sales_order table.
+    With arrow_temporal the date and time columns are date32/time64 columns,
+    otherwise strings as produced by the pandas builder. With a
+    SalesRecordKeyMap the sales_record_id keys are assigned by it. With
+    int_date_keys the date columns are int32 yyyymmdd keys. The gross_value
+    measures are those of the pandas builder, and with fixed_point_money
+    they and unit_price are its decimal128 columns.
+    """
+    if key_map is not None:
+        sales_record_ids = key_map.assign(
+            tbl_totesys_sales_order["sales_order_id"].to_numpy(),
+            tbl_totesys_sales_order["last_updated"].to_numpy(),
+        )
+    else:
+        sales_record_ids = np.arange(1, len(tbl_totesys_sales_order) + 1)
+    columns = {
+        "sales_record_id": pa.array(sales_record_ids, type=pa.int64()),
+        "sales_order_id": tbl_totesys_sales_order["sales_order_id"],
+    }
+    columns.update(
+        _return_table_dates_and_times(
+            tbl_totesys_sales_order, arrow_temporal, int_date_keys
+        )
+    )
+    columns["sales_staff_id"] = tbl_totesys_sales_order["staff_id"]
+    for column in [
+        "counterparty_id",
+        "units_sold",
+        "unit_price",
+        "currency_id",
+        "design_id",
+        "agreed_payment_date",
+        "agreed_delivery_date",
+        "agreed_delivery_location_id",
+    ]:
+        columns[column] = tbl_totesys_sales_order[column]
+    _convert_date_columns(
+        columns,
+        ["agreed_payment_date", "agreed_delivery_date"],
+        arrow_temporal,
+        int_date_keys,
+    )
+    if fixed_point_money:
+        columns.update(
+            return_fixed_point_measures(
+                columns["units_sold"],
+                columns["unit_price"],
+                columns["currency_id"],
+                gbp_rates_version,
+            )
+        )
+        return pa.table(columns)
+    gross_values = return_gross_values(columns["units_sold"], columns["unit_price"])
+    columns["gross_value"] = pa.array(gross_values, from_pandas=True)
+    columns["gross_value_gbp"] = pa.array(
+        return_gbp_values(gross_values, columns["currency_id"], gbp_rates_version),
+        from_pandas=True,
+    )
+
+    return pa.table(columns)
+
+
+def _return_table_fact_purchase_order(
+    tbl_totesys_purchase_order, int_date_keys=False, fixed_point_money=False
+):
+    """
+    Returns the data for the fact_purchase_order table, purchase_record_id
+    counting up from 1. With int_date_keys the date columns are int32
+    yyyymmdd keys. With fixed_point_money item_unit_price is the decimal128
+    column of the pandas builder.
+    """
+    columns = {
+        "purchase_record_id": pa.array(
+            np.arange(1, len(tbl_totesys_purchase_order) + 1), type=pa.int64()
+        ),
+        "purchase_order_id": tbl_totesys_purchase_order["purchase_order_id"],
+    }
+    columns.update(
+        _return_table_dates_and_times(
+            tbl_totesys_purchase_order, int_date_keys=int_date_keys
+        )
+    )
+    for column in [
+        "staff_id",
+        "counterparty_id",
+        "item_code",
+        "item_quantity",
+        "item_unit_price",
+        "currency_id",
+        "agreed_delivery_date",
+        "agreed_payment_date",
+        "agreed_delivery_location_id",
+    ]:
+        columns[column] = tbl_totesys_purchase_order[column]
+    _convert_date_columns(
+        columns,
+        ["agreed_delivery_date", "agreed_payment_date"],
+        int_date_keys=int_date_keys,
+    )
+    if fixed_point_money:
+        _convert_money_columns(columns, "fact_purchase_order")
+
+    return pa.table(columns)
+
+
+def _return_table_fact_payment(
+    tbl_totesys_payment, int_date_keys=False, fixed_point_money=False
+):
+    """
+    Returns the data for the fact_payment table, payment_record_id counting
+    up from 1. With int_date_keys the date columns are int32 yyyymmdd keys.
+    With fixed_point_money payment_amount is the decimal128 column of the
+    pandas builder.
+    """
+    columns = {
+        "payment_record_id": pa.array(
+            np.arange(1, len(tbl_totesys_payment) + 1), type=pa.int64()
+        ),
+        "payment_id": tbl_totesys_payment["payment_id"],
+    }
+    columns.update(
+        _return_table_dates_and_times(tbl_totesys_payment, int_date_keys=int_date_keys)
+    )
+    for column in [
+        "transaction_id",
+        "counterparty_id",
+        "payment_amount",
+        "currency_id",
+        "payment_type_id",
+        "paid",
+        "payment_date",
+    ]:
+        columns[column] = tbl_totesys_payment[column]
+    _convert_date_columns(columns, ["payment_date"], int_date_keys=int_date_keys)
+    if fixed_point_money:
+        _convert_money_columns(columns, "fact_payment")
+
+    return pa.table(columns)
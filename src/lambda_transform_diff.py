@@ -0,0 +1,114 @@
+import io
+import numpy as np
+import pandas as pd
+from src.utils import return_change_s3_key, parse_datetime_string
+from src.lambda_transform_state import keep_latest_versions
+
+
+# Snapshot diff engine: compares two full snapshots of a source table and
+# returns the rows inserted, updated and deleted between them. Keys of both
+# snapshots are coded into one integer space; the old keys are sorted once
+# and each new key found by binary search (np.searchsorted). Matched rows
+# are compared by a uint64 hash of each row (pd.util.hash_pandas_object)
+# rather than column by column, so the cost is one sort plus a hash pass
+# over each snapshot.
+
+CHANGE_KINDS = ["inserted", "updated", "deleted"]
+
+
+def _return_joint_key_codes(df_old, df_new, key_columns):
+    """
+    Returns int64 codes for the keys of two snapshots in a shared code space,
+    equal keys having equal codes
+    """
+    codes = np.zeros(len(df_old) + len(df_new), dtype="int64")
+    for name in key_columns:
+        values = np.concatenate([df_old[name].to_numpy(), df_new[name].to_numpy()])
+        column_codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        # refactorised each column so the combined codes stay below 2 * rows
+        codes, _ = pd.factorize(codes * len(uniques) + column_codes)
+    return codes[: len(df_old)], codes[len(df_old) :]
+
+
+def return_row_hashes(df, columns):
+    """Returns a uint64 hash of each row's values in columns"""
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+
+def diff_snapshots(df_old, df_new, key_columns):
+    """
+    Returns {"inserted", "updated", "deleted"} dataframes for two snapshots
+    of a source table: the new rows whose key is not in the old snapshot,
+    the new rows whose key is but whose values differ, and the old rows
+    whose key is not in the new snapshot. Values are compared on the
+    columns the snapshots share. Each snapshot is first reduced to the
+    latest version of each key.
+    """
+    empty = df_new.iloc[:0] if not df_new.empty else df_old.iloc[:0]
+    if df_old.empty or df_new.empty:
+        return {
+            "inserted": df_new.reset_index(drop=True),
+            "updated": empty,
+            "deleted": df_old.reset_index(drop=True),
+        }
+    df_old = keep_latest_versions(df_old, key_columns)
+    df_new = keep_latest_versions(df_new, key_columns)
+    old_codes, new_codes = _return_joint_key_codes(df_old, df_new, key_columns)
+
+    # match each new key against the sorted old keys
+    old_order = np.argsort(old_codes, kind="stable")
+    sorted_old_codes = old_codes[old_order]
+    positions = np.minimum(
+        np.searchsorted(sorted_old_codes, new_codes), len(sorted_old_codes) - 1
+    )
+    matched = sorted_old_codes[positions] == new_codes
+    old_rows = old_order[positions[matched]]
+
+    columns = [name for name in df_new.columns if name in df_old.columns]
+    old_hashes = return_row_hashes(df_old, columns)
+    new_hashes = return_row_hashes(df_new, columns)
+    updated = np.zeros(len(df_new), dtype=bool)
+    updated[matched] = old_hashes[old_rows] != new_hashes[matched]
+    deleted = np.ones(len(df_old), dtype=bool)
+    deleted[old_rows] = False
+
+    return {
+        "inserted": df_new[~matched].reset_index(drop=True),
+        "updated": df_new[updated].reset_index(drop=True),
+        "deleted": df_old[deleted].reset_index(drop=True),
+    }
+
+
+def return_previous_datetime_string(s3_client, bucket_name, datetime_string):
+    """
+    Returns the datetime string of the latest snapshot in the bucket before
+    datetime_string, None if there is none
+    """
+    current = parse_datetime_string(datetime_string)
+    if current is None:
+        return None
+    previous = None
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix="data/", Delimiter="/"):
+        for common_prefix in page.get("CommonPrefixes", []):
+            candidate = common_prefix["Prefix"][len("data/") : -1]
+            parsed = parse_datetime_string(candidate)
+            if parsed is not None and parsed < current:
+                if previous is None or parsed > previous[0]:
+                    previous = (parsed, candidate)
+    return previous[1] if previous is not None else None
+
+
+def populate_change_sets(s3_client, datetime_string, bucket_name, table_name, changes):
+    """
+    Writes the change sets of a table diff as parquet files in the processed
+    bucket, returning their manifest entry: the key and rows of each
+    """
+    entry = {}
+    for change_kind in CHANGE_KINDS:
+        key = return_change_s3_key(table_name, datetime_string, change_kind)
+        buffer = io.BytesIO()
+        changes[change_kind].to_parquet(buffer, index=False, compression="zstd")
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=buffer.getvalue())
+        entry[change_kind] = {"key": key, "rows": len(changes[change_kind])}
+    return entry
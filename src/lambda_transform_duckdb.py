@@ -0,0 +1,343 @@
+import os
+import tempfile
+import numpy as np
+import pyarrow as pa
+from src.lambda_transform_utils import FACT_DATE_COLUMNS
+from src.lambda_transform_rates import GBP_RATE_VERSIONS, CURRENT_GBP_RATES_VERSION
+from src.lambda_transform_money import (
+    FIXED_POINT_MONEY_COLUMNS,
+    return_fixed_point_measures,
+    return_money_decimals,
+)
+from src.warehouse_schema import WAREHOUSE_DATE_KEY_COLUMNS
+
+
+# DuckDB transform engine: each warehouse table is a SQL statement over the
+# ingestion tables, run in-process by DuckDB's multi-threaded vectorised
+# engine. duckdb is imported lazily so the other engines work without it.
+#
+# Every input table is registered under its ingestion table name with an
+# extra _row_order column, so that joins can return rows in the order of
+# their left table like pd.merge does, and sales_order with the
+# _sales_record_id keys of its rows. DuckDB's json reader may detect date
+# columns as DATE, so text slicing casts to VARCHAR first. dim_date reads
+# a fact_dates view of the date columns of every fact source table it is
+# built from, see _return_fact_dates_query. With int_date_keys a table's
+# query is wrapped to replace its date keys by yyyymmdd integers, see
+# _return_int_date_keys_query. fact_sales_order joins a gbp_rates table of
+# the GBP rates of its gbp_rates_version, and rounds its measures to pence
+# as lambda_transform_rates does. With fixed_point_money the money columns
+# of the fact tables are replaced after the query by the decimals of
+# lambda_transform_money.
+
+DUCKDB_TABLE_QUERIES = {
+    "dim_date": """
+        WITH all_dates AS (
+            SELECT DISTINCT CAST(left(date_value, 10) AS DATE) AS d
+            FROM fact_dates
+        )
+        SELECT
+            strftime(d, '%Y-%m-%d') AS date_id,
+            year(d) AS year,
+            month(d) AS month,
+            day(d) AS day,
+            isodow(d) AS day_of_week,
+            lower(dayname(d)) AS day_name,
+            lower(monthname(d)) AS month_name,
+            month(d) // 3 + 1 AS quarter
+        FROM all_dates
+        ORDER BY d
+    """,
+    "dim_design": """
+        SELECT design_id, design_name, file_location, file_name
+        FROM design
+        ORDER BY _row_order
+    """,
+    "dim_location": """
+        SELECT
+            address_id AS location_id,
+            address_line_1,
+            address_line_2,
+            district,
+            city,
+            postal_code,
+            country,
+            phone
+        FROM address
+        ORDER BY _row_order
+    """,
+    "dim_counterparty": """
+        SELECT
+            c.counterparty_id,
+            c.counterparty_legal_name,
+            a.address_line_1 AS counterparty_legal_address_line_1,
+            a.address_line_2 AS counterparty_legal_address_line_2,
+            a.district AS counterparty_legal_district,
+            a.city AS counterparty_legal_city,
+            a.postal_code AS counterparty_legal_postal_code,
+            a.country AS counterparty_legal_country,
+            a.phone AS counterparty_legal_phone_number
+        FROM counterparty c
+        JOIN address a ON c.legal_address_id = a.address_id
+        ORDER BY c._row_order, a._row_order
+    """,
+    "dim_staff": """
+        SELECT
+            s.staff_id,
+            s.first_name,
+            s.last_name,
+            d.department_name,
+            d.location,
+            s.email_address
+        FROM staff s
+        JOIN department d ON s.department_id = d.department_id
+        ORDER BY s._row_order, d._row_order
+    """,
+    "dim_currency": """
+        SELECT
+            currency_id,
+            currency_code,
+            CASE currency_code
+                WHEN 'GBP' THEN 'Great British Pounds'
+                WHEN 'USD' THEN 'United States Dollars'
+                WHEN 'EUR' THEN 'Euro'
+            END AS currency_name
+        FROM currency
+        ORDER BY _row_order
+    """,
+    "fact_sales_order": """
+        SELECT
+            _sales_record_id AS sales_record_id,
+            sales_order_id,
+            left(CAST(created_at AS VARCHAR), 10) AS created_date,
+            substr(CAST(created_at AS VARCHAR), 12, 12) AS created_time,
+            left(CAST(last_updated AS VARCHAR), 10) AS last_updated_date,
+            substr(CAST(last_updated AS VARCHAR), 12, 12) AS last_updated_time,
+            staff_id AS sales_staff_id,
+            counterparty_id,
+            units_sold,
+            unit_price,
+            currency_id,
+            design_id,
+            CAST(agreed_payment_date AS VARCHAR) AS agreed_payment_date,
+            CAST(agreed_delivery_date AS VARCHAR) AS agreed_delivery_date,
+            agreed_delivery_location_id,
+            floor(units_sold * unit_price * 100 + 0.5) / 100 AS gross_value,
+            floor(
+                floor(units_sold * unit_price * 100 + 0.5) / 100 * gbp_rate * 100
+                + 0.5
+            ) / 100 AS gross_value_gbp
+        FROM sales_order
+        LEFT JOIN gbp_rates ON currency_id = rate_currency_id
+        ORDER BY _row_order
+    """,
+    "dim_payment_type": """
+        SELECT payment_type_id, payment_type_name
+        FROM payment_type
+        ORDER BY _row_order
+    """,
+    "dim_transaction": """
+        SELECT transaction_id, transaction_type, sales_order_id, purchase_order_id
+        FROM transaction
+        ORDER BY _row_order
+    """,
+    "fact_purchase_order": """
+        SELECT
+            _row_order + 1 AS purchase_record_id,
+            purchase_order_id,
+            left(CAST(created_at AS VARCHAR), 10) AS created_date,
+            substr(CAST(created_at AS VARCHAR), 12, 12) AS created_time,
+            left(CAST(last_updated AS VARCHAR), 10) AS last_updated_date,
+            substr(CAST(last_updated AS VARCHAR), 12, 12) AS last_updated_time,
+            staff_id,
+            counterparty_id,
+            item_code,
+            item_quantity,
+            item_unit_price,
+            currency_id,
+            CAST(agreed_delivery_date AS VARCHAR) AS agreed_delivery_date,
+            CAST(agreed_payment_date AS VARCHAR) AS agreed_payment_date,
+            agreed_delivery_location_id
+        FROM purchase_order
+        ORDER BY _row_order
+    """,
+    "fact_payment": """
+        SELECT
+            _row_order + 1 AS payment_record_id,
+            payment_id,
+            left(CAST(created_at AS VARCHAR), 10) AS created_date,
+            substr(CAST(created_at AS VARCHAR), 12, 12) AS created_time,
+            left(CAST(last_updated AS VARCHAR), 10) AS last_updated_date,
+            substr(CAST(last_updated AS VARCHAR), 12, 12) AS last_updated_time,
+            transaction_id,
+            counterparty_id,
+            payment_amount,
+            currency_id,
+            payment_type_id,
+            paid,
+            CAST(payment_date AS VARCHAR) AS payment_date
+        FROM payment
+        ORDER BY _row_order
+    """,
+    # fact_sales_order with native DATE/TIME columns, see arrow_temporal
+    "fact_sales_order_temporal": """
+        SELECT
+            _sales_record_id AS sales_record_id,
+            sales_order_id,
+            CAST(CAST(created_at AS TIMESTAMP) AS DATE) AS created_date,
+            CAST(CAST(created_at AS TIMESTAMP) AS TIME) AS created_time,
+            CAST(CAST(last_updated AS TIMESTAMP) AS DATE) AS last_updated_date,
+            CAST(CAST(last_updated AS TIMESTAMP) AS TIME) AS last_updated_time,
+            staff_id AS sales_staff_id,
+            counterparty_id,
+            units_sold,
+            unit_price,
+            currency_id,
+            design_id,
+            CAST(agreed_payment_date AS DATE) AS agreed_payment_date,
+            CAST(agreed_delivery_date AS DATE) AS agreed_delivery_date,
+            agreed_delivery_location_id,
+            floor(units_sold * unit_price * 100 + 0.5) / 100 AS gross_value,
+            floor(
+                floor(units_sold * unit_price * 100 + 0.5) / 100 * gbp_rate * 100
+                + 0.5
+            ) / 100 AS gross_value_gbp
+        FROM sales_order
+        LEFT JOIN gbp_rates ON currency_id = rate_currency_id
+        ORDER BY _row_order
+    """,
+}
+
+
+def _import_duckdb():
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError(
+            "the duckdb transform engine needs the duckdb package installed"
+        ) from e
+    return duckdb
+
+
+def read_s3_table_duckdb(s3_client, s3_key, ingestion_bucket_name):
+    """
+    Gets json file from the ingestion table and parses it with DuckDB's
+    json reader, returning an arrow table
+    """
+    duckdb = _import_duckdb()
+    response = s3_client.get_object(Bucket=ingestion_bucket_name, Key=s3_key)
+    json_data = response["Body"].read().decode("utf-8")
+    json_data = json_data.replace("\\", "\\\\")  # as read_s3_table_json
+    file_descriptor, json_path = tempfile.mkstemp(suffix=".json")
+    try:
+        with os.fdopen(file_descriptor, "w", encoding="utf-8") as f:
+            f.write(json_data)
+        with duckdb.connect() as con:
+            return con.read_json(json_path, format="array").to_arrow_table()
+    finally:
+        os.remove(json_path)
+
+
+def _return_fact_dates_query(input_names):
+    """
+    Returns a query of every date and timestamp, as text, of the fact
+    source tables among input_names
+    """
+    return " UNION ALL ".join(
+        f"SELECT CAST({column} AS VARCHAR) AS date_value FROM {name}"
+        for name in input_names
+        if name in FACT_DATE_COLUMNS
+        for column in FACT_DATE_COLUMNS[name]
+    )
+
+
+def _return_int_date_keys_query(query, date_key_columns):
+    """
+    Returns a query of the rows of query with its date_key_columns (DATE or
+    YYYY-MM-DD text) replaced by int32 yyyymmdd keys
+    """
+    replacements = ", ".join(
+        f"CAST(year(CAST({column} AS DATE)) * 10000"
+        f" + month(CAST({column} AS DATE)) * 100"
+        f" + day(CAST({column} AS DATE)) AS INTEGER) AS {column}"
+        for column in date_key_columns
+    )
+    return f"SELECT * REPLACE ({replacements}) FROM ({query})"
+
+
+def return_duckdb_builder(table_name, input_names):
+    """
+    Returns a builder for table_name that takes the arrow tables for
+    input_names (as returned by read_s3_table_duckdb) and runs the table's
+    SQL statement over them, returning an arrow table
+    """
+
+    def builder(
+        *input_tables,
+        arrow_temporal=False,
+        key_map=None,
+        int_date_keys=False,
+        gbp_rates_version=CURRENT_GBP_RATES_VERSION,
+        fixed_point_money=False,
+    ):
+        duckdb = _import_duckdb()
+        query_name = f"{table_name}_temporal" if arrow_temporal else table_name
+        query = DUCKDB_TABLE_QUERIES[query_name]
+        if int_date_keys:
+            query = _return_int_date_keys_query(
+                query, WAREHOUSE_DATE_KEY_COLUMNS[table_name]
+            )
+        with duckdb.connect() as con:
+            for name, table in zip(input_names, input_tables):
+                row_order = np.arange(len(table), dtype="int64")
+                table = table.append_column("_row_order", pa.array(row_order))
+                if name == "sales_order":
+                    sales_record_ids = row_order + 1
+                    if key_map is not None and table_name == "fact_sales_order":
+                        sales_record_ids = key_map.assign(
+                            table["sales_order_id"].to_numpy(),
+                            table["last_updated"].to_numpy(),
+                        )
+                    table = table.append_column(
+                        "_sales_record_id", pa.array(sales_record_ids, pa.int64())
+                    )
+                con.register(name, table)
+            if table_name == "fact_sales_order":
+                rates = GBP_RATE_VERSIONS[gbp_rates_version]
+                con.register(
+                    "gbp_rates",
+                    pa.table(
+                        {
+                            "rate_currency_id": pa.array(list(rates), pa.int64()),
+                            "gbp_rate": pa.array(list(rates.values()), pa.float64()),
+                        }
+                    ),
+                )
+            if table_name == "dim_date":
+                con.execute(
+                    f"CREATE VIEW fact_dates AS {_return_fact_dates_query(input_names)}"
+                )
+            tbl_result = con.sql(query).to_arrow_table()
+        if fixed_point_money:
+            if table_name == "fact_sales_order":
+                measures = return_fixed_point_measures(
+                    tbl_result["units_sold"],
+                    tbl_result["unit_price"],
+                    tbl_result["currency_id"],
+                    gbp_rates_version,
+                )
+            else:
+                measures = {
+                    column: return_money_decimals(
+                        table_name, column, tbl_result[column]
+                    )
+                    for column in FIXED_POINT_MONEY_COLUMNS[table_name]
+                }
+            for column, values in measures.items():
+                tbl_result = tbl_result.set_column(
+                    tbl_result.schema.get_field_index(column), column, values
+                )
+        return tbl_result
+
+    builder.__name__ = f"_return_duckdb_{table_name}"
+    return builder
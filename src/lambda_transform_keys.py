@@ -0,0 +1,98 @@
+import io
+import numpy as np
+import pandas as pd
+from botocore.exceptions import ClientError
+
+
+# Stable sales_record_id keys for fact_sales_order. Each version of a sales
+# order, identified by its (sales_order_id, last_updated) natural key, keeps
+# the sales_record_id it was first given, whatever the row order of later
+# snapshots; new versions get the next unused keys.
+#
+# Keys are handed out sequentially from 1, so the map is stored as just the
+# two natural key arrays in key order: sales_record_id is position + 1.
+
+SALES_RECORD_KEY_MAP_S3_KEY = "keys/fact_sales_order.npz"
+
+
+def _return_milliseconds(last_updated):
+    """Converts ISO timestamp strings to int64 milliseconds since the epoch"""
+    timestamps = pd.to_datetime(pd.Series(last_updated), format="ISO8601")
+    return timestamps.to_numpy("datetime64[ms]").view("int64")
+
+
+class SalesRecordKeyMap:
+    """
+    Persistent mapping from (sales_order_id, last_updated) to sales_record_id,
+    read from and written back to the processed bucket
+    """
+
+    def __init__(self, sales_order_ids=None, last_updated_ms=None):
+        self.sales_order_ids = np.asarray(
+            [] if sales_order_ids is None else sales_order_ids, dtype="int64"
+        )
+        self.last_updated_ms = np.asarray(
+            [] if last_updated_ms is None else last_updated_ms, dtype="int64"
+        )
+        self.assigned = 0  # keys handed out since the map was read
+        self._index = None
+
+    def __len__(self):
+        return len(self.sales_order_ids)
+
+    @classmethod
+    def read(cls, s3_client, bucket_name, s3_key=SALES_RECORD_KEY_MAP_S3_KEY):
+        """Returns the stored key map, an empty one if none is stored yet"""
+        try:
+            response = s3_client.get_object(Bucket=bucket_name, Key=s3_key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return cls()
+            raise
+        with np.load(io.BytesIO(response["Body"].read())) as arrays:
+            return cls(arrays["sales_order_id"], arrays["last_updated_ms"])
+
+    def write(self, s3_client, bucket_name, s3_key=SALES_RECORD_KEY_MAP_S3_KEY):
+        """Stores the key map as a compressed npz of its natural key arrays"""
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            sales_order_id=self.sales_order_ids,
+            last_updated_ms=self.last_updated_ms,
+        )
+        return s3_client.put_object(
+            Bucket=bucket_name, Key=s3_key, Body=buffer.getvalue()
+        )
+
+    def assign(self, sales_order_ids, last_updated):
+        """
+        Returns the sales_record_id of each (sales_order_id, last_updated)
+        pair. Pairs not seen before are given the next unused keys, in order
+        of first appearance, and added to the map.
+        """
+        ids = np.asarray(sales_order_ids, dtype="int64")
+        updated_ms = _return_milliseconds(last_updated)
+        natural_keys = pd.MultiIndex.from_arrays([ids, updated_ms])
+        positions = self._return_index().get_indexer(natural_keys)
+
+        new = positions == -1
+        if new.any():
+            new_keys = natural_keys[new].unique()
+            positions[new] = len(self) + new_keys.get_indexer(natural_keys[new])
+            self.sales_order_ids = np.concatenate(
+                [self.sales_order_ids, new_keys.get_level_values(0)]
+            )
+            self.last_updated_ms = np.concatenate(
+                [self.last_updated_ms, new_keys.get_level_values(1)]
+            )
+            self.assigned += len(new_keys)
+            self._index = None
+
+        return positions + 1
+
+    def _return_index(self):
+        if self._index is None:
+            self._index = pd.MultiIndex.from_arrays(
+                [self.sales_order_ids, self.last_updated_ms]
+            )
+        return self._index
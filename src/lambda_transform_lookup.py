@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+# Hash indexes of the dimension primary keys, for looking up fact foreign
+# keys in bulk. A DimensionLookup is built once per dimension per run, a
+# pd.Index over a contiguous array of the keys whose hash table is made on
+# the first lookup and kept, so each later lookup, of any fact column or
+# batch, costs one vectorised get_indexer pass over the fact values rather
+# than a new hash of the dimension's keys.
+#
+# Keys are compared in one form whichever engine built the tables:
+# dictionaries decoded, dates as ISO strings and integers as int64.
+
+
+def _return_key_values(column):
+    """
+    Returns key values in a form comparable whichever way the table was
+    built: dictionaries decoded, dates as ISO strings, integers as int64
+    """
+    if pa.types.is_dictionary(column.type):
+        column = column.cast(column.type.value_type)
+    if pa.types.is_date(column.type):
+        return column.cast(pa.string())
+    if pa.types.is_integer(column.type) or pa.types.is_floating(column.type):
+        return column.cast(pa.int64())
+    return column
+
+
+def _return_key_array(values):
+    """Returns keys (arrow, pandas or numpy) as a numpy array of key values"""
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    elif not isinstance(values, pa.Array):
+        values = pa.array(values, from_pandas=True)
+    return _return_key_values(values).to_numpy(zero_copy_only=False)
+
+
+class DimensionLookup:
+    """
+    Hash index from the primary keys of a dimension to its row positions,
+    serving bulk lookups of foreign key values
+    """
+
+    def __init__(self, table_name, keys):
+        self.table_name = table_name
+        index = pd.Index(_return_key_array(keys))
+        # a repeated key resolves to its first row
+        self.rows = None
+        if not index.is_unique:
+            first = ~index.duplicated(keep="first")
+            self.rows = np.flatnonzero(first)
+            index = index[first]
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def keys(self):
+        """The distinct keys of the dimension, in row order"""
+        return self.index.to_numpy()
+
+    def positions(self, values):
+        """
+        Returns the dimension row position of each value as int64, -1 for
+        values not in the dimension and nulls
+        """
+        positions = self.index.get_indexer(_return_key_array(values))
+        if self.rows is not None:
+            found = positions != -1
+            positions[found] = self.rows[positions[found]]
+        return positions.astype("int64", copy=False)
+
+    def contains(self, values):
+        """Returns a boolean array of the values found in the dimension"""
+        return self.index.get_indexer(_return_key_array(values)) != -1
@@ -0,0 +1,124 @@
+import decimal
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from src.lambda_transform_rates import CURRENT_GBP_RATES_VERSION, return_row_gbp_rates
+from src.warehouse_schema import WAREHOUSE_ARROW_SCHEMAS
+
+
+# Fixed-point money for the NUMERIC columns of the fact tables, with the
+# fixed_point_money run option. Prices and amounts arrive in the ingestion
+# JSON as numbers with at most two decimal places and are turned into int64
+# pence by one vectorised rint, which recovers each value exactly. The
+# measures of fact_sales_order are then integer arithmetic on pence, and the
+# columns are written as arrow decimal128 arrays built straight from the
+# pence: a decimal128 of scale 2 is the value in pence as a 128-bit
+# little-endian two's complement integer, so the buffer is the pence and
+# their sign extension side by side, with no per-row Decimal objects.
+#
+# Building the buffers skips the checks of a cast, so pence too wide for a
+# column's NUMERIC precision are kept as they are, and ReferenceValidator
+# quarantines their rows (see return_too_wide_mask) before postgres would
+# reject them on load. Load copies the decimals as they are.
+
+# the NUMERIC money columns of each fact table, decimals with
+# fixed_point_money
+FIXED_POINT_MONEY_COLUMNS = {
+    "fact_sales_order": ["unit_price", "gross_value", "gross_value_gbp"],
+    "fact_purchase_order": ["item_unit_price"],
+    "fact_payment": ["payment_amount"],
+}
+
+
+def return_pence(values):
+    """
+    Returns money values (float64 or anything numpy reads as numbers) as
+    int64 pence, and a boolean mask of the missing values
+    """
+    values = np.asarray(values, dtype="float64")
+    missing = np.isnan(values)
+    return np.rint(np.where(missing, 0.0, values) * 100).astype("int64"), missing
+
+
+def return_decimal_array(pence, missing, arrow_type):
+    """
+    Returns a decimal128 array of scale 2 holding int64 pence, built from
+    their buffers, with nulls where missing. Pence wider than the type's
+    precision are not checked, see return_too_wide_mask
+    """
+    words = np.empty((len(pence), 2), dtype="int64")
+    words[:, 0] = pence
+    words[:, 1] = pence >> 63  # 0 or -1, extending the sign to 128 bits
+    validity, null_count = None, 0
+    if missing.any():
+        validity = pa.array(~missing).buffers()[1]
+        null_count = int(missing.sum())
+    return pa.Array.from_buffers(
+        arrow_type,
+        len(pence),
+        [validity, pa.py_buffer(words)],
+        null_count=null_count,
+    )
+
+
+def return_too_wide_mask(values, arrow_type):
+    """
+    Returns a boolean numpy mask of the values of an arrow array (decimals,
+    or numbers to be cast to them) with more integer digits than the
+    decimal128 arrow_type has room for. Nulls fit.
+    """
+    if arrow_type.precision >= 38:  # the widest decimal128, any int64 pence fit
+        return np.zeros(len(values), dtype=bool)
+    limit = decimal.Decimal(10) ** (arrow_type.precision - arrow_type.scale)
+    if pa.types.is_decimal(values.type):
+        values = values.cast(pa.decimal128(38, arrow_type.scale))
+        too_wide = pc.greater_equal(pc.abs(values), pa.scalar(limit, values.type))
+    else:
+        # numbers are rounded to the scale as a cast to the decimal would
+        values = pc.round(pc.abs(values.cast(pa.float64())), arrow_type.scale)
+        too_wide = pc.greater_equal(values, float(limit))
+    return too_wide.fill_null(False).to_numpy(zero_copy_only=False)
+
+
+def return_money_decimals(table_name, column_name, values):
+    """
+    Returns a money column of a fact table (float64 or anything numpy reads
+    as numbers) as a decimal128 array of its warehouse type, through pence
+    """
+    pence, missing = return_pence(values)
+    return return_decimal_array(
+        pence,
+        missing,
+        WAREHOUSE_ARROW_SCHEMAS[table_name].field(column_name).type,
+    )
+
+
+def return_fixed_point_measures(
+    units_sold, unit_prices, currency_ids, gbp_rates_version=CURRENT_GBP_RATES_VERSION
+):
+    """
+    Returns fact_sales_order's unit_price, gross_value and gross_value_gbp
+    as decimal128 arrays of their warehouse types, worked out in pence:
+    gross_value exactly, gross_value_gbp rounded half up to the penny
+    """
+    schema = WAREHOUSE_ARROW_SCHEMAS["fact_sales_order"]
+    price_pence, price_missing = return_pence(unit_prices)
+    units = np.asarray(units_sold, dtype="float64")
+    gross_missing = price_missing | np.isnan(units)
+    gross_pence = np.where(gross_missing, 0, units).astype("int64") * price_pence
+    gbp_pence = np.floor(
+        gross_pence * return_row_gbp_rates(currency_ids, gbp_rates_version) + 0.5
+    )
+    gbp_missing = gross_missing | np.isnan(gbp_pence)
+    gbp_pence = np.where(gbp_missing, 0.0, gbp_pence).astype("int64")
+    return {
+        "unit_price": return_decimal_array(
+            price_pence, price_missing, schema.field("unit_price").type
+        ),
+        "gross_value": return_decimal_array(
+            gross_pence, gross_missing, schema.field("gross_value").type
+        ),
+        "gross_value_gbp": return_decimal_array(
+            gbp_pence, gbp_missing, schema.field("gross_value_gbp").type
+        ),
+    }
@@ -0,0 +1,63 @@
+import numpy as np
+
+
+# Versioned reference of the rates converting each ToteSys currency to GBP,
+# for the gross_value_gbp measure of fact_sales_order. Rates are keyed by
+# currency_id, as the facts hold it. A change of rates is a new version
+# rather than an edit, so outputs can be rebuilt as they were: a run
+# converts with the gbp_rates_version run option, which is part of
+# fact_sales_order's fingerprint and recorded in its manifest entry.
+#
+# Measures are rounded half up to whole pence as floor(value * 100 + 0.5)
+# / 100, the same float operations in every engine (numpy and DuckDB's
+# round differ on halves), so the engines' outputs are equal.
+
+GBP_RATE_VERSIONS = {
+    # GBP, USD and EUR closing rates on 2022-11-03
+    "2022-11-03": {1: 1.0, 2: 0.896, 3: 0.8795},
+}
+
+CURRENT_GBP_RATES_VERSION = "2022-11-03"
+
+
+def return_gbp_rates(version=CURRENT_GBP_RATES_VERSION):
+    """
+    Returns the GBP rates of a version as a float64 array indexed by
+    currency_id, NaN for ids without a rate
+    """
+    rates = GBP_RATE_VERSIONS[version]
+    lookup = np.full(max(rates) + 1, np.nan)
+    lookup[list(rates)] = list(rates.values())
+    return lookup
+
+
+def round_to_pence(values):
+    """Rounds float64 values half up to two decimal places"""
+    return np.floor(values * 100 + 0.5) / 100
+
+
+def return_gross_values(units_sold, unit_prices):
+    """Returns units_sold * unit_price of each row, rounded to the penny"""
+    return round_to_pence(
+        np.asarray(units_sold, dtype="float64")
+        * np.asarray(unit_prices, dtype="float64")
+    )
+
+
+def return_row_gbp_rates(currency_ids, version=CURRENT_GBP_RATES_VERSION):
+    """
+    Returns the GBP rate of each row's currency_id, with one positional
+    lookup per row; NaN for currencies without a rate
+    """
+    lookup = return_gbp_rates(version)
+    ids = np.asarray(currency_ids, dtype="float64")
+    known = (ids >= 0) & (ids < len(lookup))  # False for NaN ids too
+    rates = np.full(len(ids), np.nan)
+    rates[known] = lookup[ids[known].astype("int64")]
+    return rates
+
+
+def return_gbp_values(values, currency_ids, version=CURRENT_GBP_RATES_VERSION):
+    """Returns values converted to GBP at the rate of their currency_id"""
+    rates = return_row_gbp_rates(currency_ids, version)
+    return round_to_pence(np.asarray(values, dtype="float64") * rates)
@@ -0,0 +1,284 @@
+import os
+import time
+import tempfile
+import multiprocessing
+from collections import deque
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+from src.utils import return_part_s3_key, return_quarantine_s3_key
+from src.lambda_transform_utils import (
+    compact_dtypes,
+    copy_on_write,
+    populate_parquet_file,
+    return_arrow_table_and_write_options,
+)
+from src.lambda_transform_validation import QUARANTINE_REASON_COLUMN
+from src.warehouse_schema import WAREHOUSE_COLUMN_TYPES, cast_to_warehouse_schema
+
+
+# Sharded builds of fact_sales_order across cores, with the fact_shards run
+# option. The pandas builder holds the GIL, so threads cannot spread it over
+# the vCPUs of a larger Lambda; processes can. sales_order is split into
+# ranges of sales_order_id, so that every version of an order is built by
+# the same shard, and each range is built, validated, cast and encoded by a
+# forked process into one parquet part, uploaded by the parent. Rows keep
+# the sales_record_id of their position in sales_order, as in a single
+# build. No more processes run at a time than there are CPUs.
+#
+# Shards reach the processes as Arrow IPC files in a temporary directory,
+# memory-mapped by each process rather than pickled through a pipe: Lambda
+# has no /dev/shm, so multiprocessing's Pool and Queue are unavailable and
+# /tmp stands in for shared memory. Processes are forked, so they share the
+# parent's builder, key map and validator as they were at the fork; stable
+# keys are assigned for the whole table before forking, which leaves each
+# process only looking them up. The pipe of each process carries back its
+# timings, or its error. Each process validates its own shard only, so the
+# parent checks the primary keys of every part against those of the parts
+# before it and quarantines repeats.
+
+SHARDED_TABLES = ["fact_sales_order"]
+
+
+def _write_ipc_file(table, path):
+    """Writes an arrow table to an Arrow IPC file"""
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def _read_ipc_file(path):
+    """Returns the arrow table of an Arrow IPC file, memory-mapped"""
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def _return_key_range_bounds(keys, shards):
+    """
+    Returns the order of the rows of a key column sorted by key, and the
+    bounds in it of at most shards ranges of about equal rows, moved to
+    where the key changes so that no key is split across two ranges
+    """
+    keys = np.asarray(keys)
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    bounds = np.linspace(0, len(keys), shards + 1).astype("int64")[1:-1]
+    bounds = np.unique(np.searchsorted(sorted_keys, sorted_keys[bounds]))
+    return order, np.concatenate([[0], bounds[bounds > 0], [len(keys)]])
+
+
+def _quarantine_repeated_keys(table_name, part_path, writer_profile, validator):
+    """
+    Checks the primary keys of a shard's part against those of the parts
+    before it, recorded by validator. Rows repeating a key are taken out of
+    the part, which is rewritten, and returned with their quarantine reason,
+    None if there are none. Returns the rows left in the part too.
+    """
+    primary_key = next(iter(WAREHOUSE_COLUMN_TYPES[table_name]))
+    keys = pq.read_table(part_path, columns=[primary_key])[primary_key]
+    repeated = np.zeros(len(keys), dtype=bool)
+    if table_name in validator.primary_keys:
+        repeated = pd.Index(keys.to_numpy()).isin(validator.primary_keys[table_name])
+    tbl_quarantine = None
+    if repeated.any():
+        table = pq.read_table(part_path)
+        tbl_quarantine = table.filter(pa.array(repeated)).append_column(
+            QUARANTINE_REASON_COLUMN,
+            pa.array([f"{primary_key} is repeated"] * int(repeated.sum())),
+        )
+        table, write_options = return_arrow_table_and_write_options(
+            table.filter(pa.array(~repeated)), writer_profile
+        )
+        pq.write_table(table, part_path, **write_options)
+        keys = pc.filter(keys, pa.array(~repeated))
+    validator.record_primary_keys(table_name, keys.to_numpy())
+    return tbl_quarantine, len(keys)
+
+
+def _build_shard(
+    connection,
+    table_name,
+    builder,
+    shard_path,
+    record_ids,
+    part_path,
+    writer_profile,
+    compact,
+    warehouse_types,
+    validator,
+):
+    """
+    Runs in a shard's process: builds the table from the shard's rows and
+    writes its parquet part to part_path, and its invalid rows to an IPC
+    file next to it. Sends its timings and the quarantine file, if any.
+    """
+    try:
+        timings = {}
+        start_time = time.perf_counter()
+        df_shard = builder(
+            _read_ipc_file(shard_path).to_pandas(), record_ids=record_ids
+        )
+        quarantine_path = None
+        if validator is not None:
+            df_shard, df_quarantine = validator.validate(table_name, df_shard)
+            if df_quarantine is not None:
+                quarantine_path = f"{part_path}.quarantine.arrow"
+                _write_ipc_file(pa.Table.from_pandas(df_quarantine), quarantine_path)
+        if compact:
+            df_shard, _ = compact_dtypes(table_name, df_shard)
+        if warehouse_types:
+            df_shard = cast_to_warehouse_schema(table_name, df_shard)
+        encode_time = time.perf_counter()
+        table, write_options = return_arrow_table_and_write_options(
+            df_shard, writer_profile
+        )
+        pq.write_table(table, part_path, **write_options)
+        timings["build_seconds"] = encode_time - start_time
+        timings["encode_seconds"] = time.perf_counter() - encode_time
+        timings["rows"] = len(df_shard)
+        connection.send({"timings": timings, "quarantine_path": quarantine_path})
+    except Exception as e:
+        connection.send({"error": f"{type(e).__name__}: {e}"})
+    finally:
+        connection.close()
+
+
+@copy_on_write
+def build_and_populate_table_sharded(
+    s3_client,
+    datetime_string,
+    table_name,
+    builder,
+    df_input,
+    bucket_name,
+    shards,
+    writer_profile=None,
+    compact=False,
+    warehouse_types=False,
+    validator=None,
+    key_column="sales_order_id",
+):
+    """
+    Alternative to build_and_populate_table for the SHARDED_TABLES: splits
+    df_input into at most shards ranges of key_column, builds each in its
+    own process with builder, which takes the record_ids of its rows, and
+    writes each as the next parquet part of the table, with at most one
+    process per CPU at a time. compact, warehouse_types and validator are as
+    for build_and_populate_table, the primary keys being checked across
+    shards too; the rows quarantined by every shard go to one quarantine
+    file. Returns the put response, listing the key and rows of each part
+    for the manifest, and a dict of timings summed over the shards.
+    """
+    timings = {"build_seconds": 0.0, "encode_seconds": 0.0, "upload_seconds": 0.0}
+    start_time = time.perf_counter()
+    tbl_input = pa.Table.from_pandas(df_input, preserve_index=False)
+    shards = max(1, min(shards, len(tbl_input)))
+    order, bounds = _return_key_range_bounds(df_input[key_column], shards)
+    context = multiprocessing.get_context("fork")
+    parts, quarantined = [], []
+    failure, error_response = None, None
+    with tempfile.TemporaryDirectory() as directory:
+        # a shard's rows keep their order in df_input, and their positions
+        # in it are their record ids
+        pending = deque(
+            (part_number, np.sort(order[start:end]))
+            for part_number, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))
+        )
+        processes = deque()
+        max_processes = min(len(pending), os.cpu_count() or 1)
+        while pending or processes:
+            while pending and len(processes) < max_processes:
+                part_number, positions = pending.popleft()
+                shard_path = os.path.join(directory, f"shard-{part_number}.arrow")
+                part_path = os.path.join(directory, f"part-{part_number}.parquet")
+                _write_ipc_file(tbl_input.take(positions), shard_path)
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(
+                    target=_build_shard,
+                    args=(
+                        sender,
+                        table_name,
+                        builder,
+                        shard_path,
+                        positions + 1,
+                        part_path,
+                        writer_profile,
+                        compact,
+                        warehouse_types,
+                        validator,
+                    ),
+                )
+                process.start()
+                sender.close()
+                processes.append((part_number, process, receiver, part_path))
+
+            # parts are uploaded in order as their processes finish, while
+            # the later shards are still building; after a failure no more
+            # processes are started, and the running ones are waited for
+            part_number, process, receiver, part_path = processes.popleft()
+            try:
+                result = receiver.recv()
+            except EOFError:
+                result = None
+            process.join()
+            if result is None:
+                result = {"error": f"exited with code {process.exitcode}"}
+            if failure or error_response:
+                continue
+            if "error" in result:
+                failure = f"{table_name} shard {part_number} failed: {result['error']}"
+                pending.clear()
+                continue
+            for name in ["build_seconds", "encode_seconds"]:
+                timings[name] += result["timings"][name]
+            if result["quarantine_path"] is not None:
+                quarantined.append(_read_ipc_file(result["quarantine_path"]))
+            rows = result["timings"]["rows"]
+            if validator is not None:
+                tbl_quarantine, rows = _quarantine_repeated_keys(
+                    table_name, part_path, writer_profile, validator
+                )
+                if tbl_quarantine is not None:
+                    quarantined.append(tbl_quarantine)
+            key = return_part_s3_key(table_name, datetime_string, part_number)
+            upload_time = time.perf_counter()
+            try:
+                with open(part_path, "rb") as f:
+                    s3_client.put_object(Bucket=bucket_name, Key=key, Body=f.read())
+            except ClientError as e:
+                error_response = {"message": "Error", "details": str(e)}
+                pending.clear()
+                continue
+            timings["upload_seconds"] += time.perf_counter() - upload_time
+            parts.append({"key": key, "rows": rows})
+        # quarantined rows are read before the directory is removed
+        quarantined = [table.to_pandas() for table in quarantined]
+    if failure:
+        raise RuntimeError(failure)
+    if error_response:
+        return error_response, timings
+
+    if validator is not None:
+        timings["validation"] = {"quarantined_rows": 0}
+        if quarantined:
+            key = return_quarantine_s3_key(table_name, datetime_string)
+            populate_parquet_file(
+                s3_client,
+                datetime_string,
+                table_name,
+                pd.concat(quarantined),
+                bucket_name,
+                key=key,
+            )
+            timings["validation"] = {
+                "quarantined_rows": sum(len(df) for df in quarantined),
+                "quarantine_key": key,
+            }
+    timings["shards"] = len(parts)
+    timings["rows"] = sum(part["rows"] for part in parts)
+    timings["total_seconds"] = time.perf_counter() - start_time
+    response = {"ResponseMetadata": {"HTTPStatusCode": 200}, "Parts": parts}
+    return response, timings
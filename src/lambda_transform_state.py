@@ -0,0 +1,185 @@
+import io
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from botocore.exceptions import ClientError
+from src.utils import return_missing_keys
+
+
+# Compacted current state of the ingestion tables, for incremental runs in
+# which each ingestion snapshot holds only the rows changed since the last.
+# The state of each source table is one parquet file in the processed bucket
+# holding the latest version of every row, keyed on the table's primary key.
+# A delta snapshot is merged into the state and the builders read the merged
+# state, so joins against unchanged rows (address for counterparty,
+# department for staff) still find them.
+#
+# sales_order is keyed on (sales_order_id, last_updated), the grain of
+# fact_sales_order, so its state keeps every version of an order as a full
+# snapshot does. Rows deleted from the source are removed using the key
+# index extraction stores next to each snapshot, which lists every primary
+# key in the source table; snapshots without one delete nothing.
+#
+# keep_latest_versions reduces a source table to the latest version of each
+# key, for when snapshots holding the same rows are combined. It keys each
+# table on LATEST_VERSION_KEYS, in which sales_order is keyed on
+# sales_order_id alone, so an order updated between the snapshots is one
+# row of its latest version.
+
+STATE_PREFIX = "state"
+
+SOURCE_TABLE_KEYS = {
+    "address": ["address_id"],
+    "counterparty": ["counterparty_id"],
+    "currency": ["currency_id"],
+    "department": ["department_id"],
+    "design": ["design_id"],
+    "payment": ["payment_id"],
+    "payment_type": ["payment_type_id"],
+    "purchase_order": ["purchase_order_id"],
+    "sales_order": ["sales_order_id", "last_updated"],
+    "staff": ["staff_id"],
+    "transaction": ["transaction_id"],
+}
+
+LATEST_VERSION_KEYS = {**SOURCE_TABLE_KEYS, "sales_order": ["sales_order_id"]}
+
+
+def return_state_s3_key(table_name):
+    """Returns the processed bucket key of a source table's current state"""
+    return f"{STATE_PREFIX}/{table_name}.parquet"
+
+
+def merge_current_state(df_state, df_delta, key_columns, df_deleted=None):
+    """
+    Returns the state with the rows of a delta merged in: rows whose key is
+    already in the state are replaced where they are, new keys are appended
+    in delta order. Where a key is repeated in the delta the last row wins.
+    Rows whose key is in df_deleted, as found by a snapshot diff, are
+    removed.
+    """
+    if df_deleted is not None and not df_deleted.empty and df_state is not None:
+        state_keys = pd.MultiIndex.from_frame(df_state[key_columns])
+        deleted_keys = pd.MultiIndex.from_frame(df_deleted[key_columns])
+        df_state = df_state[~state_keys.isin(deleted_keys)].reset_index(drop=True)
+    if df_delta.empty:
+        return df_state
+    df_delta = df_delta.drop_duplicates(key_columns, keep="last")
+    if df_state is None or df_state.empty:
+        return df_delta.reset_index(drop=True)
+
+    state_keys = pd.MultiIndex.from_frame(df_state[key_columns])
+    delta_keys = pd.MultiIndex.from_frame(df_delta[key_columns])
+    positions = state_keys.get_indexer(delta_keys)
+    updated = positions != -1
+
+    # rows of state + delta to take: the state's, with updated ones swapped
+    # for their delta row, then the delta's new rows
+    delta_rows = len(df_state) + np.arange(len(df_delta))
+    rows = np.arange(len(df_state))
+    rows[positions[updated]] = delta_rows[updated]
+    rows = np.concatenate([rows, delta_rows[~updated]])
+    df_combined = pd.concat([df_state, df_delta], ignore_index=True)
+    return df_combined.take(rows).reset_index(drop=True)
+
+
+def _return_key_codes(values):
+    """Returns int64 codes of a key column, equal values sharing a code"""
+    codes, _ = pd.factorize(values, use_na_sentinel=False)
+    return codes
+
+
+def keep_latest_versions(df_table, key_columns, version_column="last_updated"):
+    """
+    Returns a source table (dataframe or arrow table) with only the latest
+    version of each key: the row with the greatest version_column timestamp,
+    the later row where versions are equal. Rows keep their order. The rows
+    are sorted on key then version, as arrays, and the last row of each key
+    kept, so the cost is one lexsort whatever the number of duplicates.
+    Tables without duplicate keys are returned as they are.
+    """
+    if len(df_table) == 0:
+        return df_table
+    if isinstance(df_table, pa.Table):
+        column_names = df_table.column_names
+    else:
+        column_names = df_table.columns
+    key_codes = [_return_key_codes(df_table[name].to_numpy()) for name in key_columns]
+    sort_keys = [np.arange(len(df_table))]
+    if version_column in column_names and version_column not in key_columns:
+        versions = pd.to_datetime(
+            pd.Series(np.asarray(df_table[version_column])), format="ISO8601"
+        )
+        sort_keys.append(versions.to_numpy("datetime64[ns]").view("int64"))
+
+    # np.lexsort sorts on its last key first
+    order = np.lexsort(sort_keys + key_codes[::-1])
+    sorted_codes = np.column_stack([codes[order] for codes in key_codes])
+    is_last = np.ones(len(order), dtype=bool)
+    is_last[:-1] = (sorted_codes[1:] != sorted_codes[:-1]).any(axis=1)
+    if is_last.all():
+        return df_table
+    rows = np.sort(order[is_last])
+    if isinstance(df_table, pa.Table):
+        return df_table.take(pa.array(rows))
+    return df_table.take(rows).reset_index(drop=True)
+
+
+def read_current_state(s3_client, bucket_name, table_name):
+    """Returns the stored state of a source table, None if none is stored yet"""
+    try:
+        response = s3_client.get_object(
+            Bucket=bucket_name, Key=return_state_s3_key(table_name)
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return None
+        raise
+    return pd.read_parquet(io.BytesIO(response["Body"].read()))
+
+
+def write_current_state(s3_client, bucket_name, table_name, df_state):
+    """Stores the state of a source table as a single parquet file"""
+    buffer = io.BytesIO()
+    df_state.to_parquet(buffer, index=False, compression="zstd")
+    return s3_client.put_object(
+        Bucket=bucket_name, Key=return_state_s3_key(table_name), Body=buffer.getvalue()
+    )
+
+
+def update_current_state(
+    s3_client,
+    bucket_name,
+    table_name,
+    df_delta,
+    df_deleted=None,
+    df_snapshot=None,
+    key_index=None,
+):
+    """
+    Merges a delta snapshot of a source table into its stored state, and
+    removes the rows of df_deleted, stores the result and returns it.
+    Merging the same delta again changes nothing, so a failed run can be
+    retried with the same snapshot. Where the delta was diffed from a full
+    snapshot, df_snapshot is that snapshot, which seeds the state when none
+    is stored yet. key_index is the snapshot's key index of every primary
+    key in the source table, rows of the state whose key is not in it are
+    deleted.
+    """
+    key_columns = SOURCE_TABLE_KEYS[table_name]
+    df_state = read_current_state(s3_client, bucket_name, table_name)
+    if df_state is None and df_snapshot is not None:
+        df_delta, df_deleted = df_snapshot, None
+    if df_state is not None and key_index is not None:
+        missing = return_missing_keys(key_index, df_state[key_columns[0]])
+        if missing.any():
+            df_deleted = pd.concat(
+                [df_deleted, df_state.loc[missing, key_columns]], ignore_index=True
+            )
+    df_merged = merge_current_state(df_state, df_delta, key_columns, df_deleted)
+    if df_merged is None:
+        # nothing stored and nothing changed
+        return df_delta
+    if df_merged is not df_state:
+        write_current_state(s3_client, bucket_name, table_name, df_merged)
+    return df_merged
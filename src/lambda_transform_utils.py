@@ -1,68 +1,1303 @@
 import io
+import codecs
 import pandas as pd
+import numpy as np
 import json
 import datetime
-from src.utils import return_week, return_s3_key
-from copy import copy
+import time
+import sys
+import hashlib
+import inspect
+import threading
+from collections import OrderedDict
+from functools import lru_cache, partial, wraps
+from src.utils import (
+    return_week,
+    return_s3_key,
+    return_partition_s3_key,
+    return_manifest_s3_key,
+    return_quarantine_s3_key,
+)
+from src.warehouse_schema import (
+    WAREHOUSE_COLUMN_TYPES,
+    return_integer_dtype,
+    cast_to_warehouse_schema,
+)
+from src.lambda_transform_rates import (
+    CURRENT_GBP_RATES_VERSION,
+    return_gross_values,
+    return_gbp_values,
+)
+from src.lambda_transform_money import (
+    FIXED_POINT_MONEY_COLUMNS,
+    return_fixed_point_measures,
+    return_money_decimals,
+)
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 from botocore.exceptions import ClientError
 from io import BytesIO
 
 
+SOURCE_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+NANOSECONDS_PER_DAY = 86_400_000_000_000
+
+# multipart upload part size used when streaming parquet files to S3, S3
+# rejects parts (other than the last) under 5 MiB
+S3_UPLOAD_PART_SIZE = 8 * 1024 * 1024
+S3_MIN_UPLOAD_PART_SIZE = 5 * 1024 * 1024
+
+# bytes requested from S3 at a time when streaming an ingestion file in
+# batches, see iter_s3_json_array_batches
+S3_READ_SIZE = 1024 * 1024
+
+# partition column of the tables that can be written partitioned, and the
+# number of leading characters of its ISO date kept by each granularity
+TABLE_PARTITION_COLUMNS = {"fact_sales_order": "created_date"}
+PARTITION_GRANULARITIES = {"day": 10, "month": 7}
+
+# bytes of parsed ingestion tables kept by the input cache, see S3TableCache
+S3_TABLE_CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+# string columns with at most this many distinct values per row are stored
+# as categoricals / dictionaries by compact_dtypes
+CATEGORY_MAX_RATIO = 0.5
+
+# where the fingerprint of each table's last output is kept in the processed
+# bucket, see return_table_fingerprint
+FINGERPRINT_PREFIX = "fingerprints"
+
+# the warehouse tables built from sales_order alone, which chunked mode
+# builds batch by batch, see build_and_populate_sales_order_chunked
+SALES_ORDER_CHUNKED_TABLES = ["dim_date", "fact_sales_order"]
+
+# the date and timestamp columns of each fact's source table, every day of
+# which dim_date holds
+FACT_DATE_COLUMNS = {
+    "sales_order": [
+        "created_at",
+        "last_updated",
+        "agreed_delivery_date",
+        "agreed_payment_date",
+    ],
+    "purchase_order": [
+        "created_at",
+        "last_updated",
+        "agreed_delivery_date",
+        "agreed_payment_date",
+    ],
+    "payment": ["created_at", "last_updated", "payment_date"],
+}
+
+# codec and statistics settings for pq.write_table, see
+# return_parquet_writer_profile
+PARQUET_WRITER_PROFILES = {
+    "snappy": {
+        "compression": "snappy",
+        "write_statistics": True,
+        "write_page_index": True,
+    },
+    "zstd": {
+        "compression": "zstd",
+        "compression_level": 3,
+        "write_statistics": True,
+        "write_page_index": True,
+    },
+}
+
+# per-table layout: sort order (lets readers prune row groups on the sort
+# columns), low cardinality columns to dictionary encode and row group size
+PARQUET_TABLE_LAYOUTS = {
+    "dim_date": {
+        "sort_by": ["date_id"],
+        "dictionary_columns": ["day_name", "month_name"],
+    },
+    "dim_design": {
+        "sort_by": ["design_id"],
+        "dictionary_columns": ["design_name", "file_location"],
+    },
+    "dim_location": {
+        "sort_by": ["location_id"],
+        "dictionary_columns": ["district", "country"],
+    },
+    "dim_counterparty": {
+        "sort_by": ["counterparty_id"],
+        "dictionary_columns": [
+            "counterparty_legal_district",
+            "counterparty_legal_country",
+        ],
+    },
+    "dim_staff": {
+        "sort_by": ["staff_id"],
+        "dictionary_columns": ["department_name", "location"],
+    },
+    "dim_currency": {
+        "sort_by": ["currency_id"],
+        "dictionary_columns": ["currency_code", "currency_name"],
+    },
+    "fact_sales_order": {
+        "sort_by": ["created_date"],
+        "dictionary_columns": [
+            "created_date",
+            "last_updated_date",
+            "sales_staff_id",
+            "counterparty_id",
+            "currency_id",
+            "design_id",
+            "agreed_payment_date",
+            "agreed_delivery_date",
+            "agreed_delivery_location_id",
+        ],
+        "row_group_size": 128 * 1024,
+    },
+    "dim_payment_type": {
+        "sort_by": ["payment_type_id"],
+        "dictionary_columns": ["payment_type_name"],
+    },
+    "dim_transaction": {
+        "sort_by": ["transaction_id"],
+        "dictionary_columns": ["transaction_type"],
+    },
+    "fact_purchase_order": {
+        "sort_by": ["created_date"],
+        "dictionary_columns": [
+            "created_date",
+            "last_updated_date",
+            "staff_id",
+            "counterparty_id",
+            "item_code",
+            "currency_id",
+            "agreed_delivery_date",
+            "agreed_payment_date",
+            "agreed_delivery_location_id",
+        ],
+        "row_group_size": 128 * 1024,
+    },
+    "fact_payment": {
+        "sort_by": ["created_date"],
+        "dictionary_columns": [
+            "created_date",
+            "last_updated_date",
+            "counterparty_id",
+            "currency_id",
+            "payment_type_id",
+            "payment_date",
+        ],
+        "row_group_size": 128 * 1024,
+    },
+}
+
+
 def read_s3_table_json(s3_client, s3_key, ingestion_bucket_name):
     """
     Pets json file from the ingestion table and returns a dataframe
     """
     response = s3_client.get_object(Bucket=ingestion_bucket_name, Key=s3_key)
-    json_data = response["Body"].read().decode("utf-8")
+    return _return_df_from_json(response["Body"].read())
+
+
+def _return_df_from_json(body):
+    """Parses the bytes of an ingestion json file into a dataframe"""
+    json_data = body.decode("utf-8")
     json_data = json_data.replace("\\", "\\\\")  # If needed
     df = pd.DataFrame(json.loads(json_data))
 
     return df
 
 
-def populate_parquet_file(s3_client, datetime_string, table_name, df_file, bucket_name):
-    '''
+class S3TableCache:
+    """
+    In-process LRU cache of parsed ingestion tables, which lives as long as
+    a warm Lambda container. Entries are keyed on the bucket and file name
+    (the datetime prefix of the key changes every run) and hold the ETag of
+    the parsed file. A lookup is a conditional get_object with IfNoneMatch
+    on that ETag: an unchanged file costs a 304 round trip, a changed one is
+    downloaded and parsed as usual. Least recently used entries are evicted
+    once the parsed tables take more than max_bytes.
+    Cached dataframes are shared between runs, so must not be modified in
+    place (copy-on-write is on for the builders, see copy_on_write).
+    """
+
+    def __init__(self, max_bytes=S3_TABLE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, s3_client, s3_key, bucket_name):
+        """Returns the dataframe of an ingestion file, as read_s3_table_json"""
+        cache_key = (bucket_name, s3_key.rsplit("/", 1)[-1])
+        with self._lock:
+            entry = self._entries.get(cache_key)
+        get_kwargs = {"IfNoneMatch": entry["etag"]} if entry is not None else {}
+        try:
+            response = s3_client.get_object(
+                Bucket=bucket_name, Key=s3_key, **get_kwargs
+            )
+        except ClientError as e:
+            not_modified = e.response["Error"]["Code"] in ("304", "NotModified")
+            if entry is None or not not_modified:
+                raise
+            with self._lock:
+                self.hits += 1
+                if cache_key in self._entries:
+                    self._entries.move_to_end(cache_key)
+            return entry["df"]
+
+        df = _return_df_from_json(response["Body"].read())
+        nbytes = int(df.memory_usage(deep=True).sum())
+        with self._lock:
+            self.misses += 1
+            self._remove(cache_key)
+            if nbytes <= self.max_bytes:
+                self._entries[cache_key] = {
+                    "etag": response["ETag"],
+                    "df": df,
+                    "nbytes": nbytes,
+                }
+                self.total_bytes += nbytes
+            self._evict()
+        return df
+
+    def resize(self, max_bytes):
+        """Changes the byte limit, evicting entries over it"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def stats(self):
+        """Returns the counters and size of the cache"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def _remove(self, cache_key):
+        entry = self._entries.pop(cache_key, None)
+        if entry is not None:
+            self.total_bytes -= entry["nbytes"]
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            _, entry = self._entries.popitem(last=False)
+            self.total_bytes -= entry["nbytes"]
+            self.evictions += 1
+
+
+# shared by every invocation of a warm container
+S3_TABLE_CACHE = S3TableCache()
+
+
+def read_s3_table_json_cached(s3_client, s3_key, ingestion_bucket_name):
+    """read_s3_table_json through the container's S3TableCache"""
+    return S3_TABLE_CACHE.read(s3_client, s3_key, ingestion_bucket_name)
+
+
+def iter_s3_json_array_batches(
+    s3_client, s3_key, ingestion_bucket_name, batch_rows, read_size=S3_READ_SIZE
+):
+    """
+    Streams a json array file from the ingestion bucket and yields dataframes
+    of up to batch_rows records, so that the file is never held in memory as
+    a whole. Records are escaped as read_s3_table_json does.
+    """
+    response = s3_client.get_object(Bucket=ingestion_bucket_name, Key=s3_key)
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    text = ""
+    position = 0
+    array_started = False
+    array_ended = False
+    records = []
+    chunks = response["Body"].iter_chunks(read_size)
+    while not array_ended:
+        chunk = next(chunks, None)
+        if chunk is None:
+            break
+        text = text[position:] + text_decoder.decode(chunk).replace("\\", "\\\\")
+        position = 0
+        while True:
+            # skip whitespace and separators up to the next record
+            while position < len(text) and text[position] in " \t\r\n,[":
+                if text[position] == "[":
+                    array_started = True
+                position += 1
+            if position == len(text):
+                break
+            if text[position] == "]":
+                array_ended = True
+                break
+            if not array_started:
+                raise ValueError(f"{s3_key} is not a json array")
+            try:
+                record, position = decoder.raw_decode(text, position)
+            except json.JSONDecodeError:
+                break  # record continues in the next chunk
+            records.append(record)
+            if len(records) == batch_rows:
+                yield pd.DataFrame(records)
+                records = []
+    if not array_ended:
+        raise ValueError(f"{s3_key} ended before the end of its json array")
+    if records:
+        yield pd.DataFrame(records)
+
+
+def return_parquet_writer_profile(table_name, profile_name="zstd"):
+    """
+    Returns the parquet writer settings for a table: the codec/statistics
+    settings of the named profile combined with the table's layout (sort
+    order, dictionary columns and row group size). The "default" profile
+    returns an empty dict, i.e. plain pyarrow defaults.
+    """
+    if profile_name == "default":
+        return {}
+    writer_profile = dict(PARQUET_WRITER_PROFILES[profile_name])
+    writer_profile.update(PARQUET_TABLE_LAYOUTS.get(table_name, {}))
+    return writer_profile
+
+
+def return_arrow_table_and_write_options(df_file, writer_profile=None):
+    """
+    Applies a writer profile to a dataframe (or an arrow table, as produced
+    by the arrow engine). Returns the (sorted) arrow table and the keyword
+    arguments to pass to pq.write_table / pq.ParquetWriter.
+    """
+    write_options = dict(writer_profile or {})
+    sort_by = write_options.pop("sort_by", None)
+    dictionary_columns = write_options.pop("dictionary_columns", None)
+    if isinstance(df_file, pa.Table):
+        table = df_file
+        if sort_by:
+            # arrow cannot sort dictionary columns (from compact_dtypes), so
+            # the order is taken from their decoded values
+            sort_keys = pa.table(
+                {
+                    column: (
+                        table[column].cast(table[column].type.value_type)
+                        if pa.types.is_dictionary(table[column].type)
+                        else table[column]
+                    )
+                    for column in sort_by
+                }
+            )
+            table = table.take(
+                pc.sort_indices(
+                    sort_keys, [(column, "ascending") for column in sort_by]
+                )
+            )
+    else:
+        if sort_by:
+            df_file = df_file.sort_values(sort_by, kind="stable")
+        table = pa.Table.from_pandas(df_file)
+    if sort_by:
+        write_options["sorting_columns"] = pq.SortingColumn.from_ordering(
+            table.schema, [(column, "ascending") for column in sort_by]
+        )
+    if dictionary_columns is not None:
+        write_options["use_dictionary"] = dictionary_columns
+    return table, write_options
+
+
+def populate_parquet_file(
+    s3_client,
+    datetime_string,
+    table_name,
+    df_file,
+    bucket_name,
+    timings=None,
+    writer_profile=None,
+    key=None,
+):
+    """
     Converts dataframe to parquet and loads it into the 'processed' S3 bucket.
-    '''
+    If a timings dict is passed, the encode and upload durations are recorded
+    in it (in seconds). writer_profile is a dict as returned by
+    return_parquet_writer_profile, None keeps the pyarrow defaults. key
+    overrides the table's default key.
+    """
     try:
-        key = return_s3_key(table_name, datetime_string, extension=".parquet")
-        table = pa.Table.from_pandas(df_file)
+        key = key or return_s3_key(table_name, datetime_string, extension=".parquet")
+        start_time = time.perf_counter()
+        table, write_options = return_arrow_table_and_write_options(
+            df_file, writer_profile
+        )
 
         buffer = io.BytesIO()
-        pq.write_table(table, buffer)
+        pq.write_table(table, buffer, **write_options)
         buffer.seek(0)  # Reset buffer position
+        encoded_time = time.perf_counter()
         response = s3_client.put_object(
             Bucket=bucket_name, Key=key, Body=buffer.getvalue()
         )
+        if timings is not None:
+            timings["encode_seconds"] = encoded_time - start_time
+            timings["upload_seconds"] = time.perf_counter() - encoded_time
 
         return response
     except ClientError as e:
         return {"message": "Error", "details": str(e)}
 
 
-def _return_df_dim_dates(df_totesys_sales_order):
-    ''' Produce unique dates for dim_dates table '''
-    # reduce to just datetime and date columns
-    list_target_columns = [
-        "created_at",
-        "last_updated",
-        "agreed_delivery_date",
-        "agreed_payment_date",
-    ]
-    df_reduced = df_totesys_sales_order.loc[:, list_target_columns]
+class S3MultipartWriter:
+    """
+    Write-only file object that uploads to S3 as it is written to. Bytes are
+    buffered until part_size is reached and then sent as a multipart upload
+    part, so at most one part is held in memory. Objects smaller than a
+    single part are sent with one put_object call on close.
+    """
+
+    def __init__(self, s3_client, bucket_name, key, part_size=S3_UPLOAD_PART_SIZE):
+        if part_size < S3_MIN_UPLOAD_PART_SIZE:
+            raise ValueError(
+                f"part_size must be at least {S3_MIN_UPLOAD_PART_SIZE} bytes"
+            )
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.upload_seconds = 0.0
+        self.response = None
+        self._buffer = bytearray()
+        self._position = 0
+        self._upload_id = None
+        self._parts = []
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[: self.part_size])
+            del self._buffer[: self.part_size]
+            self._upload_part(part)
+        return len(data)
+
+    def close(self):
+        """Sends whatever is buffered and completes the upload"""
+        if self.closed:
+            return
+        self.closed = True
+        start_time = time.perf_counter()
+        if self._upload_id is None:
+            self.response = self.s3_client.put_object(
+                Bucket=self.bucket_name, Key=self.key, Body=bytes(self._buffer)
+            )
+        else:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            self.response = self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts},
+            )
+        self._buffer = bytearray()
+        self.upload_seconds += time.perf_counter() - start_time
+
+    def abort(self):
+        """Abandons the upload, discarding any parts already sent"""
+        self.closed = True
+        self._buffer = bytearray()
+        if self._upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self._upload_id
+            )
+
+    def _upload_part(self, part):
+        start_time = time.perf_counter()
+        if self._upload_id is None:
+            self._upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key
+            )["UploadId"]
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=part,
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self.upload_seconds += time.perf_counter() - start_time
+
+
+def stream_parquet_file(
+    s3_client,
+    datetime_string,
+    table_name,
+    df_file,
+    bucket_name,
+    timings=None,
+    writer_profile=None,
+    part_size=S3_UPLOAD_PART_SIZE,
+    key=None,
+):
+    """
+    Streaming alternative to populate_parquet_file. Row groups are written
+    straight into an S3MultipartWriter as they are encoded, so the encoded
+    file is never held in memory as a whole.
+    """
+    key = key or return_s3_key(table_name, datetime_string, extension=".parquet")
+    start_time = time.perf_counter()
+    table, write_options = return_arrow_table_and_write_options(df_file, writer_profile)
+    row_group_size = write_options.pop("row_group_size", None)
+    sink = S3MultipartWriter(s3_client, bucket_name, key, part_size)
+    try:
+        with pq.ParquetWriter(sink, table.schema, **write_options) as writer:
+            writer.write_table(table, row_group_size=row_group_size)
+        sink.close()
+    except ClientError as e:
+        sink.abort()
+        return {"message": "Error", "details": str(e)}
+    except Exception:
+        sink.abort()
+        raise
+    if timings is not None:
+        timings["encode_seconds"] = (
+            time.perf_counter() - start_time - sink.upload_seconds
+        )
+        timings["upload_seconds"] = sink.upload_seconds
+
+    return sink.response
+
+
+def _return_partitions(df_file, partition_column, granularity):
+    """
+    Splits a dataframe (or arrow table) on the day or month of its
+    partition_column dates. Returns (partition value, rows) pairs in
+    partition value order, rows keeping their order within a partition.
+    """
+    values = df_file[partition_column]
+    if not isinstance(df_file, pa.Table):
+        values = pa.array(values)
+    if pa.types.is_integer(values.type):
+        # int_date_keys yyyymmdd keys, partitioned as their dates
+        values = pc.strptime(
+            pc.cast(values, pa.string()), format="%Y%m%d", unit="s"
+        ).cast(pa.date32())
+    values = pc.utf8_slice_codeunits(
+        pc.cast(values, pa.string()), 0, PARTITION_GRANULARITIES[granularity]
+    )
+    partition_values, inverse = np.unique(
+        values.to_numpy(zero_copy_only=False), return_inverse=True
+    )
+    order = np.argsort(inverse, kind="stable")
+    ends = np.cumsum(np.bincount(inverse))
+    starts = ends - np.bincount(inverse)
+    partitions = []
+    for value, start, end in zip(partition_values, starts, ends):
+        if isinstance(df_file, pa.Table):
+            partitions.append((str(value), df_file.take(order[start:end])))
+        else:
+            partitions.append((str(value), df_file.iloc[order[start:end]]))
+    return partitions
+
+
+def populate_parquet_partitions(
+    s3_client,
+    datetime_string,
+    table_name,
+    df_file,
+    bucket_name,
+    partition_column,
+    granularity,
+    timings=None,
+    writer_profile=None,
+    streaming=False,
+    part_number=0,
+):
+    """
+    Partitioned alternative to populate_parquet_file: writes one parquet file
+    per day or month (granularity) of partition_column, under hive style
+    keys. Returns a response for the whole table listing the partitions
+    written, for the manifest; if a write fails its response is returned
+    instead.
+    """
+    write_parquet_file = stream_parquet_file if streaming else populate_parquet_file
+    partitions = []
+    for value, df_partition in _return_partitions(
+        df_file, partition_column, granularity
+    ):
+        key = return_partition_s3_key(
+            table_name, datetime_string, partition_column, value, part_number
+        )
+        partition_timings = {}
+        response = write_parquet_file(
+            s3_client,
+            datetime_string,
+            table_name,
+            df_partition,
+            bucket_name,
+            partition_timings,
+            writer_profile,
+            key=key,
+        )
+        if response.get("ResponseMetadata", {}).get("HTTPStatusCode") != 200:
+            return response
+        if timings is not None:
+            for name, seconds in partition_timings.items():
+                timings[name] = timings.get(name, 0.0) + seconds
+        partitions.append({"value": value, "keys": [key], "rows": len(df_partition)})
+
+    return {
+        "ResponseMetadata": {"HTTPStatusCode": 200},
+        "PartitionColumn": partition_column,
+        "PartitionGranularity": granularity,
+        "Partitions": partitions,
+    }
+
+
+def _merge_partitions(partitions):
+    """Combines partition entries with the same value, as written by batches"""
+    merged = {}
+    for partition in partitions:
+        entry = merged.setdefault(
+            partition["value"], {"value": partition["value"], "keys": [], "rows": 0}
+        )
+        entry["keys"] += partition["keys"]
+        entry["rows"] += partition["rows"]
+    return [merged[value] for value in sorted(merged)]
+
+
+def return_manifest_entry(table_name, datetime_string, response, rows):
+    """
+    Returns the manifest entry of a written table: its key, for a
+    partitioned table the partition column and the keys of each partition,
+    or for a table written in shards the key and rows of each part.
+    """
+    entry = {"rows": rows}
+    if "Partitions" in response:
+        entry["partition_column"] = response["PartitionColumn"]
+        entry["partition_granularity"] = response["PartitionGranularity"]
+        entry["partitions"] = response["Partitions"]
+    elif "Parts" in response:
+        entry["parts"] = response["Parts"]
+    else:
+        entry["key"] = return_s3_key(table_name, datetime_string, extension=".parquet")
+    return entry
+
+
+def populate_manifest(
+    s3_client,
+    datetime_string,
+    bucket_name,
+    manifest_tables,
+    previous_datetime_string=None,
+    change_entries=None,
+):
+    """
+    Writes the manifest of a transform run, mapping each table name to its
+    manifest entry, next to the processed files. If the run diffed its
+    inputs against a previous snapshot the change sets of each input table
+    are listed under "changes".
+    """
+    manifest = {"datetime_string": datetime_string, "tables": manifest_tables}
+    if change_entries:
+        manifest["changes"] = {
+            "previous_datetime_string": previous_datetime_string,
+            "tables": change_entries,
+        }
+    return s3_client.put_object(
+        Bucket=bucket_name,
+        Key=return_manifest_s3_key(datetime_string),
+        Body=json.dumps(manifest, indent=2),
+    )
+
+
+def read_manifest(s3_client, bucket_name, datetime_string):
+    """Returns the manifest of a transform run, None if it has none"""
+    try:
+        response = s3_client.get_object(
+            Bucket=bucket_name, Key=return_manifest_s3_key(datetime_string)
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return None
+        raise
+    return json.loads(response["Body"].read())
+
+
+def return_table_s3_keys(manifest, table_name, datetime_string):
+    """
+    Returns the keys of the parquet files holding a table: every part of
+    every partition for a partitioned table, every part of a table written
+    in shards, otherwise the table's key
+    """
+    entry = (manifest or {}).get("tables", {}).get(table_name, {})
+    if "parts" in entry:
+        return [part["key"] for part in entry["parts"]]
+    if "partitions" not in entry:
+        return [return_s3_key(table_name, datetime_string, extension=".parquet")]
+    return [key for partition in entry["partitions"] for key in partition["keys"]]
+
+
+@lru_cache(maxsize=None)
+def _return_module_version(module_name):
+    """Hash of a module's source code, read once per module"""
+    source = inspect.getsource(sys.modules[module_name])
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def return_builder_version(builder):
+    """
+    Returns a hash of the code a builder runs: the source of the module it
+    is defined in, which holds its helpers and constants too, plus any
+    keyword arguments bound with functools.partial
+    """
+    keywords = {}
+    while isinstance(builder, partial):
+        keywords = {**builder.keywords, **keywords}
+        builder = builder.func
+    version = {
+        "module_version": _return_module_version(builder.__module__),
+        "builder": builder.__name__,
+        "keywords": keywords,
+    }
+    return hashlib.sha256(
+        json.dumps(version, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def return_table_fingerprint(table_name, builder_version, input_etags, run_options):
+    """
+    Returns the fingerprint of a table's output: a hash of the builder
+    version, the ETags of its ingestion files and the run options that
+    change the written files. Equal fingerprints mean equal outputs.
+    """
+    fingerprint = {
+        "table_name": table_name,
+        "builder_version": builder_version,
+        "input_etags": input_etags,
+        "run_options": run_options,
+    }
+    return hashlib.sha256(
+        json.dumps(fingerprint, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def read_fingerprint_record(s3_client, bucket_name, table_name):
+    """
+    Returns the fingerprint record of a table's last output (its fingerprint,
+    datetime_string and manifest entry), None if it has none
+    """
+    try:
+        response = s3_client.get_object(
+            Bucket=bucket_name, Key=f"{FINGERPRINT_PREFIX}/{table_name}.json"
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return None
+        raise
+    return json.loads(response["Body"].read())
+
+
+def populate_fingerprint_record(
+    s3_client, bucket_name, table_name, fingerprint, datetime_string, entry
+):
+    """Records the fingerprint of the output just written for a table"""
+    record = {
+        "fingerprint": fingerprint,
+        "datetime_string": datetime_string,
+        "entry": entry,
+    }
+    return s3_client.put_object(
+        Bucket=bucket_name,
+        Key=f"{FINGERPRINT_PREFIX}/{table_name}.json",
+        Body=json.dumps(record, indent=2),
+    )
+
+
+def copy_table_output(s3_client, bucket_name, record, datetime_string):
+    """
+    Reuses a table's previous output: server-side copies every file of the
+    record's manifest entry to this run's keys. Returns the manifest entry
+    for the copies, marked as reused from the previous run.
+    """
+    previous_prefix = f"data/{record['datetime_string']}/"
+    prefix = f"data/{datetime_string}/"
+    entry = json.loads(json.dumps(record["entry"]).replace(previous_prefix, prefix))
+    entry["reused_from"] = record["datetime_string"]
+    if record["datetime_string"] == datetime_string:
+        return entry  # already in place
+    if "partitions" in record["entry"]:
+        previous_keys = [
+            key
+            for partition in record["entry"]["partitions"]
+            for key in partition["keys"]
+        ]
+    elif "parts" in record["entry"]:
+        previous_keys = [part["key"] for part in record["entry"]["parts"]]
+    else:
+        previous_keys = [record["entry"]["key"]]
+    for previous_key in previous_keys:
+        s3_client.copy_object(
+            Bucket=bucket_name,
+            Key=prefix + previous_key[len(previous_prefix) :],
+            CopySource={"Bucket": bucket_name, "Key": previous_key},
+        )
+    return entry
+
+
+def _return_compact_series(table_name, series, category_ratio):
+    """Narrows one column (or index) of a dataframe, see compact_dtypes"""
+    dtype = return_integer_dtype(table_name, series.name)
+    if dtype is not None and series.dtype.kind == "i" and series.dtype != dtype:
+        limits = np.iinfo(dtype)
+        if len(series) == 0 or limits.min <= series.min() <= series.max() <= limits.max:
+            return series.astype(dtype)
+    elif series.dtype == object and len(series) > 0:
+        if series.nunique(dropna=False) <= category_ratio * len(series):
+            return series.astype("category")
+    return series
+
+
+def _return_compact_column(table_name, name, column, category_ratio):
+    """Narrows one column of an arrow table, see compact_dtypes"""
+    dtype = return_integer_dtype(table_name, name)
+    if dtype is not None and pa.types.is_integer(column.type):
+        target_type = pa.from_numpy_dtype(dtype)
+        if column.type.bit_width > target_type.bit_width:
+            limits = np.iinfo(dtype)
+            min_max = pc.min_max(column)
+            if len(column) == 0 or (
+                limits.min <= min_max["min"].as_py()
+                and min_max["max"].as_py() <= limits.max
+            ):
+                return column.cast(target_type)
+    elif pa.types.is_string(column.type) and len(column) > 0:
+        if pc.count_distinct(column).as_py() <= category_ratio * len(column):
+            return pc.dictionary_encode(column)
+    return column
+
+
+def compact_dtypes(table_name, df_file, category_ratio=CATEGORY_MAX_RATIO):
+    """
+    Narrows the dtypes of a built table (dataframe or arrow table) to the
+    warehouse schema: integer columns to the width of their SQL type in
+    WAREHOUSE_COLUMN_TYPES, where the values fit, and string columns with
+    few distinct values (at most category_ratio per row) to categoricals /
+    dictionaries. Returns the compacted table and a report of its memory
+    use in bytes before and after.
+    """
+    if table_name not in WAREHOUSE_COLUMN_TYPES:
+        return df_file, None
+    if isinstance(df_file, pa.Table):
+        bytes_before = df_file.nbytes
+        compacted = pa.table(
+            {
+                name: _return_compact_column(
+                    table_name, name, df_file[name], category_ratio
+                )
+                for name in df_file.column_names
+            }
+        )
+        bytes_after = compacted.nbytes
+    else:
+        bytes_before = int(df_file.memory_usage(deep=True).sum())
+        compacted = pd.DataFrame(
+            {
+                name: _return_compact_series(table_name, series, category_ratio)
+                for name, series in df_file.items()
+            }
+        )
+        if df_file.index.name is not None:
+            compacted.index = pd.Index(
+                _return_compact_series(
+                    table_name, df_file.index.to_series(), category_ratio
+                ),
+                name=df_file.index.name,
+            )
+        bytes_after = int(compacted.memory_usage(deep=True).sum())
+    report = {
+        "bytes_before": bytes_before,
+        "bytes_after": bytes_after,
+        "bytes_saved": bytes_before - bytes_after,
+    }
+    return compacted, report
+
 
-    # trim off datetimes
-    for col in list_target_columns:
-        df_reduced[col] = df_reduced[col].apply(lambda x: x[:10])
+def validate_and_quarantine(
+    s3_client, datetime_string, table_name, df_table, bucket_name, validator
+):
+    """
+    Validates a built table with a ReferenceValidator and writes the rows it
+    rejects to the table's quarantine file. Returns the valid rows and a
+    report of the rows quarantined, their key and the time taken.
+    """
+    start_time = time.perf_counter()
+    df_table, df_quarantine = validator.validate(table_name, df_table)
+    report = {"quarantined_rows": 0}
+    if df_quarantine is not None:
+        key = return_quarantine_s3_key(table_name, datetime_string)
+        populate_parquet_file(
+            s3_client, datetime_string, table_name, df_quarantine, bucket_name, key=key
+        )
+        report = {"quarantined_rows": len(df_quarantine), "quarantine_key": key}
+    report["seconds"] = time.perf_counter() - start_time
+    return df_table, report
+
+
+def copy_on_write(function):
+    """
+    Runs function with pandas copy-on-write on, which the builders rely on
+    to project the columns they need without copying them, and puts the
+    option back as it was for the rest of the process afterwards
+    """
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with pd.option_context("mode.copy_on_write", True):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+@copy_on_write
+def build_and_populate_table(
+    s3_client,
+    datetime_string,
+    table_name,
+    builder,
+    input_dfs,
+    bucket_name,
+    writer_profile=None,
+    streaming=False,
+    partitioning=None,
+    compact=False,
+    warehouse_types=False,
+    validator=None,
+):
+    """
+    Builds a single warehouse table from its ingestion dataframes and writes
+    it to the 'processed' S3 bucket, with stream_parquet_file if streaming.
+    partitioning is a (partition column, granularity) pair to write the
+    table with populate_parquet_partitions. With compact the table's dtypes
+    are narrowed with compact_dtypes before it is written. With
+    warehouse_types it is written as its warehouse schema, see
+    cast_to_warehouse_schema. With a ReferenceValidator the rows breaking
+    the warehouse constraints are written to the table's quarantine file
+    instead. Returns the put response and a dict of build/encode/upload
+    timings for the table, with the compaction report under "compaction"
+    and the validation report under "validation".
+    """
+    timings = {}
+    start_time = time.perf_counter()
+    df_table = builder(*input_dfs)
+    if validator is not None:
+        df_table, timings["validation"] = validate_and_quarantine(
+            s3_client, datetime_string, table_name, df_table, bucket_name, validator
+        )
+    if compact:
+        df_table, timings["compaction"] = compact_dtypes(table_name, df_table)
+    timings["build_seconds"] = time.perf_counter() - start_time
+    if warehouse_types:
+        cast_time = time.perf_counter()
+        df_table = cast_to_warehouse_schema(table_name, df_table)
+        timings["cast_seconds"] = time.perf_counter() - cast_time
+    if partitioning:
+        response = populate_parquet_partitions(
+            s3_client,
+            datetime_string,
+            table_name,
+            df_table,
+            bucket_name,
+            *partitioning,
+            timings=timings,
+            writer_profile=writer_profile,
+            streaming=streaming,
+        )
+    else:
+        write_parquet_file = stream_parquet_file if streaming else populate_parquet_file
+        response = write_parquet_file(
+            s3_client,
+            datetime_string,
+            table_name,
+            df_table,
+            bucket_name,
+            timings,
+            writer_profile,
+        )
+    timings["rows"] = len(df_table)
+    timings["total_seconds"] = time.perf_counter() - start_time
+
+    return response, timings
+
+
+@copy_on_write
+def build_and_populate_sales_order_chunked(
+    s3_client,
+    datetime_string,
+    ingestion_bucket_name,
+    bucket_name,
+    chunk_rows,
+    writer_profiles=None,
+    arrow_temporal=False,
+    part_size=S3_UPLOAD_PART_SIZE,
+    partitioning=None,
+    key_map=None,
+    warehouse_types=False,
+    extra_dates=None,
+    validator=None,
+    int_date_keys=False,
+    gbp_rates_version=CURRENT_GBP_RATES_VERSION,
+    fixed_point_money=False,
+):
+    """
+    Out-of-core alternative to build_and_populate_table for the tables built
+    from sales_order. sales_order is streamed from the ingestion bucket in
+    batches of chunk_rows records; each batch is written as the next row
+    groups of fact_sales_order, straight into an S3MultipartWriter, and its
+    dates are added to a running set of distinct dates for dim_date. Peak
+    memory is bounded by chunk_rows rather than by the size of sales_order.
+    With partitioning each batch is instead written as the next part of
+    each partition it has rows for. key_map is a SalesRecordKeyMap to assign
+    stable sales_record_id keys. With warehouse_types both tables are
+    written as their warehouse schemas. extra_dates are datetime64 days of
+    the other fact source tables, for dim_date to hold as well. With a
+    ReferenceValidator each batch's invalid rows are set aside and written
+    to the quarantine file of fact_sales_order at the end. With
+    int_date_keys both tables' date keys are int32 yyyymmdd keys.
+    gbp_rates_version is the GBP rates version of gross_value_gbp, and with
+    fixed_point_money the money columns are decimals worked out in pence.
+    writer_profiles maps table names to writer profiles. Returns dicts of the
+    put responses and the timings, keyed by table name.
+    """
+    writer_profiles = writer_profiles or {}
+    sales_order_key = return_s3_key("sales_order", datetime_string)
+    fact_key = return_s3_key("fact_sales_order", datetime_string, ".parquet")
+    fact_timings = {"build_seconds": 0.0, "encode_seconds": 0.0, "rows": 0}
+    start_time = time.perf_counter()
+    unique_dates = np.array([], dtype="datetime64[D]")
+    if extra_dates is not None:
+        unique_dates = np.unique(extra_dates)
+    sink = S3MultipartWriter(s3_client, bucket_name, fact_key, part_size)
+    writer = None
+    partitions = []
+    quarantined = []
+    # rows built so far, quarantined ones included, numbering the next batch
+    built_rows = 0
+    try:
+        for batch_number, df_batch in enumerate(
+            iter_s3_json_array_batches(
+                s3_client, sales_order_key, ingestion_bucket_name, chunk_rows
+            )
+        ):
+            build_time = time.perf_counter()
+            unique_dates = np.union1d(unique_dates, _return_unique_dates(df_batch))
+            df_fact = _return_df_fact_sales_order(
+                df_batch,
+                arrow_temporal=arrow_temporal,
+                first_record_id=built_rows + 1,
+                key_map=key_map,
+                int_date_keys=int_date_keys,
+                gbp_rates_version=gbp_rates_version,
+                fixed_point_money=fixed_point_money,
+            )
+            built_rows += len(df_fact)
+            if validator is not None:
+                df_fact, df_quarantine = validator.validate("fact_sales_order", df_fact)
+                if df_quarantine is not None:
+                    quarantined.append(df_quarantine)
+            if warehouse_types:
+                df_fact = cast_to_warehouse_schema("fact_sales_order", df_fact)
+            encode_time = time.perf_counter()
+            fact_timings["build_seconds"] += encode_time - build_time
+            fact_timings["rows"] += len(df_fact)
+
+            if partitioning:
+                response = populate_parquet_partitions(
+                    s3_client,
+                    datetime_string,
+                    "fact_sales_order",
+                    df_fact,
+                    bucket_name,
+                    *partitioning,
+                    timings=fact_timings,
+                    writer_profile=writer_profiles.get("fact_sales_order"),
+                    part_number=batch_number,
+                )
+                if "Partitions" not in response:
+                    return {"fact_sales_order": response}, {}
+                partitions += response["Partitions"]
+                continue
+
+            # each batch is sorted on its own, the sort order is recorded
+            # per row group
+            table, write_options = return_arrow_table_and_write_options(
+                df_fact, writer_profiles.get("fact_sales_order")
+            )
+            row_group_size = write_options.pop("row_group_size", None)
+            if writer is None:
+                writer = pq.ParquetWriter(sink, table.schema, **write_options)
+            uploaded_seconds = sink.upload_seconds
+            writer.write_table(table.cast(writer.schema), row_group_size)
+            write_seconds = time.perf_counter() - encode_time
+            upload_seconds = sink.upload_seconds - uploaded_seconds
+            fact_timings["encode_seconds"] += write_seconds - upload_seconds
+        if fact_timings["rows"] == 0:
+            raise ValueError(f"{sales_order_key} has no records")
+        if writer is not None:
+            writer.close()
+            sink.close()
+    except ClientError as e:
+        sink.abort()
+        error = {"message": "Error", "details": str(e)}
+        return {table_name: error for table_name in SALES_ORDER_CHUNKED_TABLES}, {}
+    except Exception:
+        sink.abort()
+        raise
+    if partitioning:
+        fact_response = {
+            "ResponseMetadata": {"HTTPStatusCode": 200},
+            "PartitionColumn": partitioning[0],
+            "PartitionGranularity": partitioning[1],
+            "Partitions": _merge_partitions(partitions),
+        }
+    else:
+        fact_response = sink.response
+        fact_timings["upload_seconds"] = sink.upload_seconds
+    if validator is not None:
+        fact_timings["validation"] = {"quarantined_rows": 0}
+        if quarantined:
+            key = return_quarantine_s3_key("fact_sales_order", datetime_string)
+            populate_parquet_file(
+                s3_client,
+                datetime_string,
+                "fact_sales_order",
+                pd.concat(quarantined),
+                bucket_name,
+                key=key,
+            )
+            fact_timings["validation"] = {
+                "quarantined_rows": sum(len(df) for df in quarantined),
+                "quarantine_key": key,
+            }
+    fact_timings["total_seconds"] = time.perf_counter() - start_time
+
+    # dim_date is small once reduced to distinct dates, it is written whole
+    date_timings = {}
+    start_time = time.perf_counter()
+    df_dim_dates = _return_df_dim_dates_from_dates(unique_dates, int_date_keys)
+    if warehouse_types:
+        df_dim_dates = cast_to_warehouse_schema("dim_date", df_dim_dates)
+    date_timings["build_seconds"] = time.perf_counter() - start_time
+    date_response = populate_parquet_file(
+        s3_client,
+        datetime_string,
+        "dim_date",
+        df_dim_dates,
+        bucket_name,
+        date_timings,
+        writer_profiles.get("dim_date"),
+    )
+    date_timings["rows"] = len(df_dim_dates)
+    date_timings["total_seconds"] = time.perf_counter() - start_time
+
+    responses = {"dim_date": date_response, "fact_sales_order": fact_response}
+    timings = {"dim_date": date_timings, "fact_sales_order": fact_timings}
+    return responses, timings
+
+
+def _return_unique_fact_dates(fact_source_dfs):
+    """
+    Returns the sorted distinct days of the date columns of fact source
+    tables (dataframes or arrow tables), given by source table name. The
+    days of every table are concatenated and reduced in one np.unique.
+    """
+    # trim off datetimes as datetime64 days
+    all_days = [np.array([], dtype="datetime64[D]")]
+    for name, df_source in fact_source_dfs.items():
+        for col in FACT_DATE_COLUMNS[name]:
+            timestamps = pd.to_datetime(
+                pd.Series(np.asarray(df_source[col])), format="ISO8601"
+            )
+            all_days.append(timestamps.to_numpy().astype("datetime64[D]"))
+    return np.unique(np.concatenate(all_days))
+
+
+def _return_unique_dates(df_totesys_sales_order):
+    """Returns the sorted distinct days of the sales_order date columns"""
+    return _return_unique_fact_dates({"sales_order": df_totesys_sales_order})
+
+
+def _return_df_dim_dates(
+    df_totesys_sales_order,
+    df_totesys_purchase_order=None,
+    df_totesys_payment=None,
+    int_date_keys=False,
+):
+    """
+    Produce unique dates for dim_dates table, from the dates of every fact
+    source table given. With int_date_keys date_id is an int32 yyyymmdd key.
+    """
+    fact_source_dfs = {
+        "sales_order": df_totesys_sales_order,
+        "purchase_order": df_totesys_purchase_order,
+        "payment": df_totesys_payment,
+    }
+    return _return_df_dim_dates_from_dates(
+        _return_unique_fact_dates(
+            {
+                name: df_source
+                for name, df_source in fact_source_dfs.items()
+                if df_source is not None
+            }
+        ),
+        int_date_keys,
+    )
 
+
+def _return_int_date_keys(timestamps):
+    """
+    Returns int32 yyyymmdd date keys of datetime64 values, worked out from
+    their year, month and day as datetime64 arithmetic rather than by
+    formatting dates. Missing values are null in a nullable Int32 array.
+    """
+    days = np.asarray(timestamps, dtype="datetime64[D]")
+    months = days.astype("datetime64[M]")
+    years = days.astype("datetime64[Y]")
+    keys = (
+        (years.astype("int64") + 1970) * 10000
+        + ((months - years).astype("int64") + 1) * 100
+        + (days - months).astype("int64")
+        + 1
+    ).astype("int32")
+    missing = np.isnat(days)
+    if missing.any():
+        return pd.arrays.IntegerArray(keys, missing)
+    return keys
+
+
+def _return_df_dim_dates_from_dates(unique_dates, int_date_keys=False):
+    """
+    Produce the dim_dates table from an array of datetime64 days, with
+    int_date_keys keyed on int32 yyyymmdd keys
+    """
     # finalise dates in table
-    all_values = []
-    for x in list(df_reduced.values):
-        all_values += list(x)
-    unique_list_of_dates = list(set(all_values))
-    unique_list_of_dates.sort()
+    unique_list_of_dates = list(unique_dates.astype(str))
 
     months_dict = {
         1: "january",
@@ -108,24 +1343,24 @@ def _return_df_dim_dates(df_totesys_sales_order):
         "quarter",
     ]
     df_dim_dates = pd.DataFrame(data=data, columns=columns)
+    if int_date_keys:
+        df_dim_dates["date_id"] = _return_int_date_keys(unique_dates)
 
     df_dim_dates.set_index("date_id", inplace=True)
     return df_dim_dates
 
 
 def _return_df_dim_design(df_totesys_design):
-    ''' Returns the extrapolated data for the dim_design table '''
+    """Returns the extrapolated data for the dim_design table"""
 
     columns = ["design_id", "design_name", "file_location", "file_name"]
-    df_design_copy = copy(df_totesys_design)
-    df_reduced = df_design_copy.loc[:, columns]
-    df_reduced.set_index("design_id", inplace=True)
+    df_reduced = df_totesys_design.loc[:, columns].set_index("design_id")
 
     return df_reduced
 
 
 def _return_df_dim_location(df_totesys_address):
-    ''' Returns the extrapolated data for the dim_location table '''
+    """Returns the extrapolated data for the dim_location table"""
     columns = [
         "address_id",
         "address_line_1",
@@ -136,60 +1371,55 @@ def _return_df_dim_location(df_totesys_address):
         "country",
         "phone",
     ]
-    df_location_copy = copy(df_totesys_address)
-    df_reduced = df_location_copy.loc[:, columns]
-    df_reduced.rename(columns={"address_id": "location_id"}, inplace=True)
-    df_reduced.set_index("location_id", inplace=True)
+    df_reduced = (
+        df_totesys_address.loc[:, columns]
+        .rename(columns={"address_id": "location_id"})
+        .set_index("location_id")
+    )
 
     return df_reduced
 
 
 def _return_df_dim_counterparty(df_totesys_counterparty, df_totesys_address):
-    ''' Returns the extrapolated data for the dim_counterparty table '''
-    df_count = copy(
-        df_totesys_counterparty[
-            ["counterparty_id", "counterparty_legal_name", "legal_address_id"]
-        ]
-    )
-    df_addy = copy(
-        df_totesys_address[
-            [
-                "address_id",
-                "address_line_1",
-                "address_line_2",
-                "district",
-                "city",
-                "postal_code",
-                "country",
-                "phone",
-            ]
-        ]
-    )
-    df_merged = pd.merge(
-        df_count, df_addy, left_on="legal_address_id", right_on="address_id"
-    )
-    df_merged.rename(
-        columns={
-            "address_line_1": "counterparty_legal_address_line_1",
-            "address_line_2": "counterparty_legal_address_line_2",
-            "district": "counterparty_legal_district",
-            "city": "counterparty_legal_city",
-            "postal_code": "counterparty_legal_postal_code",
-            "country": "counterparty_legal_country",
-            "phone": "counterparty_legal_phone_number",
-        },
-        inplace=True,
+    """Returns the extrapolated data for the dim_counterparty table"""
+    df_count = df_totesys_counterparty.loc[
+        :, ["counterparty_id", "counterparty_legal_name", "legal_address_id"]
+    ]
+    df_addy = df_totesys_address.loc[
+        :,
+        [
+            "address_id",
+            "address_line_1",
+            "address_line_2",
+            "district",
+            "city",
+            "postal_code",
+            "country",
+            "phone",
+        ],
+    ]
+    df_merged = (
+        pd.merge(df_count, df_addy, left_on="legal_address_id", right_on="address_id")
+        .rename(
+            columns={
+                "address_line_1": "counterparty_legal_address_line_1",
+                "address_line_2": "counterparty_legal_address_line_2",
+                "district": "counterparty_legal_district",
+                "city": "counterparty_legal_city",
+                "postal_code": "counterparty_legal_postal_code",
+                "country": "counterparty_legal_country",
+                "phone": "counterparty_legal_phone_number",
+            }
+        )
+        .drop(columns=["address_id", "legal_address_id"])
+        .set_index("counterparty_id")
     )
-    df_merged.drop(["address_id"], axis=1, inplace=True)
-    df_merged.drop(["legal_address_id"], axis=1, inplace=True)
-
-    df_merged.set_index("counterparty_id", inplace=True)
 
     return df_merged
 
 
 def _return_df_dim_staff(df_totesys_staff, df_totesys_department):
-    ''' Returns the extrapolated data for the dim_staff table '''
+    """Returns the extrapolated data for the dim_staff table"""
     staff_columns = [
         "staff_id",
         "first_name",
@@ -199,13 +1429,9 @@ def _return_df_dim_staff(df_totesys_staff, df_totesys_department):
     ]
     department_columns = ["department_id", "department_name", "location"]
 
-    # Select and validate staff columns
-    df_staff_copy = copy(df_totesys_staff)
-    df_staff_reduced = df_staff_copy.loc[:, staff_columns]
-
-    # Select and validate department columns
-    df_department_copy = copy(df_totesys_department)
-    df_department_reduced = df_department_copy.loc[:, department_columns]
+    # Select staff and department columns
+    df_staff_reduced = df_totesys_staff.loc[:, staff_columns]
+    df_department_reduced = df_totesys_department.loc[:, department_columns]
 
     # Merge staff with department data
     df_merged = df_staff_reduced.merge(df_department_reduced, on="department_id")
@@ -219,32 +1445,163 @@ def _return_df_dim_staff(df_totesys_staff, df_totesys_department):
         "location",
         "email_address",
     ]
-    df_final = df_merged.loc[:, selected_columns]
-    df_final.set_index("staff_id", inplace=True)
+    df_final = df_merged.loc[:, selected_columns].set_index("staff_id")
 
     return df_final
 
 
 def _return_df_dim_currency(df_totesys_currency):
-    ''' Returns the extrapolated data for the dim_currency table '''
-    columns = ["currency_id", "currency_code", "currency_name"]
+    """Returns the extrapolated data for the dim_currency table"""
     currency_name_values = {
         "GBP": "Great British Pounds",
         "USD": "United States Dollars",
         "EUR": "Euro",
     }
-    df_currency_copy = copy(df_totesys_currency)
-    df_currency_copy["currency_name"] = df_currency_copy["currency_code"].map(
-        currency_name_values
-    )
-    df_reduced = df_currency_copy.loc[:, columns]
-    df_reduced.set_index("currency_id", inplace=True)
+    df_reduced = df_totesys_currency.loc[:, ["currency_id", "currency_code"]]
+    df_reduced["currency_name"] = df_reduced["currency_code"].map(currency_name_values)
+    df_reduced = df_reduced.set_index("currency_id")
+
+    return df_reduced
+
+
+def _return_df_dim_payment_type(df_totesys_payment_type):
+    """Returns the extrapolated data for the dim_payment_type table"""
+    columns = ["payment_type_id", "payment_type_name"]
+    df_reduced = df_totesys_payment_type.loc[:, columns].set_index("payment_type_id")
 
     return df_reduced
 
 
-def _return_df_fact_sales_order(df_totesys_sales_order):
-    ''' Returns the data for the fact_sales_order table '''
+def _return_df_dim_transaction(df_totesys_transaction):
+    """Returns the extrapolated data for the dim_transaction table"""
+    columns = [
+        "transaction_id",
+        "transaction_type",
+        "sales_order_id",
+        "purchase_order_id",
+    ]
+    df_reduced = df_totesys_transaction.loc[:, columns].set_index("transaction_id")
+
+    return df_reduced
+
+
+def _return_arrow_dates_and_times(timestamp_strings, int_date_keys=False):
+    """
+    Splits ISO timestamp strings into arrow date32 and time64 (millisecond
+    precision) series. The split is integer arithmetic on datetime64 values
+    rather than per-row date objects or strftime. With int_date_keys the
+    dates are int32 yyyymmdd keys instead.
+    """
+    timestamps = pd.to_datetime(timestamp_strings, format=SOURCE_TIMESTAMP_FORMAT)
+    missing = timestamps.isna().to_numpy()
+    nanoseconds = timestamps.to_numpy("datetime64[ns]").view("int64")
+    days = nanoseconds // NANOSECONDS_PER_DAY
+    milliseconds_of_day = (nanoseconds - days * NANOSECONDS_PER_DAY) // 1_000_000
+
+    if int_date_keys:
+        day_values = days.astype("datetime64[D]")
+        day_values[missing] = np.datetime64("NaT")
+        dates = pa.array(_return_int_date_keys(day_values))
+    else:
+        dates = pa.array(days.astype("int32"), mask=missing).cast(pa.date32())
+    times = pa.array(milliseconds_of_day * 1000, mask=missing).cast(pa.time64("us"))
+    return (
+        pd.Series(pd.arrays.ArrowExtensionArray(dates), index=timestamp_strings.index),
+        pd.Series(pd.arrays.ArrowExtensionArray(times), index=timestamp_strings.index),
+    )
+
+
+def _return_arrow_dates(date_strings):
+    """Parses YYYY-MM-DD strings into an arrow date32 series"""
+    dates = pd.to_datetime(date_strings, format="%Y-%m-%d")
+    return dates.astype(pd.ArrowDtype(pa.timestamp("ns"))).astype(
+        pd.ArrowDtype(pa.date32())
+    )
+
+
+def _add_df_dates_and_times(
+    df_fact, df_totesys_table, arrow_temporal=False, int_date_keys=False
+):
+    """
+    Adds the created and last_updated date and time columns of a fact table,
+    split from the created_at and last_updated timestamps of its source
+    table. With arrow_temporal they are arrow date32/time64 columns,
+    instead of strings. With int_date_keys the dates are int32 yyyymmdd
+    keys.
+    """
+    for source_column, target_column in [
+        ("created_at", "created"),
+        ("last_updated", "last_updated"),
+    ]:
+        if arrow_temporal:
+            dates, times = _return_arrow_dates_and_times(
+                df_totesys_table[source_column], int_date_keys
+            )
+        else:
+            timestamps = pd.to_datetime(df_totesys_table[source_column])
+            if int_date_keys:
+                dates = _return_int_date_keys(timestamps)
+            else:
+                dates = timestamps.dt.date.astype(str)
+            times = timestamps.dt.strftime("%H:%M:%S.%f").str[:-3]
+        df_fact[f"{target_column}_date"] = dates
+        df_fact[f"{target_column}_time"] = times
+
+
+def _convert_df_date_columns(
+    df_fact, columns, arrow_temporal=False, int_date_keys=False
+):
+    """
+    Converts the YYYY-MM-DD string date columns of a fact table to int32
+    yyyymmdd keys with int_date_keys, otherwise to arrow date32 columns with
+    arrow_temporal
+    """
+    for column in columns:
+        if int_date_keys:
+            df_fact[column] = _return_int_date_keys(
+                pd.to_datetime(df_fact[column], format="%Y-%m-%d")
+            )
+        elif arrow_temporal:
+            df_fact[column] = _return_arrow_dates(df_fact[column])
+
+
+def _convert_df_money_columns(df_fact, table_name):
+    """
+    Replaces the money columns of a fact table built from a dataframe by
+    decimal128 columns of their warehouse types, see fixed_point_money
+    """
+    for column in FIXED_POINT_MONEY_COLUMNS[table_name]:
+        df_fact[column] = pd.Series(
+            pd.arrays.ArrowExtensionArray(
+                return_money_decimals(table_name, column, df_fact[column])
+            ),
+            index=df_fact.index,
+        )
+
+
+def _return_df_fact_sales_order(
+    df_totesys_sales_order,
+    arrow_temporal=False,
+    first_record_id=1,
+    key_map=None,
+    int_date_keys=False,
+    gbp_rates_version=CURRENT_GBP_RATES_VERSION,
+    fixed_point_money=False,
+    record_ids=None,
+):
+    """
+    Returns the data for the fact_sales_order table.
+    With arrow_temporal the date and time columns are arrow date32/time64
+    columns split from the timestamps arithmetically, instead of strings.
+    With int_date_keys the date columns are int32 yyyymmdd keys.
+    sales_record_id counts up from first_record_id, so that a table built
+    in batches numbers its rows as a single build would, or is record_ids,
+    those of the rows of a shard, unless a SalesRecordKeyMap is passed to
+    assign stable keys. gross_value is
+    units_sold * unit_price and gross_value_gbp that converted to GBP at
+    the rates of gbp_rates_version. With fixed_point_money unit_price and
+    the measures are decimal128 columns worked out in integer pence.
+    """
     columns = [
         "sales_record_id",
         "sales_order_id",
@@ -261,33 +1618,165 @@ def _return_df_fact_sales_order(df_totesys_sales_order):
         "agreed_payment_date",
         "agreed_delivery_date",
         "agreed_delivery_location_id",
+        "gross_value",
+        "gross_value_gbp",
+    ]
+    source_columns = [
+        "sales_order_id",
+        "staff_id",
+        "counterparty_id",
+        "units_sold",
+        "unit_price",
+        "currency_id",
+        "design_id",
+        "agreed_payment_date",
+        "agreed_delivery_date",
+        "agreed_delivery_location_id",
     ]
-    df_sales_order_copy = copy(df_totesys_sales_order)
+    df_fact = df_totesys_sales_order.loc[:, source_columns].rename(
+        columns={"staff_id": "sales_staff_id"}
+    )
+    if key_map is not None:
+        df_fact["sales_record_id"] = key_map.assign(
+            df_totesys_sales_order["sales_order_id"],
+            df_totesys_sales_order["last_updated"],
+        )
+    elif record_ids is not None:
+        df_fact["sales_record_id"] = np.asarray(record_ids)
+    else:
+        df_fact["sales_record_id"] = range(
+            first_record_id, first_record_id + len(df_fact)
+        )
 
-    df_sales_order_copy["created_at"] = pd.to_datetime(
-        df_sales_order_copy["created_at"]
+    _add_df_dates_and_times(
+        df_fact, df_totesys_sales_order, arrow_temporal, int_date_keys
     )
-    df_sales_order_copy["last_updated"] = pd.to_datetime(
-        df_sales_order_copy["last_updated"]
+    _convert_df_date_columns(
+        df_fact,
+        ["agreed_payment_date", "agreed_delivery_date"],
+        arrow_temporal,
+        int_date_keys,
     )
-    df_sales_order_copy["sales_record_id"] = range(1, len(df_sales_order_copy) + 1)
+    if fixed_point_money:
+        measures = return_fixed_point_measures(
+            df_fact["units_sold"],
+            df_fact["unit_price"],
+            df_fact["currency_id"],
+            gbp_rates_version,
+        )
+        for column, values in measures.items():
+            df_fact[column] = pd.Series(
+                pd.arrays.ArrowExtensionArray(values), index=df_fact.index
+            )
+    else:
+        df_fact["gross_value"] = return_gross_values(
+            df_fact["units_sold"], df_fact["unit_price"]
+        )
+        df_fact["gross_value_gbp"] = return_gbp_values(
+            df_fact["gross_value"], df_fact["currency_id"], gbp_rates_version
+        )
 
-    df_sales_order_copy["created_date"] = df_sales_order_copy[
-        "created_at"
-    ].dt.date.astype(str)
-    df_sales_order_copy["created_time"] = (
-        df_sales_order_copy["created_at"].dt.strftime("%H:%M:%S.%f").str[:-3]
-    )
+    df_reduced = df_fact.loc[:, columns].set_index("sales_record_id")
 
-    df_sales_order_copy["last_updated_date"] = df_sales_order_copy[
-        "last_updated"
-    ].dt.date.astype(str)
-    df_sales_order_copy["last_updated_time"] = (
-        df_sales_order_copy["last_updated"].dt.strftime("%H:%M:%S.%f").str[:-3]
+    return df_reduced
+
+
+def _return_df_fact_purchase_order(
+    df_totesys_purchase_order, int_date_keys=False, fixed_point_money=False
+):
+    """
+    Returns the data for the fact_purchase_order table, purchase_record_id
+    counting up from 1. With int_date_keys the date columns are int32
+    yyyymmdd keys. With fixed_point_money item_unit_price is a decimal128
+    column.
+    """
+    columns = [
+        "purchase_record_id",
+        "purchase_order_id",
+        "created_date",
+        "created_time",
+        "last_updated_date",
+        "last_updated_time",
+        "staff_id",
+        "counterparty_id",
+        "item_code",
+        "item_quantity",
+        "item_unit_price",
+        "currency_id",
+        "agreed_delivery_date",
+        "agreed_payment_date",
+        "agreed_delivery_location_id",
+    ]
+    source_columns = [
+        "purchase_order_id",
+        "staff_id",
+        "counterparty_id",
+        "item_code",
+        "item_quantity",
+        "item_unit_price",
+        "currency_id",
+        "agreed_delivery_date",
+        "agreed_payment_date",
+        "agreed_delivery_location_id",
+    ]
+    df_fact = df_totesys_purchase_order.loc[:, source_columns]
+    df_fact["purchase_record_id"] = range(1, len(df_fact) + 1)
+    _add_df_dates_and_times(
+        df_fact, df_totesys_purchase_order, int_date_keys=int_date_keys
+    )
+    _convert_df_date_columns(
+        df_fact,
+        ["agreed_delivery_date", "agreed_payment_date"],
+        int_date_keys=int_date_keys,
     )
-    df_sales_order_copy["sales_staff_id"] = df_sales_order_copy["staff_id"]
+    if fixed_point_money:
+        _convert_df_money_columns(df_fact, "fact_purchase_order")
 
-    df_reduced = df_sales_order_copy.loc[:, columns]
-    df_reduced.set_index("sales_record_id", inplace=True)
+    df_reduced = df_fact.loc[:, columns].set_index("purchase_record_id")
 
-    return df_reduced
\ No newline at end of file
+    return df_reduced
+
+
+def _return_df_fact_payment(
+    df_totesys_payment, int_date_keys=False, fixed_point_money=False
+):
+    """
+    Returns the data for the fact_payment table, payment_record_id counting
+    up from 1. With int_date_keys the date columns are int32 yyyymmdd keys.
+    With fixed_point_money payment_amount is a decimal128 column.
+    """
+    columns = [
+        "payment_record_id",
+        "payment_id",
+        "created_date",
+        "created_time",
+        "last_updated_date",
+        "last_updated_time",
+        "transaction_id",
+        "counterparty_id",
+        "payment_amount",
+        "currency_id",
+        "payment_type_id",
+        "paid",
+        "payment_date",
+    ]
+    source_columns = [
+        "payment_id",
+        "transaction_id",
+        "counterparty_id",
+        "payment_amount",
+        "currency_id",
+        "payment_type_id",
+        "paid",
+        "payment_date",
+    ]
+    df_fact = df_totesys_payment.loc[:, source_columns]
+    df_fact["payment_record_id"] = range(1, len(df_fact) + 1)
+    _add_df_dates_and_times(df_fact, df_totesys_payment, int_date_keys=int_date_keys)
+    _convert_df_date_columns(df_fact, ["payment_date"], int_date_keys=int_date_keys)
+    if fixed_point_money:
+        _convert_df_money_columns(df_fact, "fact_payment")
+
+    df_reduced = df_fact.loc[:, columns].set_index("payment_record_id")
+
+    return df_reduced
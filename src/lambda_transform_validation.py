@@ -0,0 +1,173 @@
+import io
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from src.utils import return_s3_key
+from src.lambda_transform_lookup import DimensionLookup, _return_key_values
+from src.lambda_transform_money import return_too_wide_mask
+from src.warehouse_schema import (
+    WAREHOUSE_ARROW_SCHEMAS,
+    WAREHOUSE_COLUMN_TYPES,
+    WAREHOUSE_NULLABLE_COLUMNS,
+    WAREHOUSE_FOREIGN_KEYS,
+)
+
+
+# Pre-load validation of the built tables against the constraints of the
+# warehouse DDL, so that a bad row is set aside in transform rather than
+# aborting the COPY of its whole table in load. Each rule is one vectorised
+# pass over a column: NOT NULL columns are checked with is_null, primary
+# keys for repeats with a hash of the key column, and fact foreign keys
+# against the DimensionLookup hash index of the dimension they reference,
+# built once per run and reused for every fact and batch. Rows breaking any
+# rule are written to a quarantine parquet file with the rules they break,
+# the rest are written as usual. Decimal columns are checked for values
+# with more digits than their NUMERIC precision, which fixed_point_money
+# builds without a cast to check them.
+#
+# Dimensions are validated first and record the keys of their valid rows,
+# so facts referencing a quarantined dimension row are quarantined too.
+# The primary keys of every table's valid rows are kept for the run, so a
+# key repeated across the batches of a chunked build, or the shards of a
+# sharded one, is quarantined as a repeat within one table would be.
+# Foreign keys to a dimension without recorded keys are not checked: that
+# is dim_date in chunked mode, built from the fact rows themselves.
+
+QUARANTINE_REASON_COLUMN = "quarantine_reason"
+
+
+def _return_column(df_table, column_name):
+    """
+    Returns a column of a built table as an arrow array: a column of an
+    arrow table, or a column or the named index of a dataframe
+    """
+    if isinstance(df_table, pa.Table):
+        return df_table[column_name].combine_chunks()
+    if column_name == df_table.index.name:
+        return pa.array(df_table.index.to_series(), from_pandas=True)
+    return pa.array(df_table[column_name], from_pandas=True)
+
+
+def _return_null_mask(df_table, column_name):
+    """Returns a boolean array of the rows of a built table null in a column"""
+    if isinstance(df_table, pa.Table):
+        is_null = pc.is_null(df_table[column_name], nan_is_null=True)
+        return is_null.to_numpy(zero_copy_only=False)
+    if column_name == df_table.index.name:
+        return df_table.index.isna()
+    return df_table[column_name].isna().to_numpy()
+
+
+class ReferenceValidator:
+    """
+    Validates built warehouse tables against the NOT NULL, PRIMARY KEY,
+    REFERENCES and NUMERIC precision rules of the warehouse DDL, keeping
+    the primary keys of the valid rows of each dimension for the facts that
+    reference it, and of every table for its later batches
+    """
+
+    def __init__(self):
+        self.lookups = {}
+        self.primary_keys = {}
+
+    def add_dimension_keys(self, table_name, keys):
+        """Records the keys of a dimension as a DimensionLookup"""
+        self.lookups[table_name] = DimensionLookup(table_name, keys)
+
+    def read_dimension_keys(self, s3_client, bucket_name, table_name, datetime_string):
+        """
+        Records the key set of a dimension not built this run from its output
+        in the processed bucket
+        """
+        primary_key = next(iter(WAREHOUSE_COLUMN_TYPES[table_name]))
+        response = s3_client.get_object(
+            Bucket=bucket_name,
+            Key=return_s3_key(table_name, datetime_string, extension=".parquet"),
+        )
+        table = pq.read_table(
+            io.BytesIO(response["Body"].read()), columns=[primary_key]
+        )
+        self.add_dimension_keys(table_name, table[primary_key].combine_chunks())
+
+    def validate(self, table_name, df_table):
+        """
+        Returns the valid rows of a built table (dataframe or arrow table) and
+        its invalid rows with a quarantine_reason column listing the rules
+        each breaks, None if every row is valid. The keys of a dimension's
+        valid rows are recorded.
+        """
+        columns = WAREHOUSE_COLUMN_TYPES.get(table_name)
+        if columns is None:
+            return df_table, None
+        primary_key = next(iter(columns))
+        nullable = WAREHOUSE_NULLABLE_COLUMNS.get(table_name, [])
+        foreign_keys = WAREHOUSE_FOREIGN_KEYS.get(table_name, {})
+
+        rule_masks = []
+        for column_name in columns:
+            is_null = _return_null_mask(df_table, column_name)
+            if column_name not in nullable:
+                rule_masks.append((f"{column_name} is null", is_null))
+            if column_name == primary_key:
+                keys = pd.Index(
+                    np.asarray(
+                        _return_key_values(_return_column(df_table, column_name))
+                    )
+                )
+                repeated = keys.duplicated(keep="first")
+                if table_name in self.primary_keys:
+                    repeated |= keys.isin(self.primary_keys[table_name])
+                rule_masks.append((f"{column_name} is repeated", repeated))
+            arrow_type = WAREHOUSE_ARROW_SCHEMAS[table_name].field(column_name).type
+            if pa.types.is_decimal(arrow_type):
+                too_wide = return_too_wide_mask(
+                    _return_column(df_table, column_name), arrow_type
+                )
+                sql_type = columns[column_name]
+                rule_masks.append((f"{column_name} does not fit {sql_type}", too_wide))
+            dimension = foreign_keys.get(column_name)
+            if dimension in self.lookups:
+                found = self.lookups[dimension].contains(
+                    _return_column(df_table, column_name)
+                )
+                missing = ~found & ~is_null
+                rule_masks.append((f"{column_name} not in {dimension}", missing))
+
+        invalid = np.zeros(len(df_table), dtype=bool)
+        reasons = np.full(len(df_table), "", dtype=object)
+        for rule, mask in rule_masks:
+            if mask.any():
+                reasons[mask & invalid] += "; "
+                reasons[mask] += rule
+                invalid |= mask
+
+        df_quarantine = None
+        if invalid.any():
+            if isinstance(df_table, pa.Table):
+                df_quarantine = df_table.filter(pa.array(invalid)).append_column(
+                    QUARANTINE_REASON_COLUMN,
+                    pa.array(reasons[invalid].astype(str), pa.string()),
+                )
+                df_table = df_table.filter(pa.array(~invalid))
+            else:
+                df_quarantine = df_table[invalid].assign(
+                    **{QUARANTINE_REASON_COLUMN: reasons[invalid].astype(str)}
+                )
+                df_table = df_table[~invalid]
+
+        self.record_primary_keys(table_name, keys[~invalid])
+        if table_name not in WAREHOUSE_FOREIGN_KEYS:
+            self.add_dimension_keys(table_name, _return_column(df_table, primary_key))
+        return df_table, df_quarantine
+
+    def record_primary_keys(self, table_name, keys):
+        """
+        Adds primary keys of valid rows to those of the table validated so
+        far, which later batches of the table must not repeat
+        """
+        keys = pd.Index(np.asarray(keys))
+        if table_name in self.primary_keys:
+            keys = self.primary_keys[table_name].append(keys)
+        self.primary_keys[table_name] = keys
@@ -1,6 +1,8 @@
+import io
 import json
 from datetime import datetime, date
 from botocore.exceptions import ClientError, NoCredentialsError
+import numpy as np
 import pandas as pd
 from pg8000.native import Connection
 from pg8000.exceptions import DatabaseError
@@ -81,6 +83,75 @@ def write_table_to_s3(s3_client, bucket_name, table, rows, columns, date_and_tim
         return None
 
 
+def return_key_index_s3_key(table_name, datetime_string):
+    """Key of the primary key index stored next to a snapshot"""
+    return f"data/{datetime_string}/{table_name}.keys.npz"
+
+
+def return_key_index(keys):
+    """Returns the sorted distinct int64 primary keys of a snapshot"""
+    return np.unique(np.asarray(keys, dtype="int64"))
+
+
+def get_primary_keys_from_table(conn, table, primary_key):
+    """
+    Fetches every primary key of a database table, whichever of its rows a
+    snapshot holds. Returns None if they cannot be read.
+    """
+    try:
+        return [row[0] for row in conn.run(f"SELECT {primary_key} FROM {table}")]
+    except Exception as e:
+        print(f"Error querying {table} primary keys: {e}")
+        return None
+
+
+def write_key_index_to_s3(s3_client, bucket_name, table, keys, date_and_time):
+    """
+    Writes the sorted primary keys of a source table next to its snapshot.
+    keys are every key in the table, as get_primary_keys_from_table reads
+    them, not only those of the rows in the snapshot: state rows missing
+    from the index are deleted, so an index of a delta snapshot's rows
+    would delete every unchanged row. Keys are stored as the differences
+    between consecutive keys, mostly 1s, which compress to a few bytes per
+    thousand keys.
+    """
+    try:
+        if keys is None:
+            return None
+        key_index = return_key_index(keys)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, key_steps=np.diff(key_index, prepend=0))
+        key = return_key_index_s3_key(table, date_and_time)
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=buffer.getvalue())
+        return key
+    except (ClientError, NoCredentialsError, ValueError, Exception) as e:
+        print(f"Error writing {table} key index to S3: {e}")
+        return None
+
+
+def read_key_index(s3_client, bucket_name, table, datetime_string):
+    """Returns the key index of a snapshot, None if it has none"""
+    try:
+        response = s3_client.get_object(
+            Bucket=bucket_name, Key=return_key_index_s3_key(table, datetime_string)
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return None
+        raise
+    with np.load(io.BytesIO(response["Body"].read())) as arrays:
+        return np.cumsum(arrays["key_steps"])
+
+
+def return_missing_keys(key_index, keys):
+    """Returns a boolean mask of the keys that are not in a key index"""
+    keys = np.asarray(keys, dtype="int64")
+    if len(key_index) == 0:
+        return np.ones(len(keys), dtype=bool)
+    positions = np.minimum(np.searchsorted(key_index, keys), len(key_index) - 1)
+    return key_index[positions] != keys
+
+
 def log_file(s3_client, bucket_name, keys):
     """Logs file upload details and writes to S3."""
     try:
@@ -152,6 +223,35 @@ def return_s3_key(table_name, datetime_string, extension=".json"):
     return f"data/{datetime_string}/{table_name}{extension}"
 
 
+def return_partition_s3_key(
+    table_name, datetime_string, partition_column, partition_value, part_number=0
+):
+    """Key of one parquet part of a partitioned table, in hive layout"""
+    return (
+        f"data/{datetime_string}/{table_name}/"
+        f"{partition_column}={partition_value}/part-{part_number}.parquet"
+    )
+
+
+def return_part_s3_key(table_name, datetime_string, part_number):
+    """Key of one parquet part of a table written in shards"""
+    return f"data/{datetime_string}/{table_name}/part-{part_number}.parquet"
+
+
+def return_manifest_s3_key(datetime_string):
+    return f"data/{datetime_string}/manifest.json"
+
+
+def return_change_s3_key(table_name, datetime_string, change_kind):
+    """Key of the inserted, updated or deleted rows of a snapshot diff"""
+    return f"data/{datetime_string}/changes/{table_name}/{change_kind}.parquet"
+
+
+def return_quarantine_s3_key(table_name, datetime_string):
+    """Key of the rows of a built table that failed pre-load validation"""
+    return f"data/{datetime_string}/quarantine/{table_name}.parquet"
+
+
 def return_datetime_string():
     timestamp = datetime.now()
     year, month, day, hour, minute = (
@@ -162,3 +262,18 @@ def return_datetime_string():
         timestamp.minute,
     )
     return f"{year}-{month}-{day}_{hour}-{minute}"
+
+
+# formats of the datetime strings naming snapshots: lambda_extract's and
+# return_datetime_string's
+DATETIME_STRING_FORMATS = ["%Y%m%d_%H%M%S", "%Y-%m-%d_%H-%M"]
+
+
+def parse_datetime_string(datetime_string):
+    """Parses a snapshot's datetime string, None for other strings"""
+    for datetime_format in DATETIME_STRING_FORMATS:
+        try:
+            return datetime.strptime(datetime_string, datetime_format)
+        except ValueError:
+            continue
+    return None
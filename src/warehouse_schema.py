@@ -0,0 +1,357 @@
+import re
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+# SQL column types of the warehouse tables, as declared in
+# db/build-data-wh.sql (which is not deployed with the lambdas).
+# test_warehouse_schema checks the two agree, regenerate this with
+# parse_create_tables when the DDL changes.
+WAREHOUSE_COLUMN_TYPES = {
+    "dim_date": {
+        "date_id": "DATE",
+        "year": "INT",
+        "month": "INT",
+        "day": "INT",
+        "day_of_week": "INT",
+        "day_name": "VARCHAR",
+        "month_name": "VARCHAR",
+        "quarter": "INT",
+    },
+    "dim_staff": {
+        "staff_id": "INT",
+        "first_name": "VARCHAR",
+        "last_name": "VARCHAR",
+        "department_name": "VARCHAR",
+        "location": "VARCHAR",
+        "email_address": "VARCHAR",
+    },
+    "dim_location": {
+        "location_id": "INT",
+        "address_line_1": "VARCHAR",
+        "address_line_2": "VARCHAR",
+        "district": "VARCHAR",
+        "city": "VARCHAR",
+        "postal_code": "VARCHAR",
+        "country": "VARCHAR",
+        "phone": "VARCHAR",
+    },
+    "dim_currency": {
+        "currency_id": "INT",
+        "currency_code": "VARCHAR",
+        "currency_name": "VARCHAR",
+    },
+    "dim_design": {
+        "design_id": "INT",
+        "design_name": "VARCHAR",
+        "file_location": "VARCHAR",
+        "file_name": "VARCHAR",
+    },
+    "dim_counterparty": {
+        "counterparty_id": "INT",
+        "counterparty_legal_name": "VARCHAR",
+        "counterparty_legal_address_line_1": "VARCHAR",
+        "counterparty_legal_address_line_2": "VARCHAR",
+        "counterparty_legal_district": "VARCHAR",
+        "counterparty_legal_city": "VARCHAR",
+        "counterparty_legal_postal_code": "VARCHAR",
+        "counterparty_legal_country": "VARCHAR",
+        "counterparty_legal_phone_number": "VARCHAR",
+    },
+    "dim_payment_type": {
+        "payment_type_id": "SERIAL",
+        "payment_type_name": "VARCHAR",
+    },
+    "dim_transaction": {
+        "transaction_id": "INT",
+        "transaction_type": "VARCHAR",
+        "sales_order_id": "INT",
+        "purchase_order_id": "INT",
+    },
+    "fact_sales_order": {
+        "sales_record_id": "SERIAL",
+        "sales_order_id": "INT",
+        "created_date": "DATE",
+        "created_time": "TIME",
+        "last_updated_date": "DATE",
+        "last_updated_time": "TIME",
+        "sales_staff_id": "INT",
+        "counterparty_id": "INT",
+        "units_sold": "INT",
+        "unit_price": "NUMERIC(10,2)",
+        "currency_id": "INT",
+        "design_id": "INT",
+        "agreed_payment_date": "DATE",
+        "agreed_delivery_date": "DATE",
+        "agreed_delivery_location_id": "INT",
+        "gross_value": "NUMERIC(12,2)",
+        "gross_value_gbp": "NUMERIC(12,2)",
+    },
+    "fact_purchase_order": {
+        "purchase_record_id": "SERIAL",
+        "purchase_order_id": "INT",
+        "created_date": "DATE",
+        "created_time": "TIME",
+        "last_updated_date": "DATE",
+        "last_updated_time": "TIME",
+        "staff_id": "INT",
+        "counterparty_id": "INT",
+        "item_code": "VARCHAR",
+        "item_quantity": "INT",
+        "item_unit_price": "NUMERIC",
+        "currency_id": "INT",
+        "agreed_delivery_date": "DATE",
+        "agreed_payment_date": "DATE",
+        "agreed_delivery_location_id": "INT",
+    },
+    "fact_payment": {
+        "payment_record_id": "SERIAL",
+        "payment_id": "INT",
+        "created_date": "DATE",
+        "created_time": "TIME",
+        "last_updated_date": "DATE",
+        "last_updated_time": "TIME",
+        "transaction_id": "INT",
+        "counterparty_id": "INT",
+        "payment_amount": "NUMERIC",
+        "currency_id": "INT",
+        "payment_type_id": "INT",
+        "paid": "BOOLEAN",
+        "payment_date": "DATE",
+    },
+}
+
+# columns of the warehouse tables that may be NULL, every other column is
+# declared NOT NULL or PRIMARY KEY
+WAREHOUSE_NULLABLE_COLUMNS = {
+    "dim_location": ["address_line_2", "district"],
+    "dim_counterparty": [
+        "counterparty_legal_address_line_2",
+        "counterparty_legal_district",
+    ],
+    "dim_transaction": ["sales_order_id", "purchase_order_id"],
+    "fact_sales_order": ["gross_value_gbp"],
+}
+
+# the dimension each foreign key column of the fact tables REFERENCES, by
+# the dimension's primary key (its first column)
+WAREHOUSE_FOREIGN_KEYS = {
+    "fact_sales_order": {
+        "created_date": "dim_date",
+        "last_updated_date": "dim_date",
+        "sales_staff_id": "dim_staff",
+        "counterparty_id": "dim_counterparty",
+        "currency_id": "dim_currency",
+        "design_id": "dim_design",
+        "agreed_payment_date": "dim_date",
+        "agreed_delivery_date": "dim_date",
+        "agreed_delivery_location_id": "dim_location",
+    },
+    "fact_purchase_order": {
+        "created_date": "dim_date",
+        "last_updated_date": "dim_date",
+        "staff_id": "dim_staff",
+        "counterparty_id": "dim_counterparty",
+        "currency_id": "dim_currency",
+        "agreed_delivery_date": "dim_date",
+        "agreed_payment_date": "dim_date",
+        "agreed_delivery_location_id": "dim_location",
+    },
+    "fact_payment": {
+        "created_date": "dim_date",
+        "last_updated_date": "dim_date",
+        "transaction_id": "dim_transaction",
+        "counterparty_id": "dim_counterparty",
+        "currency_id": "dim_currency",
+        "payment_type_id": "dim_payment_type",
+        "payment_date": "dim_date",
+    },
+}
+
+# the date key columns of each warehouse table: dim_date's primary key and
+# the fact columns referencing it. With the transform's int_date_keys option
+# they are int32 yyyymmdd smart keys (20221103 for 2022-11-03) instead of
+# DATEs, as declared INT in db/build-data-wh-int-date-keys.sql.
+WAREHOUSE_DATE_KEY_COLUMNS = {
+    "dim_date": ["date_id"],
+    **{
+        table_name: [
+            column_name
+            for column_name, dimension in foreign_keys.items()
+            if dimension == "dim_date"
+        ]
+        for table_name, foreign_keys in WAREHOUSE_FOREIGN_KEYS.items()
+    },
+}
+
+# numpy dtype holding each SQL integer type
+SQL_INTEGER_DTYPES = {
+    "SMALLINT": "int16",
+    "INT": "int32",
+    "INTEGER": "int32",
+    "SERIAL": "int32",
+    "BIGINT": "int64",
+    "BIGSERIAL": "int64",
+}
+
+# arrow type of each SQL type, NUMERIC(precision,scale) is a decimal128 of
+# the same precision and scale. Unconstrained NUMERIC has no fixed scale;
+# its columns hold money (item_unit_price, payment_amount), at most two
+# decimal places in the source, so it is the widest decimal128 of scale 2.
+SQL_ARROW_TYPES = {
+    "SMALLINT": pa.int16(),
+    "INT": pa.int32(),
+    "INTEGER": pa.int32(),
+    "SERIAL": pa.int32(),
+    "BIGINT": pa.int64(),
+    "BIGSERIAL": pa.int64(),
+    "NUMERIC": pa.decimal128(38, 2),
+    "VARCHAR": pa.string(),
+    "BOOLEAN": pa.bool_(),
+    "DATE": pa.date32(),
+    "TIME": pa.time64("us"),
+}
+
+
+def _return_create_table_lines(ddl):
+    """Yields the table name and column definition lines of each CREATE TABLE"""
+    for table_name, body in re.findall(
+        r"CREATE TABLE (\w+) \((.*?)\n\);", ddl, flags=re.DOTALL
+    ):
+        yield table_name, [line.strip() for line in body.strip().splitlines()]
+
+
+def parse_create_tables(ddl):
+    """
+    Returns {table name: {column name: SQL type}} for the CREATE TABLE
+    statements of a DDL script
+    """
+    tables = {}
+    for table_name, lines in _return_create_table_lines(ddl):
+        columns = {}
+        for line in lines:
+            column_name, column_type = line.split()[:2]
+            columns[column_name] = column_type.rstrip(",")
+        tables[table_name] = columns
+    return tables
+
+
+def parse_nullable_columns(ddl):
+    """
+    Returns {table name: [column name]} of the columns of a DDL script
+    declared neither NOT NULL nor PRIMARY KEY, for tables that have any
+    """
+    tables = {}
+    for table_name, lines in _return_create_table_lines(ddl):
+        nullable = [
+            line.split()[0]
+            for line in lines
+            if "NOT NULL" not in line and "PRIMARY KEY" not in line
+        ]
+        if nullable:
+            tables[table_name] = nullable
+    return tables
+
+
+def parse_foreign_keys(ddl):
+    """
+    Returns {table name: {column name: referenced table}} of the REFERENCES
+    clauses of a DDL script, for tables that have any
+    """
+    tables = {}
+    for table_name, lines in _return_create_table_lines(ddl):
+        references = {}
+        for line in lines:
+            match = re.search(r"REFERENCES (\w+)\(", line)
+            if match:
+                references[line.split()[0]] = match.group(1)
+        if references:
+            tables[table_name] = references
+    return tables
+
+
+def return_integer_dtype(table_name, column_name):
+    """
+    Returns the numpy dtype of an integer warehouse column, None for columns
+    that are not integers or not in the warehouse schema
+    """
+    sql_type = WAREHOUSE_COLUMN_TYPES.get(table_name, {}).get(column_name)
+    if sql_type is None:
+        return None
+    dtype = SQL_INTEGER_DTYPES.get(sql_type)
+    return np.dtype(dtype) if dtype is not None else None
+
+
+def return_arrow_type(sql_type):
+    """Returns the arrow type of a SQL column type"""
+    decimal = re.fullmatch(r"NUMERIC\((\d+),(\d+)\)", sql_type)
+    if decimal:
+        return pa.decimal128(int(decimal.group(1)), int(decimal.group(2)))
+    return SQL_ARROW_TYPES[sql_type]
+
+
+# arrow schema of each warehouse table, the canonical column names, order
+# and types of the transform outputs and of the columns load copies
+WAREHOUSE_ARROW_SCHEMAS = {
+    table_name: pa.schema(
+        [
+            (column_name, return_arrow_type(sql_type))
+            for column_name, sql_type in columns.items()
+        ]
+    )
+    for table_name, columns in WAREHOUSE_COLUMN_TYPES.items()
+}
+
+# the same schemas with the date key columns as int32 yyyymmdd keys
+WAREHOUSE_INT_DATE_KEY_ARROW_SCHEMAS = {
+    table_name: pa.schema(
+        [
+            (
+                pa.field(field.name, pa.int32())
+                if field.name in WAREHOUSE_DATE_KEY_COLUMNS.get(table_name, [])
+                else field
+            )
+            for field in schema
+        ]
+    )
+    for table_name, schema in WAREHOUSE_ARROW_SCHEMAS.items()
+}
+
+
+def _cast_column(column, arrow_type):
+    """Casts one column of a built table to its warehouse arrow type"""
+    if pa.types.is_dictionary(column.type):
+        column = column.cast(column.type.value_type)
+    if column.type == arrow_type:
+        return column
+    if pa.types.is_time(arrow_type) and pa.types.is_string(column.type):
+        # arrow casts ISO timestamps from strings, but not times of day
+        timestamps = pc.binary_join_element_wise("1970-01-01 ", column, "")
+        return timestamps.cast(pa.timestamp("us")).cast(arrow_type)
+    return column.cast(arrow_type)
+
+
+def cast_to_warehouse_schema(table_name, df_file):
+    """
+    Returns a built table (dataframe or arrow table) as an arrow table of
+    its warehouse schema in WAREHOUSE_ARROW_SCHEMAS: the table's columns in
+    schema order, with date and time strings as date32 / time64, prices as
+    decimals and integers at the width of their SQL type. A dataframe's
+    named index is one of its columns. A table built with int_date_keys,
+    its date keys integers, is cast to WAREHOUSE_INT_DATE_KEY_ARROW_SCHEMAS
+    instead. Tables without a warehouse schema are returned unchanged.
+    """
+    schema = WAREHOUSE_ARROW_SCHEMAS.get(table_name)
+    if schema is None:
+        return df_file
+    if isinstance(df_file, pd.DataFrame):
+        df_file = pa.Table.from_pandas(df_file)
+    date_keys = WAREHOUSE_DATE_KEY_COLUMNS.get(table_name)
+    if date_keys and pa.types.is_integer(df_file.schema.field(date_keys[0]).type):
+        schema = WAREHOUSE_INT_DATE_KEY_ARROW_SCHEMAS[table_name]
+    return pa.table(
+        [_cast_column(df_file[field.name], field.type) for field in schema],
+        schema=schema,
+    )
@@ -37,6 +37,18 @@ data "archive_file" "lambda_load_package" {
     content = file("${path.module}/../../src/lambda_transform_utils.py")
     filename = "src/lambda_transform_utils.py"
   }
+  source {
+    content = file("${path.module}/../../src/warehouse_schema.py")
+    filename = "src/warehouse_schema.py"
+  }
+  source {
+    content = file("${path.module}/../../src/lambda_transform_rates.py")
+    filename = "src/lambda_transform_rates.py"
+  }
+  source {
+    content = file("${path.module}/../../src/lambda_transform_money.py")
+    filename = "src/lambda_transform_money.py"
+  }
 }
 
 
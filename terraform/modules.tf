@@ -17,6 +17,7 @@ module "transform_module" {
   lambda_extract_handler   = var.lambda_extract_handler
   lambda_transform_handler = var.lambda_transform_handler
   lambda_load_handler = var.lambda_load_handler
+  transform_engine         = var.transform_engine
 }
 
 module "load_module" {
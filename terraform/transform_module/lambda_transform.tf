@@ -12,6 +12,16 @@ resource "aws_lambda_function" "lambda_transform_handler" {
     variables = {
       INGESTION_BUCKET = "totesys-ingestion-zone-fenor"
       PROCESSED_BUCKET = "totesys-processed-zone-fenor"
+      TRANSFORM_REUSE_OUTPUTS = "true"
+      TRANSFORM_STABLE_KEYS = "true"
+      TRANSFORM_COMPACT_DTYPES = "true"
+      TRANSFORM_WAREHOUSE_TYPES = "true"
+      TRANSFORM_LATEST_VERSIONS = "true"
+      TRANSFORM_SNAPSHOT_DIFF = "true"
+      TRANSFORM_ALL_TABLES = "true"
+      TRANSFORM_VALIDATE_REFERENCES = "true"
+      TRANSFORM_FIXED_POINT_MONEY = "true"
+      TRANSFORM_ENGINE = var.transform_engine
     }
   }
 }
@@ -37,18 +47,70 @@ data "archive_file" "lambda_transform_package" {
     content = file("${path.module}/../../src/lambda_transform_utils.py")
     filename = "src/lambda_transform_utils.py"
   }
+  source {
+    content = file("${path.module}/../../src/lambda_transform_arrow.py")
+    filename = "src/lambda_transform_arrow.py"
+  }
+  source {
+    content = file("${path.module}/../../src/lambda_transform_duckdb.py")
+    filename = "src/lambda_transform_duckdb.py"
+  }
+  source {
+    content = file("${path.module}/../../src/lambda_transform_keys.py")
+    filename = "src/lambda_transform_keys.py"
+  }
+  source {
+    content = file("${path.module}/../../src/lambda_transform_state.py")
+    filename = "src/lambda_transform_state.py"
+  }
+  source {
+    content = file("${path.module}/../../src/lambda_transform_diff.py")
+    filename = "src/lambda_transform_diff.py"
+  }
+  source {
+    content = file("${path.module}/../../src/warehouse_schema.py")
+    filename = "src/warehouse_schema.py"
+  }
+  source {
+    content = file("${path.module}/../../src/lambda_transform_validation.py")
+    filename = "src/lambda_transform_validation.py"
+  }
+  source {
+    content = file("${path.module}/../../src/lambda_transform_lookup.py")
+    filename = "src/lambda_transform_lookup.py"
+  }
+  source {
+    content = file("${path.module}/../../src/lambda_transform_rates.py")
+    filename = "src/lambda_transform_rates.py"
+  }
+  source {
+    content = file("${path.module}/../../src/lambda_transform_money.py")
+    filename = "src/lambda_transform_money.py"
+  }
+  source {
+    content = file("${path.module}/../../src/lambda_transform_shards.py")
+    filename = "src/lambda_transform_shards.py"
+  }
 }
 
 
 # Layers 
 # Added AWS SDK Pandas arn to lambda function  
+# duckdb is only installed in the layer when the duckdb engine is deployed
+
+locals {
+  transform_requirements = concat(
+    ["${path.module}/requirements.txt"],
+    var.transform_engine == "duckdb" ? ["${path.module}/requirements_duckdb.txt"] : []
+  )
+}
 
 resource "null_resource" "pip_install" {
   triggers = {
-    shell_hash = "${sha256(file("${path.module}/requirements.txt"))}"
+    shell_hash = sha256(join("", [for f in local.transform_requirements : file(f)]))
   }
   provisioner "local-exec" {
-    command = "python3 -m pip install -r ${path.module}/requirements.txt -t ${path.module}/${var.lambda_transform_handler}_layer/python"
+    command = "rm -rf ${path.module}/${var.lambda_transform_handler}_layer/python && python3 -m pip install ${join(" ", [for f in local.transform_requirements : "-r ${f}"])} -t ${path.module}/${var.lambda_transform_handler}_layer/python"
   }
 }
 
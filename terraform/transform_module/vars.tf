@@ -33,3 +33,8 @@ variable "lambda_transform_handler" {
 variable "lambda_load_handler" {
   type = string
 }
+
+variable "transform_engine" {
+  type    = string
+  default = "pandas"
+}
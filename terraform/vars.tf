@@ -57,6 +57,12 @@ variable "lambda_load_handler" {
   default = "lambda_load_handler"
 }
 
+# pandas, arrow or duckdb; only the duckdb engine packages duckdb
+variable "transform_engine" {
+  type    = string
+  default = "pandas"
+}
+
 # Step Functions State Machine
 
 variable "totesys_etl_pipeline" {
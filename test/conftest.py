@@ -0,0 +1,48 @@
+import pytest
+import boto3
+from moto import mock_aws
+from src.utils import return_datetime_string, return_s3_key
+
+
+INGESTION_BUCKET = "dummy-ingestion-bucket"
+PROCESSED_BUCKET = "dummy-processing-bucket"
+# the ingestion tables of the star schema, and those of the whole schema
+TOTESYS_TABLES = [
+    "address",
+    "counterparty",
+    "currency",
+    "department",
+    "design",
+    "sales_order",
+    "staff",
+]
+ALL_TOTESYS_TABLES = sorted(
+    TOTESYS_TABLES + ["payment", "payment_type", "purchase_order", "transaction"]
+)
+
+
+@pytest.fixture()
+def s3_client_ingestion_populated(monkeypatch):
+    """
+    Mocked ingestion and processed buckets, with a snapshot of every
+    ingestion table from data/json_files. Yields the client and the
+    snapshot's datetime string.
+    """
+    with mock_aws():
+        s3 = boto3.client("s3")
+        for bucket in [INGESTION_BUCKET, PROCESSED_BUCKET]:
+            s3.create_bucket(
+                Bucket=bucket,
+                CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+            )
+        datetime_string = return_datetime_string()
+        for table_name in ALL_TOTESYS_TABLES:
+            with open(f"data/json_files/{table_name}.json", "rb") as f:
+                s3.put_object(
+                    Bucket=INGESTION_BUCKET,
+                    Key=return_s3_key(table_name, datetime_string),
+                    Body=f.read(),
+                )
+        monkeypatch.setenv("INGESTION_BUCKET", INGESTION_BUCKET)
+        monkeypatch.setenv("PROCESSED_BUCKET", PROCESSED_BUCKET)
+        yield s3, datetime_string
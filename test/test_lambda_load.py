@@ -1,11 +1,32 @@
 import os
+import io
 import pytest
 import boto3
 import psycopg2
+import json
+import decimal
+import pandas as pd
 from unittest.mock import MagicMock, patch
 from moto import mock_aws
 
-from src.lambda_load import load_connection_psycopg2, lambda_handler, dw_cleanup
+from src.lambda_load import (
+    load_connection_psycopg2,
+    lambda_handler,
+    dw_cleanup,
+    return_tables_to_load,
+    read_parquet_table,
+    copy_table,
+    return_processed_tables,
+    return_load_watermark,
+    read_load_watermark,
+    LIST_OF_TABLES,
+    LOAD_WATERMARK_S3_KEY,
+)
+from src.lambda_transform import lambda_handler as transform_handler
+from src.warehouse_schema import WAREHOUSE_ARROW_SCHEMAS, WAREHOUSE_FOREIGN_KEYS
+from src.lambda_transform_utils import _return_df_fact_sales_order
+from src.utils import return_s3_key
+from conftest import PROCESSED_BUCKET
 
 
 @pytest.fixture(scope="function", autouse=True)
@@ -119,16 +140,12 @@ class TestDbConnection:
 
         assert isinstance(conn, psycopg2.extensions.connection)
 
-
     def test_db_exception_if_failure_of_credentials(self):
-        dw_fake_creds = {
-            'fake': 'credentials'
-        }
+        dw_fake_creds = {"fake": "credentials"}
 
         with pytest.raises(Exception):
             conn = load_connection_psycopg2(dw_fake_creds)
 
-
     def test_db_exception_if_failure_of_credentials(self):
         dw_access = {
             "dbname": "test",
@@ -143,10 +160,321 @@ class TestDbConnection:
 
 
 class TestLambdaHandler:
-    
+
     def test_lambda_handler(self, postgres_test_db, mock_s3):
         event = {}
-        event['datetime_string'] = 'data/'
-        test_result = lambda_handler(event,{})
+        event["datetime_string"] = "data/"
+        test_result = lambda_handler(event, {})
+
+        assert test_result["message"] == "Successfully uploaded to data warehouse"
+
+
+# every table loaded from the run "before"
+LOADED_BEFORE = {
+    table: {"datetime_string": "before", "content_from": "before"}
+    for table in LIST_OF_TABLES
+}
+
+
+class TestReturnTablesToLoad:
+    def test_all_tables_without_manifest_or_on_full_reload(self):
+        manifest = {
+            "tables": {table: {"reused_from": "before"} for table in LIST_OF_TABLES}
+        }
+
+        assert return_tables_to_load(None) == LIST_OF_TABLES
+        assert return_tables_to_load(manifest, full_reload=True) == LIST_OF_TABLES
+
+    def test_reused_tables_are_skipped(self):
+        manifest = {
+            "tables": {table: {"reused_from": "before"} for table in LIST_OF_TABLES}
+        }
+        del manifest["tables"]["fact_sales_order"]["reused_from"]
+
+        assert return_tables_to_load(manifest, watermark=LOADED_BEFORE) == [
+            "fact_sales_order"
+        ]
+
+    def test_reused_tables_are_loaded_unless_their_run_was(self):
+        manifest = {
+            "tables": {table: {"reused_from": "before"} for table in LIST_OF_TABLES}
+        }
+        watermark = dict(LOADED_BEFORE)
+        # dim_staff last loaded from another run, dim_design never
+        watermark["dim_staff"] = {"datetime_string": "other", "content_from": "other"}
+        del watermark["dim_design"]
+
+        assert return_tables_to_load(manifest) == LIST_OF_TABLES
+        assert return_tables_to_load(manifest, watermark=watermark) == [
+            "dim_staff",
+            "dim_design",
+            "fact_sales_order",
+            "fact_purchase_order",
+        ]
+
+    def test_fact_is_reloaded_with_any_dimension(self):
+        manifest = {
+            "tables": {table: {"reused_from": "before"} for table in LIST_OF_TABLES}
+        }
+        del manifest["tables"]["dim_staff"]["reused_from"]
+
+        # fact_payment does not reference dim_staff
+        assert return_tables_to_load(manifest, watermark=LOADED_BEFORE) == [
+            "dim_staff",
+            "fact_sales_order",
+            "fact_purchase_order",
+        ]
+
+    def test_tables_not_built_are_not_loaded(self):
+        manifest = {"tables": {table: {} for table in LIST_OF_TABLES[:6]}}
+        manifest["tables"]["fact_sales_order"] = {}
+
+        assert return_tables_to_load(manifest) == LIST_OF_TABLES[:6] + [
+            "fact_sales_order"
+        ]
+        assert "fact_payment" not in return_tables_to_load(manifest, full_reload=True)
+
+    def test_tables_with_unchanged_inputs_are_skipped(self):
+        manifest = {
+            "tables": {table: {"unchanged_from": "before"} for table in LIST_OF_TABLES}
+        }
+
+        assert return_tables_to_load(manifest, watermark=LOADED_BEFORE) == []
+
+    def test_watermark_records_the_run_each_table_holds(self):
+        manifest = {
+            "tables": {
+                "dim_staff": {},
+                "dim_design": {"reused_from": "first"},
+                "dim_currency": {"unchanged_from": "before"},
+            }
+        }
+        watermark = {
+            "dim_design": {"datetime_string": "before", "content_from": "first"},
+            "dim_currency": {"datetime_string": "before", "content_from": "first"},
+            "dim_date": {"datetime_string": "before", "content_from": "before"},
+        }
+
+        # act
+        loaded = return_tables_to_load(manifest, watermark=watermark)
+        new_watermark = return_load_watermark(watermark, manifest, loaded, None, "now")
+
+        # assert
+        assert loaded == ["dim_staff"]
+        assert new_watermark == {
+            "dim_staff": {"datetime_string": "now", "content_from": "now"},
+            "dim_design": {"datetime_string": "now", "content_from": "first"},
+            "dim_currency": {"datetime_string": "now", "content_from": "first"},
+            "dim_date": {"datetime_string": "before", "content_from": "before"},
+        }
+
+    def test_load_order_follows_the_foreign_keys(self):
+        assert sorted(LIST_OF_TABLES) == sorted(WAREHOUSE_ARROW_SCHEMAS)
+        for fact_table, foreign_keys in WAREHOUSE_FOREIGN_KEYS.items():
+            for dimension in foreign_keys.values():
+                assert LIST_OF_TABLES.index(dimension) < LIST_OF_TABLES.index(
+                    fact_table
+                )
+
+
+@pytest.fixture(scope="function")
+def s3_client_with_processed_dim_staff():
+    """dim_staff as written by the pandas engine, with int64 ids"""
+    with mock_aws():
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(
+            Bucket="test_bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        df_staff = pd.DataFrame(
+            {
+                "staff_id": [2, 1],
+                "first_name": ["Jane", "John"],
+                "last_name": ["Smith", "Doe"],
+                "department_name": ["Marketing", ""],
+                "location": ["Manchester", None],
+                "email_address": ["jane.smith@example.com", "john.doe@example.com"],
+            }
+        )
+        buffer = io.BytesIO()
+        df_staff.sort_values("staff_id").to_parquet(buffer)
+        s3_client.put_object(
+            Bucket="test_bucket", Key="data/dim_staff.parquet", Body=buffer.getvalue()
+        )
+
+        yield s3_client
+
+
+@pytest.fixture(scope="function")
+def s3_client_with_fact_without_measures():
+    """fact_sales_order as written before it held the gross_value measures"""
+    with mock_aws():
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(
+            Bucket="test_bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        with open("data/json_files/sales_order.json") as f:
+            df_sales_order = pd.DataFrame(json.load(f)).head(3)
+        df_fact = _return_df_fact_sales_order(df_sales_order).drop(
+            columns=["gross_value", "gross_value_gbp"]
+        )
+        buffer = io.BytesIO()
+        df_fact.to_parquet(buffer)
+        s3_client.put_object(
+            Bucket="test_bucket",
+            Key="data/fact_sales_order.parquet",
+            Body=buffer.getvalue(),
+        )
+
+        yield s3_client, df_fact
+
+
+@pytest.fixture(scope="function")
+def s3_client_with_seven_table_output(s3_client_ingestion_populated):
+    """
+    processed output as written before the transform wrote manifests: the
+    seven tables it built then, fact_sales_order without its measures
+    """
+    s3_client, datetime_string = s3_client_ingestion_populated
+    transform_handler(
+        {"datetime_string": datetime_string, "testing_client": s3_client}, {}
+    )
+    s3_client.create_bucket(
+        Bucket="totesys-processed-zone-fenor",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+    )
+    for table_name in LIST_OF_TABLES[:6] + ["fact_sales_order"]:
+        key = return_s3_key(table_name, datetime_string, ".parquet")
+        body = s3_client.get_object(Bucket=PROCESSED_BUCKET, Key=key)["Body"].read()
+        if table_name == "fact_sales_order":
+            df_fact = pd.read_parquet(io.BytesIO(body))
+            buffer = io.BytesIO()
+            df_fact.drop(columns=["gross_value", "gross_value_gbp"]).to_parquet(buffer)
+            body = buffer.getvalue()
+        s3_client.put_object(Bucket="totesys-processed-zone-fenor", Key=key, Body=body)
+    yield s3_client, datetime_string
+
 
-        assert test_result['message'] == 'Successfully uploaded to data warehouse'
+class TestManifestlessLoad:
+    def test_only_the_processed_tables_are_loaded(
+        self, s3_client_with_seven_table_output
+    ):
+        s3_client, datetime_string = s3_client_with_seven_table_output
+        cursor = MagicMock()
+
+        # act
+        processed_tables = return_processed_tables(
+            s3_client, "totesys-processed-zone-fenor", datetime_string
+        )
+        with patch("src.lambda_load.get_secret"), patch(
+            "src.lambda_load.dw_cleanup"
+        ) as cleanup, patch("src.lambda_load.load_connection_psycopg2") as connect:
+            connect.return_value.cursor.return_value = cursor
+            response = lambda_handler({"datetime_string": datetime_string}, {})
+
+        # assert
+        assert processed_tables == LIST_OF_TABLES[:6] + ["fact_sales_order"]
+        assert response == {"message": "Successfully uploaded to data warehouse"}
+        assert cleanup.call_args.args[1] == processed_tables
+        copied = [call.args[0].split()[1] for call in cursor.copy_expert.call_args_list]
+        assert copied == processed_tables
+        # the fact table was given its measures on the way in
+        assert "gross_value_gbp" in cursor.copy_expert.call_args_list[-1].args[0]
+        watermark = read_load_watermark(s3_client, "totesys-processed-zone-fenor")
+        assert watermark == {
+            table: {"datetime_string": datetime_string, "content_from": datetime_string}
+            for table in processed_tables
+        }
+
+    def test_a_failed_load_leaves_its_tables_out_of_the_watermark(
+        self, s3_client_with_seven_table_output
+    ):
+        s3_client, datetime_string = s3_client_with_seven_table_output
+        s3_client.put_object(
+            Bucket="totesys-processed-zone-fenor",
+            Key=LOAD_WATERMARK_S3_KEY,
+            Body=json.dumps(
+                {
+                    "dim_staff": {"datetime_string": "a", "content_from": "a"},
+                    "fact_payment": {"datetime_string": "a", "content_from": "a"},
+                }
+            ),
+        )
+
+        # act
+        with patch("src.lambda_load.get_secret"), patch(
+            "src.lambda_load.dw_cleanup"
+        ), patch("src.lambda_load.load_connection_psycopg2") as connect:
+            connect.return_value.cursor.return_value.copy_expert.side_effect = (
+                psycopg2.OperationalError("connection lost")
+            )
+            response = lambda_handler({"datetime_string": datetime_string}, {})
+
+        # assert
+        assert response["message"].startswith("Error")
+        watermark = read_load_watermark(s3_client, "totesys-processed-zone-fenor")
+        assert watermark == {
+            "fact_payment": {"datetime_string": "a", "content_from": "a"}
+        }
+
+
+class TestCopyTable:
+    def test_parquet_is_read_as_warehouse_schema(
+        self, s3_client_with_processed_dim_staff
+    ):
+        table = read_parquet_table(
+            s3_client_with_processed_dim_staff,
+            "test_bucket",
+            "data/dim_staff.parquet",
+            "dim_staff",
+        )
+
+        assert table.schema == WAREHOUSE_ARROW_SCHEMAS["dim_staff"]
+        assert table["staff_id"].to_pylist() == [1, 2]
+
+    def test_fact_without_measures_is_given_them(
+        self, s3_client_with_fact_without_measures
+    ):
+        s3_client, df_fact = s3_client_with_fact_without_measures
+
+        # act
+        table = read_parquet_table(
+            s3_client,
+            "test_bucket",
+            "data/fact_sales_order.parquet",
+            "fact_sales_order",
+        )
+
+        # assert
+        assert table.schema == WAREHOUSE_ARROW_SCHEMAS["fact_sales_order"]
+        assert table["gross_value"].to_pylist() == [
+            decimal.Decimal(str(units * price)).quantize(decimal.Decimal("0.01"))
+            for units, price in zip(df_fact["units_sold"], df_fact["unit_price"])
+        ]
+
+    def test_table_is_copied_as_csv_of_its_columns(
+        self, s3_client_with_processed_dim_staff
+    ):
+        table = read_parquet_table(
+            s3_client_with_processed_dim_staff,
+            "test_bucket",
+            "data/dim_staff.parquet",
+            "dim_staff",
+        )
+        cursor = MagicMock()
+
+        # act
+        copy_table(cursor, "dim_staff", table)
+
+        # assert
+        statement, buffer = cursor.copy_expert.call_args.args
+        assert statement == (
+            "COPY dim_staff (staff_id, first_name, last_name, department_name, "
+            "location, email_address) FROM STDIN WITH (FORMAT csv, HEADER true)"
+        )
+        # empty strings are quoted, nulls are not
+        assert buffer.read().decode("utf-8").splitlines()[1:] == [
+            '1,"John","Doe","",,"john.doe@example.com"',
+            '2,"Jane","Smith","Marketing","Manchester","jane.smith@example.com"',
+        ]
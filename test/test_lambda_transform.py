@@ -3,18 +3,29 @@ import boto3
 from moto import mock_aws
 from unittest.mock import Mock, patch
 from datetime import datetime
-from src.lambda_transform import lambda_handler
+from src.lambda_transform import (
+    lambda_handler,
+    return_run_options,
+    DEFAULT_RUN_OPTIONS,
+)
 from datetime import datetime
 from unittest import mock
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import io
+import json
+import tracemalloc
+import subprocess
+import sys
 from _pytest.monkeypatch import MonkeyPatch
 from src.utils import (
     json_to_pg8000_output,
     return_datetime_string,
     write_table_to_s3,
     return_week,
-    return_s3_key
+    return_s3_key,
 )
 from src.lambda_transform_utils import (
     read_s3_table_json,
@@ -26,6 +37,29 @@ from src.lambda_transform_utils import (
     _return_df_dim_currency,
     _return_df_fact_sales_order,
     _return_df_dim_counterparty,
+    return_parquet_writer_profile,
+    stream_parquet_file,
+    S3_MIN_UPLOAD_PART_SIZE,
+    iter_s3_json_array_batches,
+    build_and_populate_sales_order_chunked,
+    read_manifest,
+    return_table_s3_keys,
+    return_builder_version,
+    return_table_fingerprint,
+    S3TableCache,
+    compact_dtypes,
+    copy_on_write,
+    _return_df_fact_purchase_order,
+    _return_df_fact_payment,
+    _return_int_date_keys,
+)
+from src.lambda_transform_arrow import (
+    _return_table_dim_design,
+    _return_table_fact_sales_order,
+)
+from src.warehouse_schema import (
+    WAREHOUSE_ARROW_SCHEMAS,
+    WAREHOUSE_INT_DATE_KEY_ARROW_SCHEMAS,
 )
 
 
@@ -35,12 +69,8 @@ MOCK_ENVIROMENT = True
 @pytest.fixture()
 def hardcoded_variables():
     hardcoded_variables = {}
-    hardcoded_variables["ingestion_bucket_name"] = (
-        "dummy-ingestion-bucket"
-    )
-    hardcoded_variables["processing_bucket_name"] = (
-        "dummy-processing-bucket"
-    )
+    hardcoded_variables["ingestion_bucket_name"] = "dummy-ingestion-bucket"
+    hardcoded_variables["processing_bucket_name"] = "dummy-processing-bucket"
     hardcoded_variables["list_of_toteSys_tables"] = ["tableA", "tableB"]
     hardcoded_variables["AccountId"] = "AccountId"
     hardcoded_variables["list_of_tables"] = [
@@ -133,6 +163,38 @@ def s3_client_ingestion_populated_with_totesys_jsonl(s3_client, hardcoded_variab
     yield s3_client, datetime_str
 
 
+@pytest.fixture()
+def s3_client_ingestion_populated_with_totesys_json(
+    s3_client, hardcoded_variables, monkeypatch
+):
+    # populates the json array files (the format written by lambda_extract)
+    # and points the handler's environment at the mock buckets
+    datetime_str = return_datetime_string()
+    json_list = [
+        "address",
+        "counterparty",
+        "currency",
+        "department",
+        "design",
+        "sales_order",
+        "staff",
+    ]
+    for json_file in json_list:
+        key = return_s3_key(json_file, datetime_str)
+        with open(f"data/json_files/{json_file}.json", "rb") as file:
+            s3_client.put_object(
+                Bucket=hardcoded_variables["ingestion_bucket_name"],
+                Key=key,
+                Body=file.read(),
+            )
+    monkeypatch.setenv("INGESTION_BUCKET", hardcoded_variables["ingestion_bucket_name"])
+    monkeypatch.setenv(
+        "PROCESSED_BUCKET", hardcoded_variables["processing_bucket_name"]
+    )
+
+    yield s3_client, datetime_str
+
+
 @pytest.fixture()
 def example_sales_order_table(hardcoded_variables):
     simulated_pg8000_output, simulated_pg8000_output_cols = json_to_pg8000_output(
@@ -1276,4 +1338,1113 @@ class TestLambdaHandler_2:
 
         # assert
         assert response["statusCode"] == 200
-        assert set(expected_file_keys) == set(actual_s3_file_keys)
\ No newline at end of file
+        assert set(expected_file_keys) == set(actual_s3_file_keys)
+
+
+class TestLambdaHandlerParallel:
+    def test_10a_parallel_mode_writes_same_tables_as_sequential(
+        self, s3_client_ingestion_populated_with_totesys_json, hardcoded_variables
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated_with_totesys_json
+        bucket = hardcoded_variables["processing_bucket_name"]
+
+        # act
+        sequential = lambda_handler(
+            {"datetime_string": datetime_string, "testing_client": s3_client},
+            {},
+        )
+        sequential_tables = {}
+        for table_name in sequential["timings"]:
+            obj = s3_client.get_object(
+                Bucket=bucket,
+                Key=return_s3_key(table_name, datetime_string, extension=".parquet"),
+            )
+            sequential_tables[table_name] = pd.read_parquet(
+                io.BytesIO(obj["Body"].read())
+            )
+        parallel = lambda_handler(
+            {
+                "datetime_string": datetime_string,
+                "testing_client": s3_client,
+                "execution_mode": "parallel",
+                "max_workers": 3,
+            },
+            {},
+        )
+
+        # assert
+        assert sequential["statusCode"] == 200
+        assert parallel["statusCode"] == 200
+        assert list(parallel["timings"]) == list(sequential["timings"])
+        for table_name, df_expected in sequential_tables.items():
+            obj = s3_client.get_object(
+                Bucket=bucket,
+                Key=return_s3_key(table_name, datetime_string, extension=".parquet"),
+            )
+            df_actual = pd.read_parquet(io.BytesIO(obj["Body"].read()))
+            pd.testing.assert_frame_equal(df_actual, df_expected)
+
+    def test_10b_timings_are_reported_per_table(
+        self, s3_client_ingestion_populated_with_totesys_json
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated_with_totesys_json
+        event = {
+            "datetime_string": datetime_string,
+            "testing_client": s3_client,
+            "execution_mode": "parallel",
+        }
+
+        # act
+        response = lambda_handler(event, {})
+
+        # assert
+        assert set(response["timings"]) == {
+            "dim_date",
+            "dim_design",
+            "dim_location",
+            "dim_counterparty",
+            "dim_staff",
+            "dim_currency",
+            "fact_sales_order",
+        }
+        for table_timings in response["timings"].values():
+            assert table_timings["build_seconds"] >= 0
+            assert table_timings["encode_seconds"] >= 0
+            assert table_timings["upload_seconds"] >= 0
+            assert table_timings["total_seconds"] >= table_timings["build_seconds"]
+        assert response["timings"]["fact_sales_order"]["rows"] > 0
+
+    def test_10c_run_options_read_from_environment_and_event(self, monkeypatch):
+        monkeypatch.setenv("TRANSFORM_EXECUTION_MODE", "parallel")
+        monkeypatch.setenv("TRANSFORM_MAX_WORKERS", "2")
+
+        assert return_run_options({}) == {
+            **DEFAULT_RUN_OPTIONS,
+            "execution_mode": "parallel",
+            "max_workers": 2,
+        }
+        assert return_run_options({"max_workers": 8})["max_workers"] == 8
+
+
+class TestFactSalesOrderArrowTemporal:
+    def test_11a_arrow_temporal_matches_string_output(self, hardcoded_variables):
+        with open(
+            hardcoded_variables["dict_table_snapshot_filepaths"]["sales_order"]
+        ) as f:
+            df_totesys_sales_order = pd.DataFrame(json.load(f))
+
+        # act
+        df_strings = _return_df_fact_sales_order(df_totesys_sales_order)
+        df_arrow = _return_df_fact_sales_order(
+            df_totesys_sales_order, arrow_temporal=True
+        )
+
+        # assert - same rows and columns
+        assert list(df_arrow.columns) == list(df_strings.columns)
+        assert all(df_arrow.index.values == df_strings.index.values)
+
+        # assert - arrow temporal types
+        for col in [
+            "created_date",
+            "last_updated_date",
+            "agreed_payment_date",
+            "agreed_delivery_date",
+        ]:
+            assert df_arrow[col].dtype == pd.ArrowDtype(pa.date32())
+            assert all(df_arrow[col].astype(str) == df_strings[col])
+        for col in ["created_time", "last_updated_time"]:
+            assert df_arrow[col].dtype == pd.ArrowDtype(pa.time64("us"))
+            assert all(
+                df_arrow[col].map(lambda t: t.strftime("%H:%M:%S.%f")[:-3])
+                == df_strings[col]
+            )
+
+    def test_11b_arrow_temporal_is_written_as_native_parquet_types(
+        self, s3_client_ingestion_populated_with_totesys_json, hardcoded_variables
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated_with_totesys_json
+        event = {
+            "datetime_string": datetime_string,
+            "testing_client": s3_client,
+            "arrow_temporal": True,
+        }
+
+        # act
+        response = lambda_handler(event, {})
+        obj = s3_client.get_object(
+            Bucket=hardcoded_variables["processing_bucket_name"],
+            Key=return_s3_key(
+                "fact_sales_order", datetime_string, extension=".parquet"
+            ),
+        )
+        schema = pq.read_schema(io.BytesIO(obj["Body"].read()))
+
+        # assert
+        assert response["statusCode"] == 200
+        assert schema.field("created_date").type == pa.date32()
+        assert schema.field("created_time").type == pa.time64("us")
+        assert schema.field("agreed_delivery_date").type == pa.date32()
+
+
+@pytest.fixture()
+def scaled_totesys_dfs(hardcoded_variables):
+    # source tables repeated so fixed allocation overheads are negligible
+    scale = 5
+    scaled_dfs = {}
+    for table_name in [
+        "address",
+        "counterparty",
+        "currency",
+        "department",
+        "design",
+        "sales_order",
+        "staff",
+    ]:
+        with open(
+            hardcoded_variables["dict_table_snapshot_filepaths"][table_name]
+        ) as f:
+            df = pd.DataFrame(json.load(f))
+        scaled_dfs[table_name] = df
+        scaled_dfs[f"{table_name}_scaled"] = pd.concat([df] * scale, ignore_index=True)
+    return scaled_dfs
+
+
+class TestBuilderMemory:
+    @pytest.mark.parametrize(
+        "builder, input_names",
+        [
+            (_return_df_dim_design, ["design_scaled"]),
+            (_return_df_dim_location, ["address_scaled"]),
+            (_return_df_dim_counterparty, ["counterparty_scaled", "address"]),
+            (_return_df_dim_staff, ["staff_scaled", "department"]),
+            (_return_df_dim_currency, ["currency_scaled"]),
+            (_return_df_fact_sales_order, ["sales_order_scaled"]),
+        ],
+    )
+    def test_12a_peak_allocation_stays_close_to_output_size(
+        self, scaled_totesys_dfs, builder, input_names
+    ):
+        input_dfs = [scaled_totesys_dfs[name] for name in input_names]
+        builder = copy_on_write(builder)  # as the transform runs them
+        builder(*input_dfs)  # warm up lazy imports and caches
+
+        # act
+        tracemalloc.start()
+        df_output = builder(*input_dfs)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # assert
+        output_size = df_output.memory_usage(index=True, deep=True).sum()
+        assert peak <= 1.25 * output_size + 64 * 1024
+
+    def test_12b_builders_do_not_modify_their_inputs(self, scaled_totesys_dfs):
+        df_sales_order = scaled_totesys_dfs["sales_order"]
+        df_expected = df_sales_order.copy()
+
+        # act
+        for copy_on_write_on in [False, True]:
+            with pd.option_context("mode.copy_on_write", copy_on_write_on):
+                _return_df_fact_sales_order(df_sales_order)
+                _return_df_fact_sales_order(df_sales_order, arrow_temporal=True)
+                _return_df_dim_dates(df_sales_order)
+
+        # assert
+        pd.testing.assert_frame_equal(df_sales_order, df_expected)
+
+    def test_12c_copy_on_write_is_only_on_within_the_transform(self):
+        @copy_on_write
+        def read_option():
+            return pd.get_option("mode.copy_on_write")
+
+        # assert
+        assert pd.get_option("mode.copy_on_write") is False
+        assert read_option() is True
+        assert pd.get_option("mode.copy_on_write") is False
+
+
+class TestParquetWriterProfile:
+    def test_13a_default_profile_keeps_pyarrow_defaults(self):
+        assert return_parquet_writer_profile("fact_sales_order", "default") == {}
+
+    def test_13b_profile_sets_codec_sort_order_and_dictionary_columns(
+        self, s3_client, hardcoded_variables, scaled_totesys_dfs
+    ):
+        bucket = hardcoded_variables["processing_bucket_name"]
+        datetime_string = return_datetime_string()
+        df_fact_sales_order = _return_df_fact_sales_order(
+            scaled_totesys_dfs["sales_order"]
+        ).iloc[::-1]
+        writer_profile = return_parquet_writer_profile("fact_sales_order", "zstd")
+
+        # act
+        response = populate_parquet_file(
+            s3_client,
+            datetime_string,
+            "fact_sales_order",
+            df_fact_sales_order,
+            bucket,
+            writer_profile=writer_profile,
+        )
+        obj = s3_client.get_object(
+            Bucket=bucket,
+            Key=return_s3_key(
+                "fact_sales_order", datetime_string, extension=".parquet"
+            ),
+        )
+        parquet_file = pq.ParquetFile(io.BytesIO(obj["Body"].read()))
+        row_group = parquet_file.metadata.row_group(0)
+        columns = {
+            row_group.column(i).path_in_schema: row_group.column(i)
+            for i in range(row_group.num_columns)
+        }
+
+        # assert
+        assert response["ResponseMetadata"]["HTTPStatusCode"] == 200
+        assert parquet_file.metadata.num_rows == len(df_fact_sales_order)
+        assert columns["created_date"].compression == "ZSTD"
+        assert columns["created_date"].is_stats_set
+        assert columns["created_date"].has_dictionary_page
+        assert not columns["created_time"].has_dictionary_page
+        assert columns["created_date"].has_offset_index
+        assert [
+            parquet_file.schema_arrow.names[c.column_index]
+            for c in row_group.sorting_columns
+        ] == ["created_date"]
+        df_read = parquet_file.read().to_pandas()
+        assert df_read["created_date"].is_monotonic_increasing
+        assert set(df_read.index) == set(df_fact_sales_order.index)
+
+
+class TestStreamParquetFile:
+    def test_14a_large_table_is_uploaded_in_parts(self, s3_client, hardcoded_variables):
+        bucket = hardcoded_variables["processing_bucket_name"]
+        datetime_string = return_datetime_string()
+        rng = np.random.default_rng(0)
+        df_large = pd.DataFrame(
+            {"value": rng.random(1_500_000)},
+            index=pd.Index(np.arange(1_500_000), name="row_id"),
+        )  # ~24 MiB of incompressible doubles and row ids plus the index
+        timings = {}
+
+        # act
+        response = stream_parquet_file(
+            s3_client,
+            datetime_string,
+            "large_table",
+            df_large,
+            bucket,
+            timings=timings,
+            writer_profile={"row_group_size": 250_000},
+            part_size=S3_MIN_UPLOAD_PART_SIZE,
+        )
+        key = return_s3_key("large_table", datetime_string, extension=".parquet")
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+        obj = s3_client.get_object(Bucket=bucket, Key=key)
+        parquet_file = pq.ParquetFile(io.BytesIO(obj["Body"].read()))
+
+        # assert
+        assert response["ResponseMetadata"]["HTTPStatusCode"] == 200
+        assert int(head["ETag"].strip('"').split("-")[1]) > 1
+        assert parquet_file.metadata.num_row_groups == 6
+        pd.testing.assert_frame_equal(parquet_file.read().to_pandas(), df_large)
+        assert timings["upload_seconds"] > 0
+
+    def test_14b_small_table_is_a_single_put_and_matches_populate(
+        self, s3_client, hardcoded_variables, scaled_totesys_dfs
+    ):
+        bucket = hardcoded_variables["processing_bucket_name"]
+        df_dim_design = _return_df_dim_design(scaled_totesys_dfs["design"])
+
+        # act
+        response = stream_parquet_file(
+            s3_client, "streamed", "dim_design", df_dim_design, bucket
+        )
+        populate_parquet_file(
+            s3_client, "buffered", "dim_design", df_dim_design, bucket
+        )
+        streamed, buffered = [
+            s3_client.get_object(
+                Bucket=bucket,
+                Key=return_s3_key("dim_design", prefix, extension=".parquet"),
+            )["Body"].read()
+            for prefix in ["streamed", "buffered"]
+        ]
+
+        # assert
+        assert response["ResponseMetadata"]["HTTPStatusCode"] == 200
+        assert streamed == buffered
+
+    def test_14c_failed_upload_is_aborted(self, s3_client):
+        df_large = pd.DataFrame({"value": np.random.default_rng(0).random(1_500_000)})
+
+        # act
+        response = stream_parquet_file(
+            s3_client,
+            return_datetime_string(),
+            "large_table",
+            df_large,
+            "bucket-that-does-not-exist",
+            part_size=S3_MIN_UPLOAD_PART_SIZE,
+        )
+
+        # assert
+        assert response["message"] == "Error"
+        assert "NoSuchBucket" in response["details"]
+
+
+class TestChunkedSalesOrder:
+    def test_15a_batches_match_whole_table_read(
+        self, s3_client_ingestion_populated_with_totesys_json, hardcoded_variables
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated_with_totesys_json
+        bucket = hardcoded_variables["ingestion_bucket_name"]
+        key = return_s3_key("design", datetime_string)
+
+        # act - a small read size splits records across chunks
+        batches = list(
+            iter_s3_json_array_batches(s3_client, key, bucket, 7, read_size=100)
+        )
+
+        # assert
+        df_expected = read_s3_table_json(s3_client, key, bucket)
+        assert [len(df) for df in batches[:-1]] == [7] * (len(batches) - 1)
+        assert 0 < len(batches[-1]) <= 7
+        pd.testing.assert_frame_equal(
+            pd.concat(batches, ignore_index=True), df_expected
+        )
+
+    def test_15b_chunked_tables_match_whole_table_build(
+        self, s3_client_ingestion_populated_with_totesys_json, hardcoded_variables
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated_with_totesys_json
+        ingestion_bucket = hardcoded_variables["ingestion_bucket_name"]
+        bucket = hardcoded_variables["processing_bucket_name"]
+        df_sales_order = read_s3_table_json(
+            s3_client, return_s3_key("sales_order", datetime_string), ingestion_bucket
+        )
+        writer_profiles = {
+            table_name: return_parquet_writer_profile(table_name)
+            for table_name in ["dim_date", "fact_sales_order"]
+        }
+
+        # act
+        responses, timings = build_and_populate_sales_order_chunked(
+            s3_client,
+            datetime_string,
+            ingestion_bucket,
+            bucket,
+            5000,
+            writer_profiles,
+        )
+        written = {}
+        for table_name in responses:
+            obj = s3_client.get_object(
+                Bucket=bucket,
+                Key=return_s3_key(table_name, datetime_string, extension=".parquet"),
+            )
+            written[table_name] = pq.ParquetFile(io.BytesIO(obj["Body"].read()))
+
+        # assert - each batch is its own row group, sorted within the batch
+        assert all(
+            response["ResponseMetadata"]["HTTPStatusCode"] == 200
+            for response in responses.values()
+        )
+        assert written["fact_sales_order"].metadata.num_row_groups == 3
+        assert timings["fact_sales_order"]["rows"] == len(df_sales_order)
+        pd.testing.assert_frame_equal(
+            written["dim_date"].read().to_pandas(),
+            _return_df_dim_dates(df_sales_order),
+        )
+        pd.testing.assert_frame_equal(
+            written["fact_sales_order"].read().to_pandas().sort_index(),
+            _return_df_fact_sales_order(df_sales_order),
+        )
+
+    def test_15c_handler_chunk_rows_option(
+        self, s3_client_ingestion_populated_with_totesys_json, hardcoded_variables
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated_with_totesys_json
+        bucket = hardcoded_variables["processing_bucket_name"]
+
+        def read_processed_table(table_name):
+            obj = s3_client.get_object(
+                Bucket=bucket,
+                Key=return_s3_key(table_name, datetime_string, extension=".parquet"),
+            )
+            return pd.read_parquet(io.BytesIO(obj["Body"].read())).sort_index()
+
+        # act
+        whole = lambda_handler(
+            {"datetime_string": datetime_string, "testing_client": s3_client}, {}
+        )
+        whole_tables = {name: read_processed_table(name) for name in whole["timings"]}
+        chunked = lambda_handler(
+            {
+                "datetime_string": datetime_string,
+                "testing_client": s3_client,
+                "chunk_rows": 2000,
+            },
+            {},
+        )
+
+        # assert
+        assert whole["statusCode"] == 200
+        assert chunked["statusCode"] == 200
+        assert set(chunked["timings"]) == set(whole["timings"])
+        for table_name, df_expected in whole_tables.items():
+            pd.testing.assert_frame_equal(read_processed_table(table_name), df_expected)
+
+
+class TestPartitionedFactOutput:
+    @pytest.mark.parametrize("engine", ["pandas", "arrow"])
+    def test_16a_fact_is_written_one_file_per_month(
+        self,
+        s3_client_ingestion_populated_with_totesys_json,
+        hardcoded_variables,
+        engine,
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated_with_totesys_json
+        bucket = hardcoded_variables["processing_bucket_name"]
+        event = {
+            "datetime_string": datetime_string,
+            "testing_client": s3_client,
+            "engine": engine,
+        }
+
+        def read_parquet(key):
+            obj = s3_client.get_object(Bucket=bucket, Key=key)
+            df = pd.read_parquet(io.BytesIO(obj["Body"].read()))
+            return df.reset_index() if df.index.name is not None else df
+
+        # act
+        lambda_handler(event, {})
+        df_whole = read_parquet(
+            return_s3_key("fact_sales_order", datetime_string, extension=".parquet")
+        )
+        response = lambda_handler({**event, "fact_partitioning": "month"}, {})
+        manifest = read_manifest(s3_client, bucket, datetime_string)
+
+        # assert
+        assert response["statusCode"] == 200
+        entry = manifest["tables"]["fact_sales_order"]
+        assert entry["partition_column"] == "created_date"
+        assert entry["partition_granularity"] == "month"
+        assert entry["rows"] == len(df_whole)
+        assert [p["value"] for p in entry["partitions"]] == sorted(
+            df_whole["created_date"].str[:7].unique()
+        )
+        assert manifest["tables"]["dim_date"]["key"] == return_s3_key(
+            "dim_date", datetime_string, extension=".parquet"
+        )
+        dfs = []
+        for partition in entry["partitions"]:
+            assert partition["keys"] == [
+                f"data/{datetime_string}/fact_sales_order/"
+                f"created_date={partition['value']}/part-0.parquet"
+            ]
+            df_partition = read_parquet(partition["keys"][0])
+            assert len(df_partition) == partition["rows"]
+            assert (df_partition["created_date"].str[:7] == partition["value"]).all()
+            dfs.append(df_partition)
+        df_partitioned = pd.concat(dfs).sort_values("sales_record_id")
+        pd.testing.assert_frame_equal(
+            df_partitioned.reset_index(drop=True),
+            df_whole.sort_values("sales_record_id").reset_index(drop=True),
+        )
+
+    def test_16b_chunked_partitions_list_a_part_per_batch(
+        self, s3_client_ingestion_populated_with_totesys_json, hardcoded_variables
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated_with_totesys_json
+        bucket = hardcoded_variables["processing_bucket_name"]
+
+        # act
+        response = lambda_handler(
+            {
+                "datetime_string": datetime_string,
+                "testing_client": s3_client,
+                "chunk_rows": 5000,
+                "fact_partitioning": "day",
+            },
+            {},
+        )
+        manifest = read_manifest(s3_client, bucket, datetime_string)
+        s3_keys = return_table_s3_keys(manifest, "fact_sales_order", datetime_string)
+
+        # assert
+        assert response["statusCode"] == 200
+        entry = manifest["tables"]["fact_sales_order"]
+        values = [partition["value"] for partition in entry["partitions"]]
+        assert values == sorted(set(values))
+        assert all(len(value) == 10 for value in values)
+        assert max(len(partition["keys"]) for partition in entry["partitions"]) > 1
+        assert len(s3_keys) == sum(len(p["keys"]) for p in entry["partitions"])
+        assert sum(p["rows"] for p in entry["partitions"]) == entry["rows"]
+
+    def test_16c_table_keys_without_manifest_or_partitions(
+        self, s3_client, hardcoded_variables
+    ):
+        bucket = hardcoded_variables["processing_bucket_name"]
+        default_key = return_s3_key("fact_sales_order", "dt", extension=".parquet")
+
+        # assert
+        assert read_manifest(s3_client, bucket, "dt") is None
+        assert return_table_s3_keys(None, "fact_sales_order", "dt") == [default_key]
+        manifest = {"tables": {"fact_sales_order": {"key": default_key, "rows": 1}}}
+        assert return_table_s3_keys(manifest, "fact_sales_order", "dt") == [default_key]
+
+
+@pytest.fixture()
+def s3_client_with_two_ingestion_snapshots(
+    s3_client_ingestion_populated_with_totesys_json, hardcoded_variables
+):
+    # a second snapshot of the same ingestion files under a later datetime
+    s3_client, datetime_string = s3_client_ingestion_populated_with_totesys_json
+    bucket = hardcoded_variables["ingestion_bucket_name"]
+    next_datetime_string = f"{datetime_string}-next"
+    for table_name in [
+        "address",
+        "counterparty",
+        "currency",
+        "department",
+        "design",
+        "sales_order",
+        "staff",
+    ]:
+        s3_client.copy_object(
+            Bucket=bucket,
+            Key=return_s3_key(table_name, next_datetime_string),
+            CopySource={
+                "Bucket": bucket,
+                "Key": return_s3_key(table_name, datetime_string),
+            },
+        )
+    yield s3_client, datetime_string, next_datetime_string
+
+
+class TestReuseUnchangedOutputs:
+    def test_17a_unchanged_tables_are_copied_not_rebuilt(
+        self, s3_client_with_two_ingestion_snapshots, hardcoded_variables
+    ):
+        s3_client, first, second = s3_client_with_two_ingestion_snapshots
+        bucket = hardcoded_variables["processing_bucket_name"]
+
+        event = {"testing_client": s3_client, "reuse_outputs": True}
+
+        # act
+        first_response = lambda_handler({**event, "datetime_string": first}, {})
+        second_response = lambda_handler({**event, "datetime_string": second}, {})
+        manifest = read_manifest(s3_client, bucket, second)
+
+        # assert
+        assert first_response["skipped_tables"] == []
+        assert set(second_response["skipped_tables"]) == set(first_response["timings"])
+        for table_name in first_response["timings"]:
+            first_body, second_body = [
+                s3_client.get_object(
+                    Bucket=bucket,
+                    Key=return_s3_key(table_name, run_datetime, extension=".parquet"),
+                )["Body"].read()
+                for run_datetime in [first, second]
+            ]
+            assert second_body == first_body
+            assert manifest["tables"][table_name]["reused_from"] == first
+            assert "build_seconds" not in second_response["timings"][table_name]
+
+    def test_17b_changed_input_or_option_rebuilds_table(
+        self, s3_client_with_two_ingestion_snapshots, hardcoded_variables
+    ):
+        s3_client, first, second = s3_client_with_two_ingestion_snapshots
+        ingestion_bucket = hardcoded_variables["ingestion_bucket_name"]
+        with open("data/json_files/design.json") as f:
+            designs = json.load(f)
+        s3_client.put_object(
+            Bucket=ingestion_bucket,
+            Key=return_s3_key("design", second),
+            Body=json.dumps(designs[:-1]),
+        )
+        event = {"testing_client": s3_client, "reuse_outputs": True}
+
+        # act
+        lambda_handler({**event, "datetime_string": first}, {})
+        changed_input = lambda_handler({**event, "datetime_string": second}, {})
+        changed_option = lambda_handler(
+            {**event, "datetime_string": second, "fact_partitioning": "month"}, {}
+        )
+
+        # assert
+        assert "dim_design" not in changed_input["skipped_tables"]
+        assert changed_input["timings"]["dim_design"]["rows"] == len(designs) - 1
+        assert len(changed_input["skipped_tables"]) == 6
+        assert "fact_sales_order" not in changed_option["skipped_tables"]
+        assert len(changed_option["skipped_tables"]) == 6
+
+    def test_17c_fingerprint_depends_on_builder_code(self):
+        fingerprint = return_table_fingerprint(
+            "dim_design",
+            return_builder_version(_return_df_dim_design),
+            {"design": '"etag"'},
+            {},
+        )
+
+        # assert
+        assert fingerprint == return_table_fingerprint(
+            "dim_design",
+            return_builder_version(_return_df_dim_design),
+            {"design": '"etag"'},
+            {},
+        )
+        assert fingerprint != return_table_fingerprint(
+            "dim_design",
+            return_builder_version(_return_df_dim_location),
+            {"design": '"etag"'},
+            {},
+        )
+        assert fingerprint != return_table_fingerprint(
+            "dim_design",
+            return_builder_version(_return_table_dim_design),
+            {"design": '"etag"'},
+            {},
+        )
+
+
+class TestS3TableCache:
+    def test_18a_unchanged_file_is_a_hit(
+        self, s3_client_with_two_ingestion_snapshots, hardcoded_variables
+    ):
+        s3_client, first, second = s3_client_with_two_ingestion_snapshots
+        bucket = hardcoded_variables["ingestion_bucket_name"]
+        cache = S3TableCache()
+
+        # act
+        df_first = cache.read(s3_client, return_s3_key("currency", first), bucket)
+        df_second = cache.read(s3_client, return_s3_key("currency", second), bucket)
+
+        # assert
+        assert df_second is df_first
+        pd.testing.assert_frame_equal(
+            df_first,
+            read_s3_table_json(s3_client, return_s3_key("currency", first), bucket),
+        )
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+        assert cache.stats()["bytes"] == df_first.memory_usage(deep=True).sum()
+
+    def test_18b_changed_file_is_a_miss(
+        self, s3_client_with_two_ingestion_snapshots, hardcoded_variables
+    ):
+        s3_client, first, second = s3_client_with_two_ingestion_snapshots
+        bucket = hardcoded_variables["ingestion_bucket_name"]
+        with open("data/json_files/currency.json") as f:
+            currencies = json.load(f)
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=return_s3_key("currency", second),
+            Body=json.dumps(currencies[:1]),
+        )
+        cache = S3TableCache()
+
+        # act
+        cache.read(s3_client, return_s3_key("currency", first), bucket)
+        df_second = cache.read(s3_client, return_s3_key("currency", second), bucket)
+
+        # assert
+        assert len(df_second) == 1
+        assert cache.stats()["hits"] == 0
+        assert cache.stats()["misses"] == 2
+        assert cache.stats()["entries"] == 1
+
+    def test_18c_least_recently_used_tables_are_evicted_by_bytes(
+        self, s3_client_with_two_ingestion_snapshots, hardcoded_variables
+    ):
+        s3_client, first, _ = s3_client_with_two_ingestion_snapshots
+        bucket = hardcoded_variables["ingestion_bucket_name"]
+        cache = S3TableCache()
+        dfs = {
+            table_name: cache.read(s3_client, return_s3_key(table_name, first), bucket)
+            for table_name in ["currency", "department", "design"]
+        }
+        sizes = {
+            table_name: df.memory_usage(deep=True).sum()
+            for table_name, df in dfs.items()
+        }
+
+        # act - currency is used again, then there is room for two tables
+        cache.read(s3_client, return_s3_key("currency", first), bucket)
+        cache.resize(sizes["design"] + sizes["currency"])
+        df_department = cache.read(
+            s3_client, return_s3_key("department", first), bucket
+        )
+
+        # assert - department was least recently used so evicted and reread
+        assert df_department is not dfs["department"]
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 4
+        assert cache.stats()["evictions"] >= 1
+        assert cache.stats()["bytes"] <= sizes["design"] + sizes["currency"]
+
+    def test_18d_warm_handler_reuses_parsed_inputs(
+        self, s3_client_with_two_ingestion_snapshots
+    ):
+        s3_client, first, second = s3_client_with_two_ingestion_snapshots
+        event = {"testing_client": s3_client, "input_cache_bytes": 0}
+
+        # act
+        lambda_handler({**event, "datetime_string": first}, {})
+        cold = lambda_handler(
+            {**event, "datetime_string": first, "input_cache_bytes": 2**30}, {}
+        )
+        warm = lambda_handler(
+            {**event, "datetime_string": second, "input_cache_bytes": 2**30}, {}
+        )
+
+        # assert
+        assert cold["statusCode"] == 200
+        assert warm["statusCode"] == 200
+        assert cold["input_cache"]["entries"] == 7
+        assert warm["input_cache"]["hits"] - cold["input_cache"]["hits"] == 7
+        assert warm["input_cache"]["misses"] == cold["input_cache"]["misses"]
+
+
+class TestCompactDtypes:
+    def test_19a_dataframe_is_narrowed_to_warehouse_types(self, scaled_totesys_dfs):
+        df_fact = _return_df_fact_sales_order(scaled_totesys_dfs["sales_order"])
+
+        # act
+        df_compact, report = compact_dtypes("fact_sales_order", df_fact)
+
+        # assert
+        assert df_compact.index.dtype == "int32"
+        assert df_compact["units_sold"].dtype == "int32"
+        assert df_compact["created_date"].dtype == "category"
+        assert df_compact["unit_price"].dtype == "float64"
+        assert report["bytes_before"] == df_fact.memory_usage(deep=True).sum()
+        assert report["bytes_after"] == df_compact.memory_usage(deep=True).sum()
+        assert report["bytes_saved"] > report["bytes_before"] / 2
+        pd.testing.assert_frame_equal(
+            df_compact,
+            df_fact,
+            check_dtype=False,
+            check_index_type=False,
+            check_categorical=False,
+        )
+
+    def test_19b_arrow_table_is_narrowed_to_warehouse_types(self, scaled_totesys_dfs):
+        tbl_fact = _return_table_fact_sales_order(
+            pa.Table.from_pandas(scaled_totesys_dfs["sales_order"])
+        )
+
+        # act
+        tbl_compact, report = compact_dtypes("fact_sales_order", tbl_fact)
+
+        # assert
+        assert tbl_compact.schema.field("sales_record_id").type == pa.int32()
+        assert pa.types.is_dictionary(tbl_compact.schema.field("created_date").type)
+        assert report["bytes_after"] == tbl_compact.nbytes < tbl_fact.nbytes
+        assert tbl_compact.to_pylist() == tbl_fact.to_pylist()
+
+    def test_19c_values_out_of_range_are_left_wide(self):
+        df = pd.DataFrame({"year": [2022, 2**40], "day_name": ["monday"] * 2})
+
+        # act
+        df_compact, _ = compact_dtypes("dim_date", df)
+        _, report = compact_dtypes("not_a_warehouse_table", df)
+
+        # assert
+        assert df_compact["year"].dtype == "int64"
+        assert df_compact["day_name"].dtype == "category"
+        assert report is None
+
+    def test_19d_handler_reports_memory_saved_per_table(
+        self, s3_client_ingestion_populated_with_totesys_json, hardcoded_variables
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated_with_totesys_json
+        bucket = hardcoded_variables["processing_bucket_name"]
+        event = {"datetime_string": datetime_string, "testing_client": s3_client}
+
+        def read_processed_table(table_name):
+            obj = s3_client.get_object(
+                Bucket=bucket,
+                Key=return_s3_key(table_name, datetime_string, extension=".parquet"),
+            )
+            return pd.read_parquet(io.BytesIO(obj["Body"].read()))
+
+        # act
+        lambda_handler(event, {})
+        wide_tables = {name: read_processed_table(name) for name in ["dim_staff"]}
+        response = lambda_handler({**event, "compact_dtypes": True}, {})
+
+        # assert
+        assert response["statusCode"] == 200
+        for table_timings in response["timings"].values():
+            assert table_timings["compaction"]["bytes_saved"] >= 0
+        df_staff = read_processed_table("dim_staff")
+        assert df_staff["department_name"].dtype == "category"
+        pd.testing.assert_frame_equal(
+            df_staff,
+            wide_tables["dim_staff"],
+            check_dtype=False,
+            check_index_type=False,
+            check_categorical=False,
+        )
+
+
+class TestWarehouseTypes:
+    @pytest.mark.parametrize("chunk_rows", [0, 5000])
+    def test_20a_outputs_are_written_as_warehouse_schemas(
+        self,
+        s3_client_ingestion_populated_with_totesys_json,
+        hardcoded_variables,
+        chunk_rows,
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated_with_totesys_json
+        bucket = hardcoded_variables["processing_bucket_name"]
+        event = {
+            "datetime_string": datetime_string,
+            "testing_client": s3_client,
+            "warehouse_types": True,
+            "compact_dtypes": True,
+            "chunk_rows": chunk_rows,
+        }
+
+        # act
+        response = lambda_handler(event, {})
+
+        # assert
+        assert response["statusCode"] == 200
+        for table_name in response["timings"]:
+            obj = s3_client.get_object(
+                Bucket=bucket,
+                Key=return_s3_key(table_name, datetime_string, extension=".parquet"),
+            )
+            table = pq.read_table(io.BytesIO(obj["Body"].read()))
+            assert table.schema.remove_metadata() == (
+                WAREHOUSE_ARROW_SCHEMAS[table_name]
+            )
+
+
+class TestAllTables:
+    @pytest.fixture()
+    def s3_client_with_purchase_and_payment(
+        self, s3_client_ingestion_populated_with_totesys_json, hardcoded_variables
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated_with_totesys_json
+        for table_name in ["payment_type", "purchase_order", "transaction"]:
+            with open(f"data/json_files/{table_name}.json", "rb") as f:
+                s3_client.put_object(
+                    Bucket=hardcoded_variables["ingestion_bucket_name"],
+                    Key=return_s3_key(table_name, datetime_string),
+                    Body=f.read(),
+                )
+        # a payment due after every sales order date
+        with open("data/json_files/payment.json") as f:
+            payments = json.load(f)
+        payments[0]["payment_date"] = "2030-01-01"
+        s3_client.put_object(
+            Bucket=hardcoded_variables["ingestion_bucket_name"],
+            Key=return_s3_key("payment", datetime_string),
+            Body=json.dumps(payments),
+        )
+        return s3_client, datetime_string
+
+    def test_21a_fact_builders_return_warehouse_columns(self):
+        with open("data/json_files/purchase_order.json") as f:
+            df_purchase_order = pd.DataFrame(json.load(f))
+        with open("data/json_files/payment.json") as f:
+            df_payment = pd.DataFrame(json.load(f))
+
+        # act
+        df_fact_purchase_order = _return_df_fact_purchase_order(df_purchase_order)
+        df_fact_payment = _return_df_fact_payment(df_payment)
+
+        # assert
+        for table_name, df_fact in [
+            ("fact_purchase_order", df_fact_purchase_order),
+            ("fact_payment", df_fact_payment),
+        ]:
+            assert [df_fact.index.name] + list(df_fact.columns) == (
+                WAREHOUSE_ARROW_SCHEMAS[table_name].names
+            )
+        assert df_fact_purchase_order.index.tolist() == list(
+            range(1, len(df_purchase_order) + 1)
+        )
+        first_row = df_fact_payment.iloc[0]
+        assert first_row["created_date"] == df_payment["created_at"][0][:10]
+        assert first_row["created_time"] == df_payment["created_at"][0][11:23]
+
+    def test_21b_dim_date_holds_the_dates_of_every_fact(self):
+        with open("data/json_files/sales_order.json") as f:
+            df_sales_order = pd.DataFrame(json.load(f))
+        with open("data/json_files/purchase_order.json") as f:
+            df_purchase_order = pd.DataFrame(json.load(f))
+        with open("data/json_files/payment.json") as f:
+            df_payment = pd.DataFrame(json.load(f))
+        df_payment.loc[0, "payment_date"] = "2030-01-01"
+
+        # act
+        df_dim_dates = _return_df_dim_dates(
+            df_sales_order, df_purchase_order, df_payment
+        )
+
+        # assert
+        assert df_dim_dates.index.is_unique
+        assert df_dim_dates.index.is_monotonic_increasing
+        for df_source, columns in [
+            (df_sales_order, ["created_at", "agreed_delivery_date"]),
+            (df_purchase_order, ["last_updated", "agreed_payment_date"]),
+            (df_payment, ["payment_date"]),
+        ]:
+            for column in columns:
+                assert set(df_source[column].str[:10]) <= set(df_dim_dates.index)
+        assert "2030-01-01" not in _return_df_dim_dates(df_sales_order).index
+
+    @pytest.mark.parametrize("chunk_rows", [0, 5000])
+    def test_21c_handler_builds_every_warehouse_table(
+        self, s3_client_with_purchase_and_payment, hardcoded_variables, chunk_rows
+    ):
+        s3_client, datetime_string = s3_client_with_purchase_and_payment
+        event = {
+            "datetime_string": datetime_string,
+            "testing_client": s3_client,
+            "all_tables": True,
+            "warehouse_types": True,
+            "chunk_rows": chunk_rows,
+        }
+
+        # act
+        response = lambda_handler(event, {})
+        default_response = lambda_handler({**event, "all_tables": False}, {})
+
+        # assert
+        assert response["statusCode"] == 200
+        assert sorted(response["timings"]) == sorted(WAREHOUSE_ARROW_SCHEMAS)
+        assert response["timings"]["fact_payment"]["rows"] == 2000
+        assert response["timings"]["fact_purchase_order"]["rows"] == 5300
+        assert response["timings"]["dim_transaction"]["rows"] == 18136
+        assert response["timings"]["dim_date"]["rows"] == (
+            default_response["timings"]["dim_date"]["rows"] + 1
+        )
+        assert "fact_payment" not in default_response["timings"]
+
+
+class TestIntDateKeys:
+    def test_22a_date_keys_are_yyyymmdd_integers(self):
+        with open("data/json_files/sales_order.json") as f:
+            df_sales_order = pd.DataFrame(json.load(f))
+        with open("data/json_files/payment.json") as f:
+            df_payment = pd.DataFrame(json.load(f))
+
+        # act
+        df_dim_dates = _return_df_dim_dates(df_sales_order, int_date_keys=True)
+        df_fact = _return_df_fact_sales_order(df_sales_order, int_date_keys=True)
+        df_fact_temporal = _return_df_fact_sales_order(
+            df_sales_order, arrow_temporal=True, int_date_keys=True
+        )
+        df_fact_payment = _return_df_fact_payment(df_payment, int_date_keys=True)
+
+        # assert
+        df_string_keys = _return_df_dim_dates(df_sales_order)
+        assert df_dim_dates.index.dtype == np.int32
+        assert df_dim_dates.index.tolist() == [
+            int(date.replace("-", "")) for date in df_string_keys.index
+        ]
+        pd.testing.assert_frame_equal(
+            df_dim_dates.reset_index(drop=True),
+            df_string_keys.reset_index(drop=True),
+        )
+        for column in ["created_date", "last_updated_date", "agreed_payment_date"]:
+            assert df_fact[column].dtype == np.int32
+            assert df_fact[column].tolist() == df_fact_temporal[column].tolist()
+            assert set(df_fact[column]) <= set(df_dim_dates.index)
+        assert df_fact["created_date"].iloc[0] == int(
+            df_sales_order["created_at"][0][:10].replace("-", "")
+        )
+        assert df_fact_payment["payment_date"].iloc[0] == int(
+            df_payment["payment_date"][0].replace("-", "")
+        )
+        assert list(
+            _return_int_date_keys(np.array(["2024-02-29", "NaT"], "datetime64[D]"))
+        ) == [20240229, pd.NA]
+
+    @pytest.mark.parametrize(
+        "engine, chunk_rows",
+        [("pandas", 0), ("arrow", 0), ("duckdb", 0), ("pandas", 5000)],
+    )
+    def test_22b_handler_writes_integer_date_keys(
+        self,
+        s3_client_ingestion_populated_with_totesys_json,
+        hardcoded_variables,
+        engine,
+        chunk_rows,
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated_with_totesys_json
+        bucket = hardcoded_variables["processing_bucket_name"]
+        for table_name in ["payment", "payment_type", "purchase_order", "transaction"]:
+            with open(f"data/json_files/{table_name}.json", "rb") as f:
+                s3_client.put_object(
+                    Bucket=hardcoded_variables["ingestion_bucket_name"],
+                    Key=return_s3_key(table_name, datetime_string),
+                    Body=f.read(),
+                )
+        event = {
+            "datetime_string": datetime_string,
+            "testing_client": s3_client,
+            "engine": engine,
+            "chunk_rows": chunk_rows,
+            "all_tables": True,
+            "warehouse_types": True,
+            "int_date_keys": True,
+        }
+
+        def read_table(key):
+            obj = s3_client.get_object(Bucket=bucket, Key=key)
+            return pq.read_table(io.BytesIO(obj["Body"].read()))
+
+        # act
+        response = lambda_handler(event, {})
+        partitioned = lambda_handler({**event, "fact_partitioning": "month"}, {})
+        manifest = read_manifest(s3_client, bucket, datetime_string)
+
+        # assert
+        assert response["statusCode"] == 200
+        assert partitioned["statusCode"] == 200
+        tables = {
+            table_name: read_table(
+                return_s3_key(table_name, datetime_string, extension=".parquet")
+            )
+            for table_name in ["dim_date", "fact_purchase_order", "fact_payment"]
+        }
+        for table_name, table in tables.items():
+            assert table.schema == WAREHOUSE_INT_DATE_KEY_ARROW_SCHEMAS[table_name]
+        date_keys = set(tables["dim_date"]["date_id"].to_pylist())
+        assert 20221103 in date_keys
+        assert set(tables["fact_payment"]["payment_date"].to_pylist()) <= date_keys
+        partitions = manifest["tables"]["fact_sales_order"]["partitions"]
+        assert partitions[0]["value"] == "2022-11"
+        df_partition = read_table(partitions[0]["keys"][0]).to_pandas()
+        assert df_partition["created_date"].between(20221101, 20221130).all()
+
+
+class TestTransformEngines:
+    def test_23a_duckdb_engine_is_imported_on_first_use(self):
+        # a fresh interpreter, as other tests import the duckdb engine
+        script = (
+            "import sys\n"
+            "from src.lambda_transform import return_transform_engine\n"
+            "assert 'src.lambda_transform_duckdb' not in sys.modules\n"
+            "assert 'duckdb' not in sys.modules\n"
+            "return_transform_engine('pandas')\n"
+            "assert 'src.lambda_transform_duckdb' not in sys.modules\n"
+            "read_table, tables, rest_of_schema = return_transform_engine('duckdb')\n"
+            "assert 'src.lambda_transform_duckdb' in sys.modules\n"
+            "assert len(tables) == 7 and len(rest_of_schema) == 5\n"
+        )
+
+        # act
+        result = subprocess.run(
+            [sys.executable, "-c", script], capture_output=True, text=True
+        )
+
+        # assert
+        assert result.returncode == 0, result.stderr
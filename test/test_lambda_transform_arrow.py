@@ -0,0 +1,189 @@
+import io
+import json
+import pytest
+import pandas as pd
+import pyarrow as pa
+from src.utils import return_s3_key
+from src.lambda_transform import lambda_handler
+from src.lambda_transform_utils import (
+    _return_df_dim_dates,
+    _return_df_dim_design,
+    _return_df_dim_location,
+    _return_df_dim_counterparty,
+    _return_df_dim_staff,
+    _return_df_dim_currency,
+    _return_df_fact_sales_order,
+    _return_df_dim_payment_type,
+    _return_df_dim_transaction,
+    _return_df_fact_purchase_order,
+    _return_df_fact_payment,
+)
+from src.lambda_transform_arrow import (
+    _return_table_dim_dates,
+    _return_table_dim_design,
+    _return_table_dim_location,
+    _return_table_dim_counterparty,
+    _return_table_dim_staff,
+    _return_table_dim_currency,
+    _return_table_fact_sales_order,
+    _return_table_dim_payment_type,
+    _return_table_dim_transaction,
+    _return_table_fact_purchase_order,
+    _return_table_fact_payment,
+)
+from conftest import PROCESSED_BUCKET, ALL_TOTESYS_TABLES
+
+
+@pytest.fixture()
+def totesys_json():
+    totesys_json = {}
+    for table_name in ALL_TOTESYS_TABLES:
+        with open(f"data/json_files/{table_name}.json") as f:
+            # escaped as read_s3_table_json / read_s3_table_arrow do
+            totesys_json[table_name] = json.loads(f.read().replace("\\", "\\\\"))
+    return totesys_json
+
+
+class TestArrowEngineEquivalence:
+    @pytest.mark.parametrize(
+        "df_builder, table_builder, input_names",
+        [
+            (_return_df_dim_dates, _return_table_dim_dates, ["sales_order"]),
+            (_return_df_dim_design, _return_table_dim_design, ["design"]),
+            (_return_df_dim_location, _return_table_dim_location, ["address"]),
+            (
+                _return_df_dim_counterparty,
+                _return_table_dim_counterparty,
+                ["counterparty", "address"],
+            ),
+            (
+                _return_df_dim_staff,
+                _return_table_dim_staff,
+                ["staff", "department"],
+            ),
+            (_return_df_dim_currency, _return_table_dim_currency, ["currency"]),
+            (
+                _return_df_fact_sales_order,
+                _return_table_fact_sales_order,
+                ["sales_order"],
+            ),
+            (
+                _return_df_dim_dates,
+                _return_table_dim_dates,
+                ["sales_order", "purchase_order", "payment"],
+            ),
+            (
+                _return_df_dim_payment_type,
+                _return_table_dim_payment_type,
+                ["payment_type"],
+            ),
+            (
+                _return_df_dim_transaction,
+                _return_table_dim_transaction,
+                ["transaction"],
+            ),
+            (
+                _return_df_fact_purchase_order,
+                _return_table_fact_purchase_order,
+                ["purchase_order"],
+            ),
+            (_return_df_fact_payment, _return_table_fact_payment, ["payment"]),
+        ],
+    )
+    def test_arrow_builder_matches_pandas_builder(
+        self, totesys_json, df_builder, table_builder, input_names
+    ):
+        input_dfs = [pd.DataFrame(totesys_json[name]) for name in input_names]
+        input_tables = [
+            pa.Table.from_pylist(totesys_json[name]) for name in input_names
+        ]
+
+        # act
+        df_expected = df_builder(*input_dfs).reset_index()
+        table = table_builder(*input_tables)
+
+        # assert - same columns, order, values and dtypes once in pandas
+        assert isinstance(table, pa.Table)
+        pd.testing.assert_frame_equal(table.to_pandas(), df_expected)
+
+    def test_arrow_temporal_fact_matches_pandas_builder(self, totesys_json):
+        df_expected = _return_df_fact_sales_order(
+            pd.DataFrame(totesys_json["sales_order"]), arrow_temporal=True
+        ).reset_index()
+
+        # act
+        table = _return_table_fact_sales_order(
+            pa.Table.from_pylist(totesys_json["sales_order"]), arrow_temporal=True
+        )
+
+        # assert
+        assert table.equals(pa.Table.from_pandas(df_expected, preserve_index=False))
+
+
+class TestArrowEngineHandler:
+    def test_arrow_engine_writes_same_rows_as_pandas_engine(
+        self, s3_client_ingestion_populated
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated
+
+        def read_processed_tables(response):
+            tables = {}
+            for table_name in response["timings"]:
+                obj = s3_client.get_object(
+                    Bucket=PROCESSED_BUCKET,
+                    Key=return_s3_key(table_name, datetime_string, ".parquet"),
+                )
+                df = pd.read_parquet(io.BytesIO(obj["Body"].read()))
+                if df.index.name is not None:
+                    df = df.reset_index()
+                tables[table_name] = df.sort_index(axis=1)
+            return tables
+
+        # act
+        pandas_response = lambda_handler(
+            {"datetime_string": datetime_string, "testing_client": s3_client}, {}
+        )
+        pandas_tables = read_processed_tables(pandas_response)
+        arrow_response = lambda_handler(
+            {
+                "datetime_string": datetime_string,
+                "testing_client": s3_client,
+                "engine": "arrow",
+            },
+            {},
+        )
+        arrow_tables = read_processed_tables(arrow_response)
+
+        # assert
+        assert pandas_response["statusCode"] == 200
+        assert arrow_response["statusCode"] == 200
+        assert list(arrow_tables) == list(pandas_tables)
+        for table_name, df_expected in pandas_tables.items():
+            pd.testing.assert_frame_equal(arrow_tables[table_name], df_expected)
+
+    def test_arrow_engine_with_compact_dtypes_sorts_dictionary_columns(
+        self, s3_client_ingestion_populated
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated
+        event = {"datetime_string": datetime_string, "testing_client": s3_client}
+        fact_key = return_s3_key("fact_sales_order", datetime_string, ".parquet")
+
+        def read_fact():
+            obj = s3_client.get_object(Bucket=PROCESSED_BUCKET, Key=fact_key)
+            return pd.read_parquet(io.BytesIO(obj["Body"].read()))
+
+        # act
+        lambda_handler({**event, "engine": "arrow"}, {})
+        df_expected = read_fact()
+        response = lambda_handler(
+            {**event, "engine": "arrow", "compact_dtypes": True}, {}
+        )
+        df_compact = read_fact()
+
+        # assert
+        assert response["statusCode"] == 200
+        assert isinstance(df_compact["created_date"].dtype, pd.CategoricalDtype)
+        assert df_compact["created_date"].astype(str).is_monotonic_increasing
+        pd.testing.assert_frame_equal(
+            df_compact.astype(df_expected.dtypes), df_expected
+        )
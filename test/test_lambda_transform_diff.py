@@ -0,0 +1,230 @@
+import io
+import json
+import pytest
+import boto3
+import pandas as pd
+from moto import mock_aws
+from src.utils import return_s3_key
+from src.lambda_transform import lambda_handler
+from src.lambda_transform_utils import read_manifest
+from src.lambda_transform_diff import (
+    diff_snapshots,
+    return_previous_datetime_string,
+)
+from src.lambda_transform_state import read_current_state
+from src.lambda_load import return_tables_to_load, return_load_watermark
+from conftest import INGESTION_BUCKET, PROCESSED_BUCKET, TOTESYS_TABLES
+
+
+# not zero padded, so the second sorts first as a string
+FIRST_DATETIME = "2024-9-30_23-5"
+SECOND_DATETIME = "2024-10-1_0-5"
+
+
+@pytest.fixture()
+def designs():
+    with open("data/json_files/design.json") as f:
+        return json.load(f)
+
+
+@pytest.fixture()
+def s3_client_with_two_snapshots(monkeypatch, designs):
+    # the second snapshot renames the first design and drops the last
+    with mock_aws():
+        s3 = boto3.client("s3")
+        for bucket in [INGESTION_BUCKET, PROCESSED_BUCKET]:
+            s3.create_bucket(
+                Bucket=bucket,
+                CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+            )
+        for datetime_string in [FIRST_DATETIME, SECOND_DATETIME]:
+            for table_name in TOTESYS_TABLES:
+                with open(f"data/json_files/{table_name}.json", "rb") as f:
+                    s3.put_object(
+                        Bucket=INGESTION_BUCKET,
+                        Key=return_s3_key(table_name, datetime_string),
+                        Body=f.read(),
+                    )
+        # both design snapshots written by json.dumps, as its escaping differs
+        # from that of the data files
+        changed_designs = [{**designs[0], "design_name": "Renamed"}] + designs[1:-1]
+        for datetime_string, rows in [
+            (FIRST_DATETIME, designs),
+            (SECOND_DATETIME, changed_designs),
+        ]:
+            s3.put_object(
+                Bucket=INGESTION_BUCKET,
+                Key=return_s3_key("design", datetime_string),
+                Body=json.dumps(rows),
+            )
+        monkeypatch.setenv("INGESTION_BUCKET", INGESTION_BUCKET)
+        monkeypatch.setenv("PROCESSED_BUCKET", PROCESSED_BUCKET)
+        yield s3
+
+
+class TestDiffSnapshots:
+    def test_inserted_updated_and_deleted_rows(self):
+        df_old = pd.DataFrame({"id": [1, 2, 3], "name": ["a", "b", "c"]})
+        df_new = pd.DataFrame({"name": ["d", "c", "x"], "id": [4, 3, 1]})
+
+        # act
+        changes = diff_snapshots(df_old, df_new, ["id"])
+
+        # assert - column order does not count as a change
+        assert changes["inserted"].to_dict("records") == [{"name": "d", "id": 4}]
+        assert changes["updated"].to_dict("records") == [{"name": "x", "id": 1}]
+        assert changes["deleted"].to_dict("records") == [{"id": 2, "name": "b"}]
+
+    def test_compound_keys(self):
+        df_old = pd.DataFrame(
+            {"sales_order_id": [1, 1], "last_updated": ["t1", "t2"], "units": [5, 6]}
+        )
+        df_new = pd.DataFrame(
+            {"sales_order_id": [1, 1], "last_updated": ["t2", "t3"], "units": [6, 7]}
+        )
+
+        # act
+        changes = diff_snapshots(df_old, df_new, ["sales_order_id", "last_updated"])
+
+        # assert
+        assert changes["inserted"]["last_updated"].tolist() == ["t3"]
+        assert changes["updated"].empty
+        assert changes["deleted"]["last_updated"].tolist() == ["t1"]
+
+    def test_identical_and_empty_snapshots(self):
+        with open("data/json_files/sales_order.json") as f:
+            df_sales_order = pd.DataFrame(json.load(f))
+        keys = ["sales_order_id", "last_updated"]
+
+        # act
+        unchanged = diff_snapshots(df_sales_order, df_sales_order.iloc[::-1], keys)
+        from_empty = diff_snapshots(pd.DataFrame([]), df_sales_order, keys)
+
+        # assert
+        assert all(df.empty for df in unchanged.values())
+        assert len(from_empty["inserted"]) == len(df_sales_order)
+        assert from_empty["deleted"].empty
+
+
+class TestReturnPreviousDatetimeString:
+    def test_latest_earlier_snapshot_by_date(self, s3_client_with_two_snapshots):
+        s3_client = s3_client_with_two_snapshots
+
+        assert (
+            return_previous_datetime_string(
+                s3_client, INGESTION_BUCKET, SECOND_DATETIME
+            )
+            == FIRST_DATETIME
+        )
+        assert (
+            return_previous_datetime_string(s3_client, INGESTION_BUCKET, FIRST_DATETIME)
+            is None
+        )
+
+    def test_extract_datetime_strings(self, s3_client_with_two_snapshots):
+        s3_client = s3_client_with_two_snapshots
+        for datetime_string in ["20241001_060000", "20241001_090000"]:
+            s3_client.put_object(
+                Bucket=INGESTION_BUCKET,
+                Key=return_s3_key("design", datetime_string),
+                Body=b"[]",
+            )
+
+        assert (
+            return_previous_datetime_string(
+                s3_client, INGESTION_BUCKET, "20241001_083000"
+            )
+            == "20241001_060000"
+        )
+        assert (
+            return_previous_datetime_string(
+                s3_client, INGESTION_BUCKET, "20241001_060000"
+            )
+            == SECOND_DATETIME
+        )
+
+
+class TestSnapshotDiffHandler:
+    def test_change_sets_are_written_and_listed_in_manifest(
+        self, s3_client_with_two_snapshots, designs
+    ):
+        s3_client = s3_client_with_two_snapshots
+        event = {"testing_client": s3_client, "snapshot_diff": True}
+
+        # act
+        first = lambda_handler({**event, "datetime_string": FIRST_DATETIME}, {})
+        second = lambda_handler({**event, "datetime_string": SECOND_DATETIME}, {})
+        manifest = read_manifest(s3_client, PROCESSED_BUCKET, SECOND_DATETIME)
+
+        # assert
+        assert first["changes"] == {}
+        assert second["statusCode"] == 200
+        design_changes = second["changes"]["design"]
+        assert design_changes["inserted"]["rows"] == 0
+        assert design_changes["updated"]["rows"] == 1
+        assert design_changes["deleted"]["rows"] == 1
+        obj = s3_client.get_object(
+            Bucket=PROCESSED_BUCKET, Key=design_changes["deleted"]["key"]
+        )
+        df_deleted = pd.read_parquet(io.BytesIO(obj["Body"].read()))
+        assert df_deleted["design_id"].tolist() == [designs[-1]["design_id"]]
+        assert manifest["changes"]["previous_datetime_string"] == FIRST_DATETIME
+        assert manifest["changes"]["tables"]["sales_order"]["updated"]["rows"] == 0
+
+    def test_load_skips_tables_with_unchanged_inputs(
+        self, s3_client_with_two_snapshots
+    ):
+        s3_client = s3_client_with_two_snapshots
+        event = {"testing_client": s3_client, "snapshot_diff": True}
+
+        # act
+        lambda_handler({**event, "datetime_string": FIRST_DATETIME}, {})
+        first_manifest = read_manifest(s3_client, PROCESSED_BUCKET, FIRST_DATETIME)
+        lambda_handler({**event, "datetime_string": SECOND_DATETIME}, {})
+        manifest = read_manifest(s3_client, PROCESSED_BUCKET, SECOND_DATETIME)
+        first_loaded = return_tables_to_load(first_manifest)
+        # the watermark of a successful load of the first run
+        watermark = return_load_watermark(
+            {}, first_manifest, first_loaded, None, FIRST_DATETIME
+        )
+        changed_option = lambda_handler(
+            {**event, "datetime_string": SECOND_DATETIME, "compact_dtypes": True}, {}
+        )
+        changed_option_manifest = read_manifest(
+            s3_client, PROCESSED_BUCKET, SECOND_DATETIME
+        )
+
+        # assert
+        assert manifest["tables"]["dim_location"]["unchanged_from"] == FIRST_DATETIME
+        assert "unchanged_from" not in manifest["tables"]["dim_design"]
+        assert return_tables_to_load(manifest, watermark=watermark) == [
+            "dim_design",
+            "fact_sales_order",
+        ]
+        # without a successful load of the first run every table is loaded
+        assert return_tables_to_load(manifest) == first_loaded
+        assert changed_option["statusCode"] == 200
+        assert all(
+            "unchanged_from" not in entry
+            for entry in changed_option_manifest["tables"].values()
+        )
+
+    def test_incremental_state_follows_diffed_snapshots(
+        self, s3_client_with_two_snapshots, designs
+    ):
+        s3_client = s3_client_with_two_snapshots
+        event = {
+            "testing_client": s3_client,
+            "snapshot_diff": True,
+            "incremental": True,
+        }
+
+        # act
+        lambda_handler({**event, "datetime_string": FIRST_DATETIME}, {})
+        response = lambda_handler({**event, "datetime_string": SECOND_DATETIME}, {})
+        df_state = read_current_state(s3_client, PROCESSED_BUCKET, "design")
+
+        # assert
+        assert response["timings"]["dim_design"]["rows"] == len(designs) - 1
+        assert len(df_state) == len(designs) - 1
+        assert df_state["design_name"].iloc[0] == "Renamed"
@@ -0,0 +1,131 @@
+import io
+import json
+import pytest
+import pandas as pd
+import pyarrow as pa
+from src.utils import return_s3_key
+from src.lambda_transform import (
+    lambda_handler,
+    TRANSFORM_TABLES,
+    ALL_TABLES_TRANSFORM_TABLES,
+)
+from src.lambda_transform_utils import _return_df_fact_sales_order
+from src.lambda_transform_duckdb import read_s3_table_duckdb, return_duckdb_builder
+from conftest import INGESTION_BUCKET, PROCESSED_BUCKET, ALL_TOTESYS_TABLES
+
+pytest.importorskip("duckdb")
+
+
+@pytest.fixture()
+def totesys_dfs_and_tables(s3_client_ingestion_populated):
+    s3_client, datetime_string = s3_client_ingestion_populated
+    totesys_dfs = {}
+    totesys_tables = {}
+    for table_name in ALL_TOTESYS_TABLES:
+        s3_key = return_s3_key(table_name, datetime_string)
+        with open(f"data/json_files/{table_name}.json") as f:
+            # escaped as read_s3_table_json / read_s3_table_duckdb do
+            totesys_dfs[table_name] = pd.DataFrame(
+                json.loads(f.read().replace("\\", "\\\\"))
+            )
+        totesys_tables[table_name] = read_s3_table_duckdb(
+            s3_client, s3_key, INGESTION_BUCKET
+        )
+    return totesys_dfs, totesys_tables
+
+
+class TestReadS3TableDuckdb:
+    def test_returns_arrow_table_of_ingestion_rows(self, totesys_dfs_and_tables):
+        totesys_dfs, totesys_tables = totesys_dfs_and_tables
+
+        # assert
+        for table_name in ALL_TOTESYS_TABLES:
+            assert isinstance(totesys_tables[table_name], pa.Table)
+            assert totesys_tables[table_name].num_rows == len(totesys_dfs[table_name])
+            assert totesys_tables[table_name].column_names == list(
+                totesys_dfs[table_name].columns
+            )
+
+
+class TestDuckdbEngineEquivalence:
+    @pytest.mark.parametrize(
+        "table_name, df_builder, input_names",
+        TRANSFORM_TABLES + ALL_TABLES_TRANSFORM_TABLES,
+        ids=[table_name for table_name, _, _ in TRANSFORM_TABLES]
+        + [
+            f"{table_name}-all_tables"
+            for table_name, _, _ in ALL_TABLES_TRANSFORM_TABLES
+        ],
+    )
+    def test_duckdb_builder_matches_pandas_builder(
+        self, totesys_dfs_and_tables, table_name, df_builder, input_names
+    ):
+        totesys_dfs, totesys_tables = totesys_dfs_and_tables
+        df_expected = df_builder(*[totesys_dfs[name] for name in input_names])
+
+        # act
+        builder = return_duckdb_builder(table_name, input_names)
+        table = builder(*[totesys_tables[name] for name in input_names])
+
+        # assert - same columns, order and values once in pandas
+        assert isinstance(table, pa.Table)
+        pd.testing.assert_frame_equal(
+            table.to_pandas(), df_expected.reset_index(), check_dtype=False
+        )
+
+    def test_duckdb_temporal_fact_matches_pandas_builder(self, totesys_dfs_and_tables):
+        totesys_dfs, totesys_tables = totesys_dfs_and_tables
+        df_expected = _return_df_fact_sales_order(
+            totesys_dfs["sales_order"], arrow_temporal=True
+        ).reset_index()
+
+        # act
+        builder = return_duckdb_builder("fact_sales_order", ["sales_order"])
+        table = builder(totesys_tables["sales_order"], arrow_temporal=True)
+
+        # assert
+        assert table.equals(pa.Table.from_pandas(df_expected, preserve_index=False))
+
+
+class TestDuckdbEngineHandler:
+    def test_duckdb_engine_writes_same_rows_as_pandas_engine(
+        self, s3_client_ingestion_populated
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated
+
+        def read_processed_tables(response):
+            tables = {}
+            for table_name in response["timings"]:
+                obj = s3_client.get_object(
+                    Bucket=PROCESSED_BUCKET,
+                    Key=return_s3_key(table_name, datetime_string, ".parquet"),
+                )
+                df = pd.read_parquet(io.BytesIO(obj["Body"].read()))
+                if df.index.name is not None:
+                    df = df.reset_index()
+                tables[table_name] = df.sort_index(axis=1)
+            return tables
+
+        # act
+        pandas_response = lambda_handler(
+            {"datetime_string": datetime_string, "testing_client": s3_client}, {}
+        )
+        pandas_tables = read_processed_tables(pandas_response)
+        duckdb_response = lambda_handler(
+            {
+                "datetime_string": datetime_string,
+                "testing_client": s3_client,
+                "engine": "duckdb",
+            },
+            {},
+        )
+        duckdb_tables = read_processed_tables(duckdb_response)
+
+        # assert
+        assert pandas_response["statusCode"] == 200
+        assert duckdb_response["statusCode"] == 200
+        assert list(duckdb_tables) == list(pandas_tables)
+        for table_name, df_expected in pandas_tables.items():
+            pd.testing.assert_frame_equal(
+                duckdb_tables[table_name], df_expected, check_dtype=False
+            )
@@ -0,0 +1,141 @@
+import io
+import json
+import pytest
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from src.utils import return_s3_key
+from src.lambda_transform import lambda_handler
+from src.lambda_transform_utils import _return_df_fact_sales_order
+from src.lambda_transform_arrow import _return_table_fact_sales_order
+from src.lambda_transform_keys import SalesRecordKeyMap
+from conftest import INGESTION_BUCKET, PROCESSED_BUCKET, TOTESYS_TABLES
+
+
+@pytest.fixture()
+def df_sales_order():
+    with open("data/json_files/sales_order.json") as f:
+        return pd.DataFrame(json.load(f))
+
+
+class TestSalesRecordKeyMap:
+    def test_first_assignment_numbers_rows_in_order(self, df_sales_order):
+        key_map = SalesRecordKeyMap()
+
+        # act
+        keys = key_map.assign(
+            df_sales_order["sales_order_id"], df_sales_order["last_updated"]
+        )
+
+        # assert
+        assert list(keys) == list(range(1, len(df_sales_order) + 1))
+        assert len(key_map) == key_map.assigned == len(df_sales_order)
+
+    def test_existing_versions_keep_keys_and_new_versions_get_fresh_ones(
+        self, df_sales_order
+    ):
+        key_map = SalesRecordKeyMap()
+        keys = key_map.assign(
+            df_sales_order["sales_order_id"], df_sales_order["last_updated"]
+        )
+        df_next = df_sales_order.sample(frac=1, random_state=0).iloc[:-3]
+        df_updated = df_sales_order.iloc[:2].assign(
+            last_updated="2025-01-01T00:00:00.000"
+        )
+        df_next = pd.concat([df_updated.iloc[:1], df_next, df_updated])
+
+        # act
+        next_keys = key_map.assign(df_next["sales_order_id"], df_next["last_updated"])
+
+        # assert - the new version repeated in the snapshot shares its key
+        n = len(df_sales_order)
+        assert list(next_keys[1:-2]) == list(keys[df_next.index[1:-2]])
+        assert list(next_keys[:1]) + list(next_keys[-2:]) == [n + 1, n + 1, n + 2]
+        assert len(key_map) == n + 2
+
+    def test_round_trips_through_s3(self, s3_client_ingestion_populated):
+        s3_client, _ = s3_client_ingestion_populated
+        key_map = SalesRecordKeyMap()
+        key_map.assign([3, 1, 3], ["2022-11-03T14:20:52.186"] * 2 + ["2023-01-01"])
+
+        # act
+        empty = SalesRecordKeyMap.read(s3_client, PROCESSED_BUCKET)
+        key_map.write(s3_client, PROCESSED_BUCKET)
+        read_back = SalesRecordKeyMap.read(s3_client, PROCESSED_BUCKET)
+
+        # assert
+        assert len(empty) == 0
+        assert np.array_equal(read_back.sales_order_ids, [3, 1, 3])
+        assert np.array_equal(read_back.last_updated_ms, key_map.last_updated_ms)
+        assert list(read_back.assign([3], ["2023-01-01T00:00:00.000"])) == [3]
+        assert read_back.assigned == 0
+
+    def test_arrow_builder_assigns_the_same_keys(self, df_sales_order):
+        df_reordered = df_sales_order.iloc[::-1]
+        pandas_map = SalesRecordKeyMap()
+        arrow_map = SalesRecordKeyMap()
+        _return_df_fact_sales_order(df_sales_order, key_map=pandas_map)
+        _return_table_fact_sales_order(
+            pa.Table.from_pandas(df_sales_order, preserve_index=False),
+            key_map=arrow_map,
+        )
+
+        # act
+        df_fact = _return_df_fact_sales_order(df_reordered, key_map=pandas_map)
+        tbl_fact = _return_table_fact_sales_order(
+            pa.Table.from_pandas(df_reordered, preserve_index=False),
+            key_map=arrow_map,
+        )
+
+        # assert
+        assert list(df_fact.index) == list(range(len(df_sales_order), 0, -1))
+        assert tbl_fact["sales_record_id"].to_pylist() == list(df_fact.index)
+
+
+class TestStableKeysHandler:
+    @pytest.mark.parametrize("engine", ["pandas", "arrow", "duckdb"])
+    def test_keys_survive_reordered_snapshot(
+        self, s3_client_ingestion_populated, engine
+    ):
+        if engine == "duckdb":
+            pytest.importorskip("duckdb")
+        s3_client, datetime_string = s3_client_ingestion_populated
+        next_datetime_string = f"{datetime_string}-next"
+        for table_name in TOTESYS_TABLES:
+            s3_client.copy_object(
+                Bucket=INGESTION_BUCKET,
+                Key=return_s3_key(table_name, next_datetime_string),
+                CopySource={
+                    "Bucket": INGESTION_BUCKET,
+                    "Key": return_s3_key(table_name, datetime_string),
+                },
+            )
+        with open("data/json_files/sales_order.json") as f:
+            sales_orders = json.load(f)
+        s3_client.put_object(
+            Bucket=INGESTION_BUCKET,
+            Key=return_s3_key("sales_order", next_datetime_string),
+            Body=json.dumps(sales_orders[::-1]),
+        )
+        event = {"testing_client": s3_client, "engine": engine, "stable_keys": True}
+
+        def read_fact(run_datetime):
+            obj = s3_client.get_object(
+                Bucket=PROCESSED_BUCKET,
+                Key=return_s3_key("fact_sales_order", run_datetime, ".parquet"),
+            )
+            df = pd.read_parquet(io.BytesIO(obj["Body"].read()))
+            if df.index.name is not None:
+                df = df.reset_index()
+            return df.set_index("sales_record_id").sort_index()
+
+        # act
+        first = lambda_handler({**event, "datetime_string": datetime_string}, {})
+        second = lambda_handler({**event, "datetime_string": next_datetime_string}, {})
+
+        # assert
+        assert first["statusCode"] == 200
+        assert second["statusCode"] == 200
+        pd.testing.assert_frame_equal(
+            read_fact(next_datetime_string), read_fact(datetime_string)
+        )
@@ -0,0 +1,36 @@
+import datetime
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from src.lambda_transform_lookup import DimensionLookup
+
+
+class TestDimensionLookup:
+    def test_positions_of_keys_and_missing_values(self):
+        lookup = DimensionLookup("dim_currency", pa.array([3, 1, 2]))
+
+        # act
+        positions = lookup.positions(pd.Series([1, 2, 5, None, 3]))
+
+        # assert
+        assert positions.dtype == np.int64
+        assert positions.tolist() == [1, 2, -1, -1, 0]
+        assert lookup.contains(np.array([2, 4])).tolist() == [True, False]
+        assert len(lookup) == 3
+
+    def test_keys_compare_across_engines(self):
+        lookup = DimensionLookup("dim_date", pd.Series(["2022-11-03", "2022-11-04"]))
+        dates = pa.array(
+            [datetime.date(2022, 11, 4), datetime.date(2030, 1, 1)]
+        ).dictionary_encode()
+
+        assert lookup.positions(dates).tolist() == [1, -1]
+        assert DimensionLookup("dim_staff", pa.array([1, 2], pa.int16())).contains(
+            pa.chunked_array([[2.0, 3.0]])
+        ).tolist() == [True, False]
+
+    def test_repeated_keys_resolve_to_first_row(self):
+        lookup = DimensionLookup("dim_design", [4, 5, 4, 6])
+
+        assert lookup.positions([4, 6, 5]).tolist() == [0, 3, 1]
+        assert lookup.keys.tolist() == [4, 5, 6]
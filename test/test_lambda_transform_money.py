@@ -0,0 +1,187 @@
+import json
+import decimal
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from io import BytesIO
+from src.utils import return_s3_key
+from src.lambda_transform import lambda_handler, return_output_run_options
+from src.lambda_transform import DEFAULT_RUN_OPTIONS
+from src.lambda_transform_money import (
+    FIXED_POINT_MONEY_COLUMNS,
+    return_pence,
+    return_decimal_array,
+    return_fixed_point_measures,
+    return_money_decimals,
+    return_too_wide_mask,
+)
+from src.lambda_transform_utils import (
+    _return_df_fact_sales_order,
+    _return_df_fact_purchase_order,
+    _return_df_fact_payment,
+)
+from src.lambda_transform_validation import ReferenceValidator
+from conftest import PROCESSED_BUCKET
+
+
+class TestFixedPointMoney:
+    def test_prices_become_exact_pence(self):
+        pence, missing = return_pence([2.51, 0.29, 1234567.89, None, -0.07])
+
+        assert pence.dtype == np.int64
+        assert pence.tolist() == [251, 29, 123456789, 0, -7]
+        assert missing.tolist() == [False, False, False, True, False]
+
+    def test_decimal_array_from_pence(self):
+        pence = np.array([251, -7, 0, 10**15], dtype="int64")
+        missing = np.array([False, False, True, False])
+
+        # act
+        decimals = return_decimal_array(pence, missing, pa.decimal128(18, 2))
+
+        # assert
+        expected = pa.array(
+            [
+                decimal.Decimal("2.51"),
+                decimal.Decimal("-0.07"),
+                None,
+                decimal.Decimal("10000000000000.00"),
+            ],
+            pa.decimal128(18, 2),
+        )
+        assert decimals.equals(expected)
+        assert decimals.null_count == 1
+
+    def test_values_wider_than_the_precision_are_found(self):
+        pence = np.array([10**10 - 1, 10**10, -(10**10), 10**12], dtype="int64")
+        missing = np.array([False, False, False, True])
+
+        # act
+        decimals = return_decimal_array(pence, missing, pa.decimal128(10, 2))
+        too_wide = return_too_wide_mask(decimals, pa.decimal128(10, 2))
+        floats = pa.array([99999999.99, 99999999.999, -1e8, None])
+
+        # assert
+        assert too_wide.tolist() == [False, True, True, False]
+        assert return_too_wide_mask(floats, pa.decimal128(10, 2)).tolist() == [
+            False,
+            True,
+            True,
+            False,
+        ]
+        assert not return_too_wide_mask(decimals, pa.decimal128(38, 2)).any()
+
+    def test_rows_too_wide_for_the_warehouse_are_quarantined(self):
+        df_sales_order = pd.DataFrame(
+            json.load(open("data/json_files/sales_order.json"))
+        ).head(3)
+        # 100000 units at 99999999.99 are 15 digits of pence, gross_value has 12
+        df_sales_order.loc[1, ["units_sold", "unit_price"]] = [100000, 99999999.99]
+        df_fact = _return_df_fact_sales_order(df_sales_order, fixed_point_money=True)
+
+        # act
+        df_valid, df_quarantine = ReferenceValidator().validate(
+            "fact_sales_order", df_fact
+        )
+
+        # assert
+        assert df_valid.index.tolist() == [1, 3]
+        assert df_quarantine.index.tolist() == [2]
+        assert df_quarantine["quarantine_reason"].tolist() == [
+            "gross_value does not fit NUMERIC(12,2); "
+            "gross_value_gbp does not fit NUMERIC(12,2)"
+        ]
+
+    def test_measures_are_worked_out_in_pence(self):
+        measures = return_fixed_point_measures(
+            [3, 10, 1, 2], [0.29, 2.51, 2.5, None], [1, 2, 9, 1], "2022-11-03"
+        )
+
+        # assert
+        assert list(measures) == FIXED_POINT_MONEY_COLUMNS["fact_sales_order"]
+        assert measures["unit_price"].type == pa.decimal128(10, 2)
+        assert measures["gross_value"].type == pa.decimal128(12, 2)
+        assert measures["gross_value"].to_pylist() == [
+            decimal.Decimal("0.87"),
+            decimal.Decimal("25.10"),
+            decimal.Decimal("2.50"),
+            None,
+        ]
+        # 2510 pence at 0.896 is 2248.96 pence, 22.49 rounded half up;
+        # currency_id 9 has no rate
+        assert measures["gross_value_gbp"].to_pylist() == [
+            decimal.Decimal("0.87"),
+            decimal.Decimal("22.49"),
+            None,
+            None,
+        ]
+
+    def test_other_fact_money_columns_are_exact_decimals(self):
+        with open("data/json_files/purchase_order.json") as f:
+            df_purchase_order = pd.DataFrame(json.load(f))
+        with open("data/json_files/payment.json") as f:
+            df_payment = pd.DataFrame(json.load(f))
+
+        # act
+        df_purchase = _return_df_fact_purchase_order(
+            df_purchase_order, fixed_point_money=True
+        )
+        df_payment_fact = _return_df_fact_payment(df_payment, fixed_point_money=True)
+
+        # assert
+        for df_fact, column, df_source in [
+            (df_purchase, "item_unit_price", df_purchase_order),
+            (df_payment_fact, "payment_amount", df_payment),
+        ]:
+            assert df_fact[column].dtype == pd.ArrowDtype(pa.decimal128(38, 2))
+            assert df_fact[column].tolist() == [
+                decimal.Decimal(f"{value:.2f}") for value in df_source[column]
+            ]
+        assert return_money_decimals(
+            "fact_payment", "payment_amount", [949774.71]
+        ).to_pylist() == [decimal.Decimal("949774.71")]
+
+
+class TestFixedPointMoneyHandler:
+    def test_engines_write_the_same_decimals(self, s3_client_ingestion_populated):
+        s3_client, datetime_string = s3_client_ingestion_populated
+        event = {
+            "datetime_string": datetime_string,
+            "testing_client": s3_client,
+            "fixed_point_money": True,
+            "all_tables": True,
+        }
+
+        def read_money_columns(table_name):
+            key = return_s3_key(table_name, datetime_string, ".parquet")
+            body = s3_client.get_object(Bucket=PROCESSED_BUCKET, Key=key)["Body"]
+            return pq.read_table(
+                BytesIO(body.read()), columns=FIXED_POINT_MONEY_COLUMNS[table_name]
+            )
+
+        # act
+        tables = []
+        for engine in ["pandas", "arrow", "duckdb"]:
+            response = lambda_handler({**event, "engine": engine}, {})
+            assert response["statusCode"] == 200
+            tables.append(
+                {
+                    table_name: read_money_columns(table_name)
+                    for table_name in FIXED_POINT_MONEY_COLUMNS
+                }
+            )
+
+        # assert
+        assert tables[0]["fact_sales_order"].schema.field(
+            "gross_value"
+        ).type == pa.decimal128(12, 2)
+        for table_name in ["fact_purchase_order", "fact_payment"]:
+            for field in tables[0][table_name].schema:
+                assert field.type == pa.decimal128(38, 2)
+        for table_name in FIXED_POINT_MONEY_COLUMNS:
+            assert tables[1][table_name].equals(tables[0][table_name])
+            assert tables[2][table_name].equals(tables[0][table_name])
+            assert "fixed_point_money" in return_output_run_options(
+                table_name, DEFAULT_RUN_OPTIONS
+            )
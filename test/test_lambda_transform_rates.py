@@ -0,0 +1,85 @@
+import json
+import numpy as np
+import pandas as pd
+from src.lambda_transform import lambda_handler, return_output_run_options
+from src.lambda_transform import DEFAULT_RUN_OPTIONS
+from src.lambda_transform_utils import _return_df_fact_sales_order, read_manifest
+from src.lambda_transform_rates import (
+    GBP_RATE_VERSIONS,
+    CURRENT_GBP_RATES_VERSION,
+    return_gbp_rates,
+    return_gross_values,
+    return_gbp_values,
+    round_to_pence,
+)
+from conftest import PROCESSED_BUCKET
+
+
+class TestGbpRates:
+    def test_rates_are_indexed_by_currency_id(self):
+        rates = return_gbp_rates()
+
+        assert rates[1] == 1.0
+        assert np.isnan(rates[0])
+        assert len(rates) == max(GBP_RATE_VERSIONS[CURRENT_GBP_RATES_VERSION]) + 1
+
+    def test_measures_are_rounded_half_up_to_pence(self):
+        gross_values = return_gross_values([3, 10], [2.5, 0.33])
+
+        assert round_to_pence(np.array([0.125, 0.375, -0.125])).tolist() == [
+            0.13,
+            0.38,
+            -0.12,
+        ]
+        assert gross_values.tolist() == [7.5, 3.3]
+        gbp_values = return_gbp_values([100.0] * 4, [1, 2, 9, None], "2022-11-03")
+        assert gbp_values[:2].tolist() == [100.0, 89.6]
+        assert np.isnan(gbp_values[2:]).all()
+
+    def test_fact_sales_order_measures(self):
+        with open("data/json_files/sales_order.json") as f:
+            df_sales_order = pd.DataFrame(json.load(f))
+
+        # act
+        df_fact = _return_df_fact_sales_order(df_sales_order)
+
+        # assert
+        rates = GBP_RATE_VERSIONS[CURRENT_GBP_RATES_VERSION]
+        expected_gross = (df_fact["units_sold"] * df_fact["unit_price"]).round(2)
+        np.testing.assert_allclose(df_fact["gross_value"], expected_gross)
+        np.testing.assert_allclose(
+            df_fact["gross_value_gbp"],
+            (df_fact["gross_value"] * df_fact["currency_id"].map(rates)).round(2),
+            atol=0.01,
+        )
+        gbp_rows = df_fact["currency_id"] == 1
+        assert (
+            df_fact.loc[gbp_rows, "gross_value_gbp"]
+            == df_fact.loc[gbp_rows, "gross_value"]
+        ).all()
+
+
+class TestGbpRatesVersionHandler:
+    def test_version_is_recorded_and_part_of_the_fingerprint(
+        self, s3_client_ingestion_populated
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated
+        event = {"datetime_string": datetime_string, "testing_client": s3_client}
+
+        # act
+        response = lambda_handler(event, {})
+        manifest = read_manifest(s3_client, PROCESSED_BUCKET, datetime_string)
+        unknown_version = lambda_handler({**event, "gbp_rates_version": "1999"}, {})
+
+        # assert
+        assert response["statusCode"] == 200
+        assert manifest["tables"]["fact_sales_order"]["gbp_rates_version"] == (
+            CURRENT_GBP_RATES_VERSION
+        )
+        assert "no GBP rates version 1999" in unknown_version
+        assert "gbp_rates_version" in return_output_run_options(
+            "fact_sales_order", DEFAULT_RUN_OPTIONS
+        )
+        assert "gbp_rates_version" not in return_output_run_options(
+            "dim_date", DEFAULT_RUN_OPTIONS
+        )
@@ -0,0 +1,235 @@
+import json
+import time
+import pytest
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from io import BytesIO
+from src.utils import return_s3_key, return_part_s3_key
+from src.lambda_transform import lambda_handler
+from src.lambda_transform_utils import (
+    _return_df_fact_sales_order,
+    read_manifest,
+    return_table_s3_keys,
+)
+from src.lambda_transform_validation import ReferenceValidator
+from src.lambda_transform_shards import build_and_populate_table_sharded
+from conftest import PROCESSED_BUCKET
+
+
+@pytest.fixture()
+def df_sales_order():
+    with open("data/json_files/sales_order.json") as f:
+        return pd.DataFrame(json.load(f))
+
+
+def read_parts(s3_client, keys):
+    return pa.concat_tables(
+        pq.read_table(
+            BytesIO(
+                s3_client.get_object(Bucket=PROCESSED_BUCKET, Key=key)["Body"].read()
+            )
+        )
+        for key in keys
+    )
+
+
+class TestBuildAndPopulateTableSharded:
+    def test_parts_hold_the_rows_of_a_single_build(
+        self, s3_client_ingestion_populated, df_sales_order
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated
+
+        # act
+        response, timings = build_and_populate_table_sharded(
+            s3_client,
+            datetime_string,
+            "fact_sales_order",
+            _return_df_fact_sales_order,
+            df_sales_order,
+            PROCESSED_BUCKET,
+            3,
+        )
+
+        # assert
+        keys = [part["key"] for part in response["Parts"]]
+        assert keys == [
+            return_part_s3_key("fact_sales_order", datetime_string, part_number)
+            for part_number in range(3)
+        ]
+        expected = pa.Table.from_pandas(_return_df_fact_sales_order(df_sales_order))
+        parts = read_parts(s3_client, keys).sort_by("sales_record_id")
+        assert parts.equals(expected)
+        assert timings["rows"] == len(df_sales_order)
+        assert timings["shards"] == 3
+
+    def test_every_version_of_an_order_is_in_one_part(
+        self, s3_client_ingestion_populated, df_sales_order
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated
+        df_sales_order = df_sales_order.head(9).copy()
+        df_sales_order["sales_order_id"] = [3, 1, 2, 3, 1, 2, 3, 1, 2]
+
+        # act
+        response, timings = build_and_populate_table_sharded(
+            s3_client,
+            datetime_string,
+            "fact_sales_order",
+            _return_df_fact_sales_order,
+            df_sales_order,
+            PROCESSED_BUCKET,
+            3,
+        )
+
+        # assert
+        parts = [read_parts(s3_client, [part["key"]]) for part in response["Parts"]]
+        assert [set(part["sales_order_id"].to_pylist()) for part in parts] == [
+            {1},
+            {2},
+            {3},
+        ]
+        assert parts[0]["sales_record_id"].to_pylist() == [2, 5, 8]
+
+    def test_no_more_processes_run_than_cpus(
+        self, s3_client_ingestion_populated, df_sales_order, tmp_path, monkeypatch
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated
+        monkeypatch.setattr("src.lambda_transform_shards.os.cpu_count", lambda: 2)
+
+        def builder(df_shard, record_ids):
+            started = time.perf_counter()
+            time.sleep(0.2)
+            (tmp_path / str(record_ids[0])).write_text(
+                f"{started} {time.perf_counter()}"
+            )
+            return _return_df_fact_sales_order(df_shard, record_ids=record_ids)
+
+        # act
+        build_and_populate_table_sharded(
+            s3_client,
+            datetime_string,
+            "fact_sales_order",
+            builder,
+            df_sales_order,
+            PROCESSED_BUCKET,
+            4,
+        )
+
+        # assert
+        spans = [tuple(map(float, f.read_text().split())) for f in tmp_path.iterdir()]
+        assert len(spans) == 4
+        for started, _ in spans:
+            running = [span for span in spans if span[0] <= started < span[1]]
+            assert len(running) <= 2
+
+    def test_keys_repeated_across_shards_are_quarantined(
+        self, s3_client_ingestion_populated, df_sales_order, monkeypatch
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated
+        df_sales_order = df_sales_order.head(6).copy()
+        # both shards are forked before either is checked
+        monkeypatch.setattr("src.lambda_transform_shards.os.cpu_count", lambda: 2)
+
+        def builder(df_shard, record_ids):
+            # numbers every shard's rows from 1
+            return _return_df_fact_sales_order(df_shard)
+
+        # act
+        response, timings = build_and_populate_table_sharded(
+            s3_client,
+            datetime_string,
+            "fact_sales_order",
+            builder,
+            df_sales_order,
+            PROCESSED_BUCKET,
+            2,
+            validator=ReferenceValidator(),
+        )
+
+        # assert
+        assert [part["rows"] for part in response["Parts"]] == [3, 0]
+        keys = [part["key"] for part in response["Parts"]]
+        assert read_parts(s3_client, keys)["sales_record_id"].to_pylist() == [1, 2, 3]
+        assert read_parts(s3_client, keys)["sales_order_id"].to_pylist() == list(
+            df_sales_order["sales_order_id"][:3]
+        )
+        assert timings["validation"]["quarantined_rows"] == 3
+        quarantine = read_parts(s3_client, [timings["validation"]["quarantine_key"]])
+        assert (
+            quarantine["quarantine_reason"].to_pylist()
+            == ["sales_record_id is repeated"] * 3
+        )
+
+    def test_invalid_rows_of_every_shard_are_quarantined(
+        self, s3_client_ingestion_populated, df_sales_order
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated
+        df_sales_order = df_sales_order.head(6).copy()
+        df_sales_order["currency_id"] = [1, 9, 1, 1, 9, 1]
+        validator = ReferenceValidator()
+        validator.add_dimension_keys("dim_currency", pa.array([1]))
+
+        # act
+        response, timings = build_and_populate_table_sharded(
+            s3_client,
+            datetime_string,
+            "fact_sales_order",
+            _return_df_fact_sales_order,
+            df_sales_order,
+            PROCESSED_BUCKET,
+            2,
+            validator=validator,
+        )
+
+        # assert
+        assert [part["rows"] for part in response["Parts"]] == [2, 2]
+        assert timings["validation"]["quarantined_rows"] == 2
+        quarantine = read_parts(s3_client, [timings["validation"]["quarantine_key"]])
+        assert quarantine["sales_record_id"].to_pylist() == [2, 5]
+
+    def test_a_failed_shard_is_raised(
+        self, s3_client_ingestion_populated, df_sales_order
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated
+
+        def builder(df_shard, record_ids):
+            if record_ids[0] > 1:
+                raise KeyError("units_sold")
+            return _return_df_fact_sales_order(df_shard, record_ids=record_ids)
+
+        with pytest.raises(RuntimeError, match="shard 1 failed: KeyError"):
+            build_and_populate_table_sharded(
+                s3_client,
+                datetime_string,
+                "fact_sales_order",
+                builder,
+                df_sales_order,
+                PROCESSED_BUCKET,
+                2,
+            )
+
+
+class TestFactShardsHandler:
+    def test_manifest_lists_the_parts(self, s3_client_ingestion_populated):
+        s3_client, datetime_string = s3_client_ingestion_populated
+        event = {"datetime_string": datetime_string, "testing_client": s3_client}
+
+        # act
+        lambda_handler(event, {})
+        expected = read_parts(
+            s3_client,
+            [return_s3_key("fact_sales_order", datetime_string, ".parquet")],
+        )
+        response = lambda_handler({**event, "fact_shards": 2}, {})
+        manifest = read_manifest(s3_client, PROCESSED_BUCKET, datetime_string)
+        unsupported = lambda_handler({**event, "fact_shards": 2, "engine": "arrow"}, {})
+
+        # assert
+        assert response["statusCode"] == 200
+        entry = manifest["tables"]["fact_sales_order"]
+        assert len(entry["parts"]) == 2
+        assert entry["rows"] == sum(part["rows"] for part in entry["parts"])
+        keys = return_table_s3_keys(manifest, "fact_sales_order", datetime_string)
+        parts = read_parts(s3_client, keys).sort_by("sales_record_id")
+        assert parts.equals(expected.sort_by("sales_record_id"))
+        assert "fact_shards runs need the pandas engine" in unsupported
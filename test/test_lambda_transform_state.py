@@ -0,0 +1,350 @@
+import io
+import json
+import pytest
+import pandas as pd
+import pyarrow as pa
+from unittest.mock import MagicMock
+from src.utils import (
+    return_s3_key,
+    get_primary_keys_from_table,
+    write_key_index_to_s3,
+)
+from src.lambda_transform import lambda_handler
+from src.lambda_transform_state import (
+    merge_current_state,
+    read_current_state,
+    update_current_state,
+    keep_latest_versions,
+    LATEST_VERSION_KEYS,
+)
+from conftest import INGESTION_BUCKET, PROCESSED_BUCKET, TOTESYS_TABLES
+
+
+def read_processed_table(s3_client, table_name, datetime_string):
+    obj = s3_client.get_object(
+        Bucket=PROCESSED_BUCKET,
+        Key=return_s3_key(table_name, datetime_string, ".parquet"),
+    )
+    df = pd.read_parquet(io.BytesIO(obj["Body"].read()))
+    if df.index.name is not None:
+        df = df.reset_index()
+    return df
+
+
+class TestMergeCurrentState:
+    def test_updated_rows_are_replaced_in_place_and_new_rows_appended(self):
+        df_state = pd.DataFrame({"id": [1, 2, 3], "name": ["a", "b", "c"]})
+        df_delta = pd.DataFrame({"id": [4, 2, 2], "name": ["d", "x", "y"]})
+
+        # act
+        df_merged = merge_current_state(df_state, df_delta, ["id"])
+
+        # assert
+        expected = pd.DataFrame({"id": [1, 2, 3, 4], "name": ["a", "y", "c", "d"]})
+        pd.testing.assert_frame_equal(df_merged, expected)
+
+    def test_empty_delta_or_state(self):
+        df_state = pd.DataFrame({"id": [1], "name": ["a"]})
+
+        assert merge_current_state(df_state, pd.DataFrame([]), ["id"]) is df_state
+        assert merge_current_state(None, pd.DataFrame([]), ["id"]) is None
+        pd.testing.assert_frame_equal(
+            merge_current_state(None, df_state, ["id"]), df_state
+        )
+
+    def test_compound_key_keeps_every_version(self):
+        df_state = pd.DataFrame(
+            {"sales_order_id": [1, 1], "last_updated": ["t1", "t2"], "units": [5, 6]}
+        )
+        df_delta = pd.DataFrame(
+            {"sales_order_id": [1, 1], "last_updated": ["t2", "t3"], "units": [6, 7]}
+        )
+
+        # act
+        df_merged = merge_current_state(
+            df_state, df_delta, ["sales_order_id", "last_updated"]
+        )
+
+        # assert
+        assert df_merged["last_updated"].tolist() == ["t1", "t2", "t3"]
+        assert df_merged["units"].tolist() == [5, 6, 7]
+
+
+class TestUpdateCurrentState:
+    def test_deltas_are_merged_into_stored_state(self, s3_client_ingestion_populated):
+        s3_client, _ = s3_client_ingestion_populated
+        df_first = pd.DataFrame({"design_id": [1, 2], "design_name": ["a", "b"]})
+        df_second = pd.DataFrame({"design_id": [2, 3], "design_name": ["x", "c"]})
+
+        # act
+        update_current_state(s3_client, PROCESSED_BUCKET, "design", df_first)
+        df_returned = update_current_state(
+            s3_client, PROCESSED_BUCKET, "design", df_second
+        )
+        df_stored = read_current_state(s3_client, PROCESSED_BUCKET, "design")
+
+        # assert
+        assert df_stored["design_name"].tolist() == ["a", "x", "c"]
+        pd.testing.assert_frame_equal(df_returned, df_stored)
+        assert read_current_state(s3_client, PROCESSED_BUCKET, "staff") is None
+
+
+class TestIncrementalHandler:
+    def test_full_snapshot_builds_same_tables(self, s3_client_ingestion_populated):
+        s3_client, datetime_string = s3_client_ingestion_populated
+        event = {"datetime_string": datetime_string, "testing_client": s3_client}
+
+        # act
+        full_response = lambda_handler(event, {})
+        full_tables = {
+            table_name: read_processed_table(s3_client, table_name, datetime_string)
+            for table_name in full_response["timings"]
+        }
+        incremental_response = lambda_handler({**event, "incremental": True}, {})
+
+        # assert
+        assert incremental_response["statusCode"] == 200
+        for table_name, df_expected in full_tables.items():
+            df_table = read_processed_table(s3_client, table_name, datetime_string)
+            pd.testing.assert_frame_equal(df_table, df_expected)
+
+    def test_delta_snapshot_joins_with_unchanged_rows(
+        self, s3_client_ingestion_populated
+    ):
+        s3_client, first = s3_client_ingestion_populated
+        second = f"{first}-next"
+        with open("data/json_files/counterparty.json") as f:
+            counterparties = json.load(f)
+        with open("data/json_files/address.json") as f:
+            addresses = json.load(f)
+        # a new counterparty at an unchanged address, and a changed address
+        new_counterparty = {
+            **counterparties[0],
+            "counterparty_id": 1000,
+            "counterparty_legal_name": "New Ltd",
+        }
+        changed_address = {**addresses[-1], "city": "Changed City"}
+        deltas = {table_name: [] for table_name in TOTESYS_TABLES}
+        deltas["counterparty"] = [new_counterparty]
+        deltas["address"] = [changed_address]
+        for table_name, rows in deltas.items():
+            s3_client.put_object(
+                Bucket=INGESTION_BUCKET,
+                Key=return_s3_key(table_name, second),
+                Body=json.dumps(rows),
+            )
+        event = {"testing_client": s3_client, "incremental": True}
+
+        # act
+        lambda_handler({**event, "datetime_string": first}, {})
+        response = lambda_handler({**event, "datetime_string": second}, {})
+
+        # assert
+        assert response["statusCode"] == 200
+        assert response["timings"]["dim_counterparty"]["rows"] == (
+            len(counterparties) + 1
+        )
+        assert response["timings"]["fact_sales_order"]["rows"] == 12836
+        df_counterparty = read_processed_table(s3_client, "dim_counterparty", second)
+        new_row = df_counterparty.loc[df_counterparty["counterparty_id"] == 1000]
+        first_row = df_counterparty.loc[
+            df_counterparty["counterparty_id"] == counterparties[0]["counterparty_id"]
+        ]
+        assert new_row["counterparty_legal_city"].tolist() == (
+            first_row["counterparty_legal_city"].tolist()
+        )
+        df_location = read_processed_table(s3_client, "dim_location", second)
+        assert len(df_location) == len(addresses)
+        changed_row = df_location.loc[
+            df_location["location_id"] == changed_address["address_id"]
+        ]
+        assert changed_row["city"].tolist() == ["Changed City"]
+
+    def test_rows_missing_from_key_index_are_deleted(
+        self, s3_client_ingestion_populated
+    ):
+        s3_client, first = s3_client_ingestion_populated
+        second = f"{first}-next"
+        with open("data/json_files/design.json") as f:
+            designs = json.load(f)
+        for table_name in TOTESYS_TABLES:
+            s3_client.put_object(
+                Bucket=INGESTION_BUCKET,
+                Key=return_s3_key(table_name, second),
+                Body=b"[]",
+            )
+        # the delta holds one changed design, the last design was deleted
+        # from the source, and the index lists every key still in it
+        changed_design = {**designs[0], "design_name": "Changed"}
+        s3_client.put_object(
+            Bucket=INGESTION_BUCKET,
+            Key=return_s3_key("design", second),
+            Body=json.dumps([changed_design]),
+        )
+        mock_conn = MagicMock()
+        mock_conn.run.return_value = [[design["design_id"]] for design in designs[:-1]]
+        write_key_index_to_s3(
+            s3_client,
+            INGESTION_BUCKET,
+            "design",
+            get_primary_keys_from_table(mock_conn, "design", "design_id"),
+            second,
+        )
+        event = {"testing_client": s3_client, "incremental": True}
+
+        # act
+        lambda_handler({**event, "datetime_string": first}, {})
+        response = lambda_handler({**event, "datetime_string": second}, {})
+
+        # assert - unchanged designs are kept, only the deleted one goes
+        assert response["timings"]["dim_design"]["rows"] == len(designs) - 1
+        df_state = read_current_state(s3_client, PROCESSED_BUCKET, "design")
+        assert sorted(df_state["design_id"]) == sorted(
+            design["design_id"] for design in designs[:-1]
+        )
+        changed_row = df_state.loc[
+            df_state["design_id"] == changed_design["design_id"], "design_name"
+        ]
+        assert changed_row.tolist() == ["Changed"]
+        assert response["timings"]["dim_location"]["rows"] > 0
+
+    def test_incremental_needs_pandas_engine(self, s3_client_ingestion_populated):
+        s3_client, datetime_string = s3_client_ingestion_populated
+        event = {
+            "datetime_string": datetime_string,
+            "testing_client": s3_client,
+            "incremental": True,
+        }
+
+        assert "pandas engine" in lambda_handler({**event, "engine": "arrow"}, {})
+        assert "pandas engine" in lambda_handler({**event, "chunk_rows": 100}, {})
+
+
+class TestKeepLatestVersions:
+    @pytest.fixture()
+    def df_versions(self):
+        return pd.DataFrame(
+            {
+                "id": [1, 2, 1, 3, 2, 3],
+                "last_updated": [
+                    "2022-11-03T14:20:52.186",
+                    "2022-11-03T14:20:52.186",
+                    "2022-11-04T10:00:00.000",
+                    "2022-11-03T14:20:52.186",
+                    "2022-11-01T09:00:00.000",
+                    "2022-11-03T14:20:52.186",
+                ],
+                "name": ["a", "b", "c", "d", "e", "f"],
+            }
+        )
+
+    def test_latest_version_of_each_key_is_kept_in_row_order(self, df_versions):
+        df_latest = keep_latest_versions(df_versions, ["id"])
+
+        # equal versions keep the later row
+        assert df_latest["name"].tolist() == ["b", "c", "f"]
+        assert df_latest.index.tolist() == [0, 1, 2]
+
+    def test_arrow_table_matches_dataframe(self, df_versions):
+        tbl_latest = keep_latest_versions(
+            pa.Table.from_pandas(df_versions, preserve_index=False), ["id"]
+        )
+
+        assert isinstance(tbl_latest, pa.Table)
+        assert tbl_latest["name"].to_pylist() == ["b", "c", "f"]
+
+    def test_tables_without_duplicates_are_unchanged(self):
+        with open("data/json_files/sales_order.json") as f:
+            df_sales_order = pd.DataFrame(json.load(f))
+
+        assert (
+            keep_latest_versions(df_sales_order, LATEST_VERSION_KEYS["sales_order"])
+            is df_sales_order
+        )
+
+    def test_sales_order_keeps_one_row_per_order(self):
+        df_sales_order = pd.DataFrame(
+            {
+                "sales_order_id": [1, 2, 1],
+                "last_updated": [
+                    "2022-11-03T14:20:52.186",
+                    "2022-11-03T14:20:52.186",
+                    "2022-11-05T09:00:00.000",
+                ],
+                "units_sold": [10, 20, 15],
+            }
+        )
+
+        df_latest = keep_latest_versions(
+            df_sales_order, LATEST_VERSION_KEYS["sales_order"]
+        )
+
+        assert df_latest["sales_order_id"].tolist() == [2, 1]
+        assert df_latest["units_sold"].tolist() == [20, 15]
+
+    @pytest.mark.parametrize("engine", ["pandas", "arrow", "duckdb"])
+    def test_handler_builds_from_latest_versions(
+        self, s3_client_ingestion_populated, engine
+    ):
+        s3_client, datetime_string = s3_client_ingestion_populated
+        with open("data/json_files/counterparty.json") as f:
+            counterparties = json.load(f)
+        # two snapshots of counterparty combined, the second renaming one
+        renamed = {
+            **counterparties[0],
+            "counterparty_legal_name": "Renamed Ltd",
+            "last_updated": "2030-01-01T00:00:00.000",
+        }
+        s3_client.put_object(
+            Bucket=INGESTION_BUCKET,
+            Key=return_s3_key("counterparty", datetime_string),
+            Body=json.dumps([renamed] + counterparties),
+        )
+        event = {
+            "datetime_string": datetime_string,
+            "testing_client": s3_client,
+            "engine": engine,
+            "latest_versions": True,
+        }
+
+        # act
+        response = lambda_handler(event, {})
+
+        # assert
+        assert response["statusCode"] == 200
+        df_counterparty = read_processed_table(
+            s3_client, "dim_counterparty", datetime_string
+        )
+        assert len(df_counterparty) == len(counterparties)
+        assert "Renamed Ltd" in df_counterparty["counterparty_legal_name"].tolist()
+
+    def test_handler_builds_one_fact_row_per_order(self, s3_client_ingestion_populated):
+        s3_client, datetime_string = s3_client_ingestion_populated
+        with open("data/json_files/sales_order.json") as f:
+            sales_orders = json.load(f)
+        # two snapshots of sales_order combined, the second updating an order
+        updated = {
+            **sales_orders[0],
+            "units_sold": 1,
+            "last_updated": "2030-01-01T00:00:00.000",
+        }
+        s3_client.put_object(
+            Bucket=INGESTION_BUCKET,
+            Key=return_s3_key("sales_order", datetime_string),
+            Body=json.dumps(sales_orders + [updated]),
+        )
+        event = {
+            "datetime_string": datetime_string,
+            "testing_client": s3_client,
+            "latest_versions": True,
+        }
+
+        # act
+        response = lambda_handler(event, {})
+
+        # assert
+        assert response["statusCode"] == 200
+        df_fact = read_processed_table(s3_client, "fact_sales_order", datetime_string)
+        assert len(df_fact) == len(sales_orders)
+        order = df_fact.loc[df_fact["sales_order_id"] == updated["sales_order_id"]]
+        assert order["units_sold"].tolist() == [1]
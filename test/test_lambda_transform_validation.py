@@ -0,0 +1,286 @@
+import io
+import json
+import pytest
+import boto3
+import pandas as pd
+import pyarrow as pa
+from moto import mock_aws
+from src.utils import return_datetime_string, return_s3_key
+from src.lambda_transform import (
+    lambda_handler,
+    return_table_input_names,
+    TRANSFORM_TABLES,
+    ARROW_TRANSFORM_TABLES,
+)
+from src.lambda_transform_utils import read_manifest
+from src.lambda_transform_validation import (
+    ReferenceValidator,
+    QUARANTINE_REASON_COLUMN,
+)
+from conftest import INGESTION_BUCKET, PROCESSED_BUCKET, TOTESYS_TABLES
+
+
+@pytest.fixture()
+def totesys_json():
+    totesys_json = {}
+    for table_name in TOTESYS_TABLES:
+        with open(f"data/json_files/{table_name}.json") as f:
+            totesys_json[table_name] = json.load(f)
+    # an order by a staff member who is not in staff, an order without a
+    # design and a staff member without an email address
+    totesys_json["sales_order"][0]["staff_id"] = 999
+    totesys_json["sales_order"][1]["design_id"] = None
+    totesys_json["staff"][0]["email_address"] = None
+    return totesys_json
+
+
+@pytest.fixture()
+def s3_client_with_bad_rows(monkeypatch, totesys_json):
+    with mock_aws():
+        s3 = boto3.client("s3")
+        for bucket in [INGESTION_BUCKET, PROCESSED_BUCKET]:
+            s3.create_bucket(
+                Bucket=bucket,
+                CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+            )
+        datetime_string = return_datetime_string()
+        for table_name, rows in totesys_json.items():
+            s3.put_object(
+                Bucket=INGESTION_BUCKET,
+                Key=return_s3_key(table_name, datetime_string),
+                Body=json.dumps(rows),
+            )
+        monkeypatch.setenv("INGESTION_BUCKET", INGESTION_BUCKET)
+        monkeypatch.setenv("PROCESSED_BUCKET", PROCESSED_BUCKET)
+        yield s3, datetime_string
+
+
+class TestReferenceValidator:
+    @pytest.mark.parametrize(
+        "transform_tables, read_rows",
+        [
+            (TRANSFORM_TABLES, pd.DataFrame),
+            (ARROW_TRANSFORM_TABLES, pa.Table.from_pylist),
+        ],
+        ids=["pandas", "arrow"],
+    )
+    def test_bad_rows_are_quarantined_with_their_reasons(
+        self, totesys_json, transform_tables, read_rows
+    ):
+        validator = ReferenceValidator()
+        staff_id = totesys_json["staff"][0]["staff_id"]
+        staff_orders = sum(
+            row["staff_id"] == staff_id for row in totesys_json["sales_order"]
+        )
+        results = {}
+
+        # act - dimensions first, as the handler builds them
+        for table_name, builder, input_names in transform_tables:
+            df_table = builder(*[read_rows(totesys_json[name]) for name in input_names])
+            results[table_name] = validator.validate(table_name, df_table)
+
+        # assert
+        df_staff, staff_quarantine = results["dim_staff"]
+        assert len(df_staff) == len(totesys_json["staff"]) - 1
+        assert len(staff_quarantine) == 1
+        df_fact, fact_quarantine = results["fact_sales_order"]
+        if isinstance(fact_quarantine, pa.Table):
+            fact_quarantine = fact_quarantine.to_pandas()
+        reasons = fact_quarantine[QUARANTINE_REASON_COLUMN].tolist()
+        assert reasons[:2] == [
+            "sales_staff_id not in dim_staff",
+            "design_id is null",
+        ]
+        assert reasons[2:] == ["sales_staff_id not in dim_staff"] * staff_orders
+        assert len(df_fact) + len(reasons) == len(totesys_json["sales_order"])
+        assert results["dim_design"][1] is None
+
+    def test_rules_are_listed_together_and_keys_checked_once_each(self):
+        validator = ReferenceValidator()
+        validator.add_dimension_keys("dim_currency", pa.array([1, 2]))
+        df_currency = pd.DataFrame(
+            {
+                "currency_id": [1, 1, 2],
+                "currency_code": ["GBP", "GBP", None],
+                "currency_name": ["Pounds", "Pounds", "Dollars"],
+            }
+        ).set_index("currency_id")
+
+        # act
+        df_valid, df_quarantine = validator.validate("dim_currency", df_currency)
+
+        # assert
+        assert df_valid.index.tolist() == [1]
+        assert df_quarantine[QUARANTINE_REASON_COLUMN].tolist() == [
+            "currency_id is repeated",
+            "currency_code is null",
+        ]
+        assert validator.lookups["dim_currency"].keys.tolist() == [1]
+        assert validator.validate("not_a_table", df_currency) == (df_currency, None)
+
+    def test_keys_of_earlier_batches_are_not_repeated(self):
+        validator = ReferenceValidator()
+        df_currency = pd.DataFrame(
+            {
+                "currency_id": [1, 2, 3, 2, 3, 3],
+                "currency_code": ["GBP", "USD", "EUR", "USD", "EUR", "EUR"],
+                "currency_name": ["Pounds", "Dollars", "Euro"] * 2,
+            }
+        ).set_index("currency_id")
+
+        # act
+        validator.validate("dim_currency", df_currency.head(2))
+        df_valid, df_quarantine = validator.validate(
+            "dim_currency", df_currency.tail(4)
+        )
+
+        # assert
+        assert df_valid.index.tolist() == [3]
+        assert df_quarantine.index.tolist() == [2, 3, 3]
+        assert (
+            df_quarantine[QUARANTINE_REASON_COLUMN].tolist()
+            == ["currency_id is repeated"] * 3
+        )
+        assert validator.primary_keys["dim_currency"].tolist() == [1, 2, 3]
+
+
+class TestReturnTableInputNames:
+    def test_validated_facts_depend_on_their_dimensions_inputs(self):
+        plain = return_table_input_names(TRANSFORM_TABLES)
+        validated = return_table_input_names(TRANSFORM_TABLES, True)
+
+        assert plain["fact_sales_order"] == ["sales_order"]
+        assert validated["fact_sales_order"][0] == "sales_order"
+        assert set(validated["fact_sales_order"]) == set(TOTESYS_TABLES)
+        assert validated["dim_staff"] == ["staff", "department"]
+
+
+class TestValidationHandler:
+    @pytest.mark.parametrize("chunk_rows", [0, 5000])
+    def test_quarantined_rows_are_written_and_listed_in_manifest(
+        self, s3_client_with_bad_rows, totesys_json, chunk_rows
+    ):
+        s3_client, datetime_string = s3_client_with_bad_rows
+        event = {
+            "datetime_string": datetime_string,
+            "testing_client": s3_client,
+            "validate_references": True,
+            "warehouse_types": True,
+            "chunk_rows": chunk_rows,
+        }
+
+        # act
+        response = lambda_handler(event, {})
+        manifest = read_manifest(s3_client, PROCESSED_BUCKET, datetime_string)
+
+        # assert
+        assert response["statusCode"] == 200
+        validation = response["timings"]["fact_sales_order"]["validation"]
+        quarantined = validation["quarantined_rows"]
+        assert quarantined > 2
+        assert response["timings"]["fact_sales_order"]["rows"] == (
+            len(totesys_json["sales_order"]) - quarantined
+        )
+        assert manifest["tables"]["fact_sales_order"]["quarantine"] == {
+            "key": validation["quarantine_key"],
+            "rows": quarantined,
+        }
+        obj = s3_client.get_object(
+            Bucket=PROCESSED_BUCKET, Key=validation["quarantine_key"]
+        )
+        df_quarantine = pd.read_parquet(io.BytesIO(obj["Body"].read()))
+        assert len(df_quarantine) == quarantined
+        assert "quarantine" not in manifest["tables"]["dim_design"]
+
+    def test_reused_dimensions_are_read_for_their_keys(self, s3_client_with_bad_rows):
+        s3_client, datetime_string = s3_client_with_bad_rows
+        event = {
+            "datetime_string": datetime_string,
+            "testing_client": s3_client,
+            "validate_references": True,
+            "reuse_outputs": True,
+        }
+
+        # act - stable_keys only changes fact_sales_order, so the dimensions
+        # are copied from the first run
+        first = lambda_handler(event, {})
+        second = lambda_handler({**event, "stable_keys": True}, {})
+
+        # assert
+        assert "dim_staff" in second["skipped_tables"]
+        assert "fact_sales_order" not in second["skipped_tables"]
+        assert (
+            second["timings"]["fact_sales_order"]["validation"]["quarantined_rows"]
+            == first["timings"]["fact_sales_order"]["validation"]["quarantined_rows"]
+        )
+
+    def test_chunked_keys_are_unique_across_batches(self, s3_client_with_bad_rows):
+        s3_client, datetime_string = s3_client_with_bad_rows
+        event = {
+            "datetime_string": datetime_string,
+            "testing_client": s3_client,
+            "validate_references": True,
+            "chunk_rows": 5000,
+        }
+
+        # act
+        response = lambda_handler(event, {})
+        fact_key = return_s3_key("fact_sales_order", datetime_string, ".parquet")
+        obj = s3_client.get_object(Bucket=PROCESSED_BUCKET, Key=fact_key)
+        df_fact = pd.read_parquet(io.BytesIO(obj["Body"].read()))
+        validation = response["timings"]["fact_sales_order"]["validation"]
+        obj = s3_client.get_object(
+            Bucket=PROCESSED_BUCKET, Key=validation["quarantine_key"]
+        )
+        df_quarantine = pd.read_parquet(io.BytesIO(obj["Body"].read()))
+
+        # assert - the first batch has quarantined rows, the later batches
+        # carry on from the rows it built
+        record_ids = df_fact.index.append(df_quarantine.index)
+        assert record_ids.is_unique
+        assert sorted(record_ids) == list(range(1, len(record_ids) + 1))
+
+    def test_chunked_repeats_across_batches_are_quarantined(
+        self, totesys_json, monkeypatch
+    ):
+        # an order version repeated in a later batch gets the same stable key
+        totesys_json["sales_order"].append(dict(totesys_json["sales_order"][10]))
+        with mock_aws():
+            s3_client = boto3.client("s3")
+            for bucket in [INGESTION_BUCKET, PROCESSED_BUCKET]:
+                s3_client.create_bucket(
+                    Bucket=bucket,
+                    CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+                )
+            datetime_string = return_datetime_string()
+            for table_name, rows in totesys_json.items():
+                s3_client.put_object(
+                    Bucket=INGESTION_BUCKET,
+                    Key=return_s3_key(table_name, datetime_string),
+                    Body=json.dumps(rows),
+                )
+            monkeypatch.setenv("INGESTION_BUCKET", INGESTION_BUCKET)
+            monkeypatch.setenv("PROCESSED_BUCKET", PROCESSED_BUCKET)
+            event = {
+                "datetime_string": datetime_string,
+                "testing_client": s3_client,
+                "validate_references": True,
+                "stable_keys": True,
+                "chunk_rows": 5000,
+            }
+
+            # act
+            response = lambda_handler(event, {})
+            validation = response["timings"]["fact_sales_order"]["validation"]
+            obj = s3_client.get_object(
+                Bucket=PROCESSED_BUCKET, Key=validation["quarantine_key"]
+            )
+            df_quarantine = pd.read_parquet(io.BytesIO(obj["Body"].read()))
+
+        # assert
+        repeated = df_quarantine[
+            df_quarantine[QUARANTINE_REASON_COLUMN] == "sales_record_id is repeated"
+        ]
+        assert repeated["sales_order_id"].tolist() == [
+            totesys_json["sales_order"][10]["sales_order_id"]
+        ]
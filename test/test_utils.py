@@ -13,10 +13,15 @@ from src.utils import (
     create_conn,
     close_db,
     get_rows_and_columns_from_table,
+    get_primary_keys_from_table,
     write_table_to_s3,
     log_file,
     json_to_pg8000_output,
+    write_key_index_to_s3,
+    read_key_index,
+    return_missing_keys,
 )
+import numpy as np
 
 
 @pytest.fixture(scope="function", autouse=True)
@@ -494,4 +499,67 @@ class TestJsonToPg8000Output:
         output, cols = json_to_pg8000_output(temp_file_path)
 
         assert output == expected_output, "Output does not match expected output"
-        assert cols == expected_cols, "Column names do not match expected columns"
\ No newline at end of file
+        assert cols == expected_cols, "Column names do not match expected columns"
+
+
+class TestKeyIndex:
+    @pytest.mark.it("Stores the sorted primary keys of a snapshot in a few bytes")
+    def test_key_index_round_trip(self, s3):
+        s3.create_bucket(
+            Bucket="test-bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        rows, columns = json_to_pg8000_output("data/json_files/sales_order.json")
+
+        key = write_key_index_to_s3(
+            s3,
+            "test-bucket",
+            "sales_order",
+            [row[0] for row in rows],
+            "20240303_101010",
+        )
+        key_index = read_key_index(s3, "test-bucket", "sales_order", "20240303_101010")
+
+        assert key == "data/20240303_101010/sales_order.keys.npz"
+        assert s3.head_object(Bucket="test-bucket", Key=key)["ContentLength"] < 1024
+        assert key_index.tolist() == sorted(row[0] for row in rows)
+        assert read_key_index(s3, "test-bucket", "staff", "20240303_101010") is None
+
+    @pytest.mark.it("Indexes every key of the source table")
+    def test_primary_keys_are_read_from_the_whole_table(self):
+        mock_conn = MagicMock()
+        mock_conn.run.return_value = [[3], [1], [2]]
+
+        keys = get_primary_keys_from_table(mock_conn, "design", "design_id")
+
+        mock_conn.run.assert_called_once_with("SELECT design_id FROM design")
+        assert keys == [3, 1, 2]
+
+    @pytest.mark.it("Skips tables whose keys cannot be read")
+    def test_key_index_needs_keys(self):
+        s3_client = MagicMock()
+        mock_conn = MagicMock()
+        mock_conn.run.side_effect = Exception("column users_id does not exist")
+
+        key = write_key_index_to_s3(
+            s3_client,
+            "test-bucket",
+            "users",
+            get_primary_keys_from_table(mock_conn, "users", "users_id"),
+            "2024",
+        )
+
+        assert key is None
+        s3_client.put_object.assert_not_called()
+
+    @pytest.mark.it("Finds the keys missing from a key index")
+    def test_return_missing_keys(self):
+        new_key_index = np.array([1, 3, 5, 8, 9])
+
+        assert return_missing_keys(new_key_index, [9, 2, 1, 10]).tolist() == [
+            False,
+            True,
+            False,
+            True,
+        ]
+        assert return_missing_keys(np.array([], dtype="int64"), [1]).tolist() == [True]
@@ -0,0 +1,179 @@
+import datetime
+import decimal
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from src.warehouse_schema import (
+    WAREHOUSE_COLUMN_TYPES,
+    WAREHOUSE_ARROW_SCHEMAS,
+    WAREHOUSE_NULLABLE_COLUMNS,
+    WAREHOUSE_FOREIGN_KEYS,
+    WAREHOUSE_DATE_KEY_COLUMNS,
+    WAREHOUSE_INT_DATE_KEY_ARROW_SCHEMAS,
+    parse_create_tables,
+    parse_nullable_columns,
+    parse_foreign_keys,
+    return_integer_dtype,
+    return_arrow_type,
+    cast_to_warehouse_schema,
+)
+
+
+class TestWarehouseSchema:
+    def test_column_types_match_warehouse_ddl(self):
+        with open("db/build-data-wh.sql") as f:
+            ddl = f.read()
+
+        assert parse_create_tables(ddl) == WAREHOUSE_COLUMN_TYPES
+
+    def test_constraints_match_warehouse_ddl(self):
+        with open("db/build-data-wh.sql") as f:
+            ddl = f.read()
+
+        assert parse_nullable_columns(ddl) == WAREHOUSE_NULLABLE_COLUMNS
+        assert parse_foreign_keys(ddl) == WAREHOUSE_FOREIGN_KEYS
+        # foreign keys reference the primary key, the first column
+        for foreign_keys in WAREHOUSE_FOREIGN_KEYS.values():
+            for dimension in foreign_keys.values():
+                primary_key = next(iter(WAREHOUSE_COLUMN_TYPES[dimension]))
+                assert f"REFERENCES {dimension}({primary_key})" in ddl
+
+    def test_int_date_key_ddl_declares_date_keys_as_int(self):
+        with open("db/build-data-wh-int-date-keys.sql") as f:
+            ddl = f.read()
+
+        # act
+        column_types = parse_create_tables(ddl)
+
+        # assert
+        expected = {
+            table_name: {
+                column_name: (
+                    "INT"
+                    if column_name in WAREHOUSE_DATE_KEY_COLUMNS.get(table_name, [])
+                    else sql_type
+                )
+                for column_name, sql_type in columns.items()
+            }
+            for table_name, columns in WAREHOUSE_COLUMN_TYPES.items()
+        }
+        assert column_types == expected
+        assert parse_nullable_columns(ddl) == WAREHOUSE_NULLABLE_COLUMNS
+        assert parse_foreign_keys(ddl) == WAREHOUSE_FOREIGN_KEYS
+        assert WAREHOUSE_DATE_KEY_COLUMNS["fact_payment"] == [
+            "created_date",
+            "last_updated_date",
+            "payment_date",
+        ]
+
+    def test_integer_dtypes_follow_sql_types(self):
+        assert return_integer_dtype("dim_date", "year") == np.dtype("int32")
+        assert return_integer_dtype("fact_sales_order", "sales_record_id") == (
+            np.dtype("int32")
+        )
+        assert return_integer_dtype("fact_sales_order", "unit_price") is None
+        assert return_integer_dtype("dim_date", "day_name") is None
+        assert return_integer_dtype("not_a_table", "year") is None
+
+    def test_arrow_types_follow_sql_types(self):
+        schema = WAREHOUSE_ARROW_SCHEMAS["fact_sales_order"]
+
+        assert return_arrow_type("NUMERIC(10,2)") == pa.decimal128(10, 2)
+        assert schema.names == list(WAREHOUSE_COLUMN_TYPES["fact_sales_order"])
+        assert schema.field("sales_record_id").type == pa.int32()
+        assert schema.field("created_date").type == pa.date32()
+        assert schema.field("created_time").type == pa.time64("us")
+        assert schema.field("unit_price").type == pa.decimal128(10, 2)
+        assert WAREHOUSE_ARROW_SCHEMAS["fact_payment"].field("paid").type == (
+            pa.bool_()
+        )
+
+
+class TestCastToWarehouseSchema:
+    def test_dataframe_is_cast_to_native_types(self):
+        df = pd.DataFrame(
+            {
+                "date_id": ["2022-11-03", "2023-02-28"],
+                "year": [2022, 2023],
+                "month": [11, 2],
+                "day": [3, 28],
+                "day_of_week": [4, 2],
+                "day_name": pd.Categorical(["thursday", "tuesday"]),
+                "month_name": ["november", "february"],
+                "quarter": [4, 1],
+            }
+        ).set_index("date_id")
+
+        # act
+        table = cast_to_warehouse_schema("dim_date", df)
+
+        # assert
+        assert table.schema == WAREHOUSE_ARROW_SCHEMAS["dim_date"]
+        assert table.slice(0, 1).to_pylist() == [
+            {
+                "date_id": datetime.date(2022, 11, 3),
+                "year": 2022,
+                "month": 11,
+                "day": 3,
+                "day_of_week": 4,
+                "day_name": "thursday",
+                "month_name": "november",
+                "quarter": 4,
+            }
+        ]
+
+    def test_time_strings_and_prices_are_cast(self):
+        columns = {
+            name: pa.nulls(2, field.type)
+            for name, field in zip(
+                WAREHOUSE_ARROW_SCHEMAS["fact_sales_order"].names,
+                WAREHOUSE_ARROW_SCHEMAS["fact_sales_order"],
+            )
+        }
+        columns["created_time"] = pa.array(["14:20:52.186", None])
+        columns["unit_price"] = pa.array([3.94, 2.5])
+        columns["created_date"] = pc.dictionary_encode(
+            pa.array(["2022-11-03", "2022-11-03"])
+        )
+
+        # act
+        table = cast_to_warehouse_schema("fact_sales_order", pa.table(columns))
+
+        # assert
+        assert table.schema == WAREHOUSE_ARROW_SCHEMAS["fact_sales_order"]
+        assert table["created_time"].to_pylist() == [
+            datetime.time(14, 20, 52, 186000),
+            None,
+        ]
+        assert table["unit_price"].to_pylist() == [
+            decimal.Decimal("3.94"),
+            decimal.Decimal("2.50"),
+        ]
+        assert table["created_date"].to_pylist() == [datetime.date(2022, 11, 3)] * 2
+
+    def test_integer_date_keys_keep_their_type(self):
+        df = pd.DataFrame(
+            {
+                "date_id": np.array([20221103], dtype="int64"),
+                "year": [2022],
+                "month": [11],
+                "day": [3],
+                "day_of_week": [4],
+                "day_name": ["thursday"],
+                "month_name": ["november"],
+                "quarter": [4],
+            }
+        ).set_index("date_id")
+
+        # act
+        table = cast_to_warehouse_schema("dim_date", df)
+
+        # assert
+        assert table.schema == WAREHOUSE_INT_DATE_KEY_ARROW_SCHEMAS["dim_date"]
+        assert table["date_id"].to_pylist() == [20221103]
+
+    def test_tables_without_a_schema_are_unchanged(self):
+        df = pd.DataFrame({"a": [1]})
+
+        assert cast_to_warehouse_schema("not_a_warehouse_table", df) is df